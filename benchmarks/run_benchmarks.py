@@ -0,0 +1,452 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+import pandas as pd
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+
+from transformers import AutoTokenizer
+from transformers import AutoModelForQuestionAnswering
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.dataset import QADataset
+from modules.dataset import LengthGroupedSampler, batch_dataloader
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.ingest import iter_train_records, iter_test_records, TRAIN_FIELDS, TEST_FIELDS
+from modules.modeling import save_model_artifact
+from modules.metrics import SquadV2Scorer
+from modules.postprocess import postprocess_predictions
+from modules.preprocess import tokenize_shards, preprocess_training_examples, preprocess_shared_context_examples
+from modules.profiler import PeakRSS
+from modules.sharded_inference import predict_sharded
+from modules.window_filter import build_window_index, WindowIndex, select_windows
+from optimize import run_model
+from synthetic_data import generate, make_tiny_model
+
+
+STAGES = ('ingestion', 'tokenization', 'feature_loading', 'train_steps', 'forward', 'decode', 'sharded_forward', 'model_load', 'window_filter')
+# stages read what the stages they depend on produced
+DEPENDS = {
+    'tokenization': ('ingestion',),
+    'feature_loading': ('tokenization',),
+    'train_steps': ('feature_loading',),
+    'forward': ('tokenization',),
+    'decode': ('forward',),
+    'sharded_forward': ('forward',),
+    'window_filter': ('forward',),
+}
+
+
+def define_argparser():
+    '''
+    Define argument parser to benchmark the pipeline stages on a synthetic corpus.
+    '''
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--work_dir', required=True, help="Directory for the corpus, tiny model and feature stores.")
+    p.add_argument('--output_fn', default=None, help="Result file. Defaults to work_dir/results.json.")
+    p.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+
+    # corpus, see synthetic_data.py
+    p.add_argument('--n_train_docs', type=int, default=100)
+    p.add_argument('--n_test_docs', type=int, default=20)
+    p.add_argument('--paragraphs_per_doc', type=int, default=5)
+    p.add_argument('--questions_per_paragraph', type=int, default=3)
+    p.add_argument('--min_context_words', type=int, default=50)
+    p.add_argument('--max_context_words', type=int, default=400)
+    p.add_argument('--answer_rate', type=float, default=.7)
+    p.add_argument('--question_overlap', type=float, default=0.)
+    p.add_argument('--vocab_size', type=int, default=2000)
+    p.add_argument('--seed', type=int, default=42)
+
+    p.add_argument('--pretrained_model_name',
+                    default=None,
+                    help="Benchmark this model instead of a randomly initialized tiny BERT.")
+    p.add_argument('--max_length', type=int, default=384)
+    p.add_argument('--stride', type=int, default=50)
+    p.add_argument('--test_size', type=float, default=.2)
+    p.add_argument('--chunk_size', type=int, default=100)
+    p.add_argument('--num_workers', type=int, default=1)
+    p.add_argument('--batch_size', type=int, default=16)
+    p.add_argument('--n_train_steps', type=int, default=10)
+    p.add_argument('--n_best', type=int, default=5)
+    p.add_argument('--max_answer_length', type=int, default=40)
+    p.add_argument('--n_decode_repeats', type=int, default=5)
+    p.add_argument('--n_threads', type=int, default=None)
+    p.add_argument('--sharded_workers',
+                    type=int,
+                    nargs='+',
+                    default=[1, 2, 4, 8],
+                    help="Worker process counts of the sharded_forward stage.")
+    p.add_argument('--top_k_windows',
+                    type=int,
+                    nargs='+',
+                    default=[1, 2, 3],
+                    help="Windows kept per question by the window_filter stage.")
+
+    config = p.parse_args()
+
+    return config
+
+
+def _timed(iterable):
+    # yield (item, seconds spent producing it)
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        yield item, time.perf_counter() - started
+
+
+def bench_ingestion(state, config):
+    data_path = os.path.join(config.work_dir, 'data')
+    train = pd.DataFrame.from_records(iter_train_records(os.path.join(data_path, 'train.json')), columns=TRAIN_FIELDS)
+    test = pd.DataFrame.from_records(iter_test_records(os.path.join(data_path, 'test.json')), columns=TEST_FIELDS)
+
+    train, validation = train_test_split(train, test_size=config.test_size, random_state=42, shuffle=True)
+    state['train'] = train.reset_index()
+    state['validation'] = validation.reset_index(drop=True)
+    state['test'] = test
+    return len(train) + len(validation) + len(test), 'examples', []
+
+
+def bench_tokenization(state, config):
+    splits = (
+        ('train', preprocess_training_examples),
+        ('validation', preprocess_shared_context_examples),
+        ('test', preprocess_shared_context_examples),
+    )
+    latencies = []
+    n_examples = 0
+    for name, preprocess_fn in splits:
+        writer = FeatureStoreWriter(os.path.join(config.work_dir, 'features', name + '_features'))
+        for features, seconds in _timed(tokenize_shards(state[name], preprocess_fn, config, state['tokenizer'])):
+            writer.append(features)
+            latencies.append(seconds)
+        writer.close()
+        n_examples += len(state[name])
+    return n_examples, 'examples', latencies
+
+
+def bench_feature_loading(state, config):
+    train = FeatureStore(os.path.join(config.work_dir, 'features', 'train_features'))
+    dataset = QADataset(train['input_ids'], train['token_type_ids'], train['attention_mask'], train['start_positions'], train['end_positions'], state['tokenizer'].pad_token_id)
+    sampler = LengthGroupedSampler(train['input_ids'].lengths(), config.batch_size, shuffle=False)
+    dataloader = batch_dataloader(dataset, list(sampler), config.batch_size)
+
+    latencies = [seconds for _, seconds in _timed(dataloader)]
+    state['train_dataset'] = dataset
+    return len(dataset), 'features', latencies
+
+
+def bench_train_steps(state, config):
+    dataset = state['train_dataset']
+    sampler = LengthGroupedSampler(dataset.input_ids.lengths(), config.batch_size, shuffle=True, seed=config.seed)
+    dataloader = batch_dataloader(dataset, list(sampler), config.batch_size)
+
+    model = state['model'].train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5)
+    latencies = []
+    n_features = 0
+    for step, batch in enumerate(dataloader):
+        if step == config.n_train_steps:
+            break
+        started = time.perf_counter()
+        loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        latencies.append(time.perf_counter() - started)
+        n_features += len(batch['input_ids'])
+    model.eval()
+    return n_features, 'features', latencies
+
+
+def bench_forward(state, config):
+    valid = FeatureStore(os.path.join(config.work_dir, 'features', 'validation_features'))
+    start_logits, end_logits, latencies = run_model(state['model'].eval(), valid, config.batch_size, state['tokenizer'].pad_token_id)
+    state['valid'] = valid
+    state['logits'] = (start_logits, end_logits)
+    return len(valid), 'features', list(latencies)
+
+
+def bench_decode(state, config):
+    valid = state['valid']
+    start_logits, end_logits = state['logits']
+    offsets = np.full(start_logits.shape + (2,), -1, dtype=np.int32)
+    for i, offset in enumerate(valid['offset_mapping']):
+        offsets[i, :len(offset)] = offset
+    example_ids = list(valid['example_id'])
+
+    latencies = []
+    for _ in range(config.n_decode_repeats):
+        started = time.perf_counter()
+        postprocess_predictions(
+            start_logits,
+            end_logits,
+            offsets,
+            example_ids,
+            state['validation']['question_id'].tolist(),
+            state['validation']['context'].tolist(),
+            n_best=config.n_best,
+            max_answer_length=config.max_answer_length)
+        latencies.append(time.perf_counter() - started)
+    return len(state['validation']) * config.n_decode_repeats, 'examples', latencies
+
+
+def bench_sharded_forward(state, config):
+    valid = state['valid']
+    feature_order = list(LengthGroupedSampler(valid['input_ids'].lengths(), config.batch_size, shuffle=False))
+    start_logits, end_logits = state['logits']
+
+    workers = {}
+    for num_workers in config.sharded_workers:
+        # process start up and model sharing are included
+        started = time.perf_counter()
+        sharded_start_logits, sharded_end_logits = predict_sharded(
+            state['model'],
+            os.path.join(config.work_dir, 'features', 'validation_features'),
+            feature_order,
+            config.batch_size,
+            state['tokenizer'].pad_token_id,
+            num_workers)
+        elapsed = time.perf_counter() - started
+        workers[num_workers] = {
+            'seconds': elapsed,
+            'features_per_sec': len(valid) / elapsed,
+            'identical_to_single_process': bool(np.array_equal(sharded_start_logits, start_logits) and np.array_equal(sharded_end_logits, end_logits)),
+        }
+    return len(valid) * len(config.sharded_workers), 'features', [], {'workers': workers}
+
+
+# run in a fresh process, so cold start and peak memory of loading are measured alone
+_LOAD_SCRIPT = '''
+import sys, json, time
+import torch
+sys.path.append(sys.argv[1])
+from modules.modeling import load_model, load_model_artifact, predict_logits
+from modules.profiler import PeakRSS, current_rss
+rss_before = current_rss()
+# sampled here, ru_maxrss of a child starts at the high-water mark of its parent
+with PeakRSS() as rss:
+    started = time.perf_counter()
+    model = load_model(sys.argv[4], sys.argv[5]) if sys.argv[2] == 'state_dict' else load_model_artifact(sys.argv[4])
+    seconds = time.perf_counter() - started
+rss_loaded = current_rss()
+# memory mapped weights are only read from disk when a forward pass touches them
+input_ids = torch.randint(model.config.vocab_size, (1, int(sys.argv[3])))
+batch = {'input_ids': input_ids, 'token_type_ids': torch.zeros_like(input_ids), 'attention_mask': torch.ones_like(input_ids)}
+with PeakRSS() as rss_forward, torch.no_grad():
+    started = time.perf_counter()
+    predict_logits(model, batch)
+    forward_seconds = time.perf_counter() - started
+print(json.dumps({
+    'seconds': seconds,
+    'first_forward_seconds': forward_seconds,
+    'rss_before_load_mb': rss_before / 2 ** 20,
+    'peak_rss_mb': rss.peak / 2 ** 20,
+    'rss_after_load_mb': rss_loaded / 2 ** 20,
+    'peak_rss_with_forward_mb': max(rss.peak, rss_forward.peak) / 2 ** 20,
+}))
+'''
+
+
+def bench_model_load(state, config):
+    path = os.path.join(config.work_dir, 'model_load')
+    model_fn = os.path.join(path, 'model.pt')
+    artifact_dir = os.path.join(path, 'model_artifact')
+    os.makedirs(path, exist_ok=True)
+    torch.save(state['model'].state_dict(), model_fn)
+    save_model_artifact(state['model'], state['tokenizer'], artifact_dir)
+
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    loads = {
+        'state_dict': [model_fn, config.pretrained_model_name],
+        'artifact': [artifact_dir],
+    }
+    methods = {}
+    for method, args in loads.items():
+        output = subprocess.check_output(
+            [sys.executable, '-c', _LOAD_SCRIPT, repo_path, method, str(config.max_length)] + args, stderr=subprocess.DEVNULL)
+        methods[method] = json.loads(output.decode().strip().splitlines()[-1])
+    return len(loads), 'loads', [result['seconds'] for result in methods.values()], {'methods': methods}
+
+
+def _answer_windows(valid, validation):
+    # whether the context of every window holds the whole answer of its question
+    answers = {}
+    for question_id, answer_starts, texts in zip(validation['question_id'], validation['answer_start'], validation['text']):
+        if len(texts) > 0:
+            answers[question_id] = (answer_starts[0], answer_starts[0] + len(texts[0]))
+
+    contains = np.zeros(len(valid), dtype=bool)
+    for i, (offsets, example_id) in enumerate(zip(valid['offset_mapping'], valid['example_id'])):
+        context = offsets[1:][offsets[1:, 0] >= 0]
+        if example_id in answers and len(context) > 0:
+            start, end = answers[example_id]
+            contains[i] = context[0, 0] <= start and end <= context[-1, 1]
+    return contains, len(answers)
+
+
+def bench_window_filter(state, config):
+    valid = state['valid']
+    started = time.perf_counter()
+    build_window_index(valid, state['tokenizer'].all_special_ids)
+    index_seconds = time.perf_counter() - started
+
+    example_index = valid['example_index']
+    contains, n_answerable = _answer_windows(valid, state['validation'])
+    start_logits, end_logits = state['logits']
+    offsets = np.full(start_logits.shape + (2,), -1, dtype=np.int32)
+    for i, offset in enumerate(valid['offset_mapping']):
+        offsets[i, :len(offset)] = offset
+    example_ids = list(valid['example_id'])
+    scorer = SquadV2Scorer.from_examples(state['validation'])
+
+    def evaluate(keep):
+        predictions = postprocess_predictions(
+            np.where(keep[:, None], start_logits, -np.inf),
+            np.where(keep[:, None], end_logits, -np.inf),
+            offsets,
+            example_ids,
+            state['validation']['question_id'].tolist(),
+            state['validation']['context'].tolist(),
+            n_best=config.n_best,
+            max_answer_length=config.max_answer_length)
+        return scorer.score(predictions)
+
+    full = evaluate(np.ones(len(valid), dtype=bool))
+    latencies = []
+    top_k = {}
+    for k in config.top_k_windows:
+        started = time.perf_counter()
+        keep = select_windows(WindowIndex(valid.path).scores(), example_index, k)
+        latencies.append(time.perf_counter() - started)
+
+        result = evaluate(keep)
+        top_k[k] = {
+            'n_windows': int(keep.sum()),
+            'forward_saved': 1 - keep.sum() / len(valid),
+            # answerable questions that still have a window holding the answer
+            'answer_window_recall': len(set(example_index[keep & contains])) / max(n_answerable, 1),
+            'exact_change': result['exact'] - full['exact'],
+            'f1_change': result['f1'] - full['f1'],
+        }
+    extra = {'index_seconds': index_seconds, 'n_windows': len(valid), 'exact': full['exact'], 'f1': full['f1'], 'top_k_windows': top_k}
+    return len(valid) * len(config.top_k_windows), 'features', latencies, extra
+
+
+BENCHMARKS = {
+    'ingestion': bench_ingestion,
+    'tokenization': bench_tokenization,
+    'feature_loading': bench_feature_loading,
+    'train_steps': bench_train_steps,
+    'forward': bench_forward,
+    'decode': bench_decode,
+    'sharded_forward': bench_sharded_forward,
+    'model_load': bench_model_load,
+    'window_filter': bench_window_filter,
+}
+
+
+def run_stage(name, state, config):
+    with PeakRSS() as rss:
+        started = time.perf_counter()
+        n_items, unit, latencies, *extra = BENCHMARKS[name](state, config)
+        elapsed = time.perf_counter() - started
+
+    result = {
+        'seconds': elapsed,
+        'n_items': n_items,
+        'unit': unit,
+        '{}_per_sec'.format(unit): n_items / elapsed if elapsed > 0 else None,
+        'peak_rss_mb': rss.peak / 2 ** 20,
+    }
+    if len(latencies) > 0:
+        latencies = np.array(latencies) * 1000
+        result.update({
+            'n_batches': len(latencies),
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p90': float(np.percentile(latencies, 90)),
+            'latency_ms_p99': float(np.percentile(latencies, 99)),
+            'latency_ms_max': float(latencies.max()),
+        })
+    for values in extra:
+        result.update(values)
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(config):
+    if config.n_threads is not None:
+        torch.set_num_threads(config.n_threads)
+
+    # corpus and model are generated once and reused by later runs
+    data_path = os.path.join(config.work_dir, 'data')
+    if not os.path.exists(os.path.join(data_path, 'test.json')):
+        generate(argparse.Namespace(**{**vars(config), 'save_path': data_path}))
+    if config.pretrained_model_name is None:
+        config.pretrained_model_name = os.path.join(config.work_dir, 'tiny_model')
+        if not os.path.exists(os.path.join(config.pretrained_model_name, 'config.json')):
+            make_tiny_model(config.pretrained_model_name, config.vocab_size, max(512, config.max_length), config.seed)
+
+    torch.manual_seed(config.seed)
+    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+    state = {
+        'tokenizer': tokenizer,
+        'model': AutoModelForQuestionAnswering.from_pretrained(config.pretrained_model_name),
+    }
+
+    required = set(config.stages)
+    for name in reversed(STAGES):
+        if name in required:
+            required.update(DEPENDS.get(name, ()))
+
+    stages = {}
+    for name in STAGES:
+        if name not in required:
+            continue
+        stages[name] = run_stage(name, state, config)
+        if name in config.stages:
+            print('{:<16}{:>10.2f}s{:>12.1f} {}/s{:>10.1f} MB'.format(
+                name, stages[name]['seconds'], stages[name]['{}_per_sec'.format(stages[name]['unit'])], stages[name]['unit'], stages[name]['peak_rss_mb']))
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'config': vars(config),
+        },
+        'stages': {name: result for name, result in stages.items() if name in config.stages},
+    }
+
+    output_fn = config.output_fn or os.path.join(config.work_dir, 'results.json')
+    with open(output_fn, 'w') as fw:
+        json.dump(report, fw, indent=2)
+    print('results written to {}'.format(output_fn))
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    main(config)
@@ -0,0 +1,114 @@
+import os
+import json
+import random
+import argparse
+
+
+def define_argparser():
+    '''
+    Define argument parser to generate a synthetic corpus in the train.json/test.json format.
+    '''
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--save_path', required=True)
+    p.add_argument('--n_train_docs', type=int, default=200)
+    p.add_argument('--n_test_docs', type=int, default=50)
+    p.add_argument('--paragraphs_per_doc', type=int, default=5)
+    p.add_argument('--questions_per_paragraph', type=int, default=3, help="Questions per test paragraph.")
+    p.add_argument('--min_context_words', type=int, default=50)
+    p.add_argument('--max_context_words', type=int, default=400)
+    p.add_argument('--answer_rate', type=float, default=.7)
+    p.add_argument('--question_overlap',
+                    type=float,
+                    default=0.,
+                    help="Probability of every question word to be drawn from the words around the answer instead of the vocabulary.")
+    p.add_argument('--vocab_size', type=int, default=2000)
+    p.add_argument('--seed', type=int, default=42)
+
+    config = p.parse_args()
+
+    return config
+
+
+def make_vocab(vocab_size):
+    return ['w{}'.format(i) for i in range(vocab_size)]
+
+
+def _paragraph(rng, words, config, n_questions, with_answers, ids):
+    context_words = [rng.choice(words) for _ in range(rng.randint(config.min_context_words, config.max_context_words))]
+    context = ' '.join(context_words)
+
+    qas = []
+    for _ in range(n_questions):
+        qa = {
+            'question_id': 'q{:08d}'.format(next(ids)),
+            'question': ' '.join(rng.choice(words) for _ in range(rng.randint(4, 12))),
+        }
+        if with_answers:
+            qa['answers'] = []
+            if rng.random() < config.answer_rate:
+                start = rng.randrange(len(context_words))
+                end = min(len(context_words), start + rng.randint(1, 5))
+                answer_start = len(' '.join(context_words[:start])) + (1 if start > 0 else 0)
+                qa['answers'].append({'text': ' '.join(context_words[start:end]), 'answer_start': answer_start})
+                if config.question_overlap > 0:
+                    # lexical overlap with the answer window, as in real questions
+                    nearby = context_words[max(0, start - 10):end + 10]
+                    qa['question'] = ' '.join(rng.choice(nearby) if rng.random() < config.question_overlap else word for word in qa['question'].split())
+        qas.append(qa)
+    return {'context': context, 'qas': qas}
+
+
+def generate(config):
+    '''
+    Write train.json and test.json with the nested data/paragraphs/qas schema.
+    Train paragraphs have one question with zero or one answer, test paragraphs
+    have questions_per_paragraph questions without answers.
+    '''
+    os.makedirs(config.save_path, exist_ok=True)
+    rng = random.Random(config.seed)
+    words = make_vocab(config.vocab_size)
+    ids = iter(range(10 ** 8))
+
+    splits = (
+        ('train.json', config.n_train_docs, 1, True),
+        ('test.json', config.n_test_docs, config.questions_per_paragraph, False),
+    )
+    for filename, n_docs, n_questions, with_answers in splits:
+        data = []
+        for i in range(n_docs):
+            paragraphs = [_paragraph(rng, words, config, n_questions, with_answers, ids) for _ in range(config.paragraphs_per_doc)]
+            data.append({'title': 'doc{}'.format(i), 'paragraphs': paragraphs})
+        with open(os.path.join(config.save_path, filename), 'w', encoding='utf-8') as fw:
+            json.dump({'version': 'synthetic', 'data': data}, fw, ensure_ascii=False)
+
+
+def make_tiny_model(save_path, vocab_size, max_position_embeddings=512, seed=42):
+    '''
+    Save a randomly initialized two layer BERT QA model and a WordPiece tokenizer
+    covering the synthetic vocabulary, loadable with from_pretrained(save_path).
+    '''
+    import torch
+    from transformers import BertConfig, BertForQuestionAnswering, BertTokenizerFast
+
+    os.makedirs(save_path, exist_ok=True)
+    vocab_fn = os.path.join(save_path, 'vocab.txt')
+    with open(vocab_fn, 'w', encoding='utf-8') as fw:
+        fw.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + make_vocab(vocab_size)))
+    BertTokenizerFast(vocab_fn).save_pretrained(save_path)
+
+    torch.manual_seed(seed)
+    model_config = BertConfig(
+        vocab_size=vocab_size + 5,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        max_position_embeddings=max_position_embeddings)
+    BertForQuestionAnswering(model_config).save_pretrained(save_path)
+    return save_path
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    generate(config)
@@ -0,0 +1,139 @@
+import os
+import json
+import argparse
+
+import pandas as pd
+import numpy as np
+
+from modules.cascade import example_confidence, cascade_curve, calibrate_threshold
+from modules.feature_store import FeatureStore
+from modules.logit_cache import LogitCache, checkpoint_fingerprint, ensemble_fingerprint
+from modules.metrics import SquadV2Scorer
+from modules.postprocess import offsets_to_array, postprocess_predictions
+
+
+def define_argparser():
+    '''
+    Define argument parser to calibrate the cascade threshold of inference.py on cached validation logits.
+    '''
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--small_model_fn', default=None, help="Small cascade model whose validation logits were cached with --cache_logits.")
+    p.add_argument('--small_optimized_fn', default=None)
+    p.add_argument('--small_artifact_dir', default=None)
+    p.add_argument('--model_fn', nargs='+', default=None, help="Large model (or ensemble members) whose validation logits were cached with --cache_logits.")
+    p.add_argument('--optimized_fn', default=None)
+    p.add_argument('--artifact_dir', nargs='+', default=None)
+    p.add_argument('--ensemble_weights', type=float, nargs='+', default=None)
+    p.add_argument('--file_path',
+                    required=True,
+                    help="Directory where preprocessed data files located.")
+    p.add_argument('--max_exact_loss',
+                    type=float,
+                    default=1.,
+                    help="Exact match points the cascade may lose against the large model alone.")
+    p.add_argument('--n_best', type=int, default=5)
+    p.add_argument('--max_answer_length', type=int, default=40)
+    p.add_argument('--top_k_windows', type=int, default=None, help="Use the logits cached with inference.py --top_k_windows.")
+    p.add_argument('--report_fn', default=None, help="Also write the cascade curve and the chosen threshold to this json file.")
+
+    config = p.parse_args()
+    if config.small_model_fn is None and config.small_optimized_fn is None and config.small_artifact_dir is None:
+        p.error('Set --small_model_fn, --small_optimized_fn or --small_artifact_dir.')
+    if config.model_fn is None and config.optimized_fn is None and config.artifact_dir is None:
+        p.error('Set --model_fn, --optimized_fn or --artifact_dir.')
+
+    return config
+
+
+def load_cached_logits(store, checkpoint, window_filter, name):
+    cache = LogitCache(store, checkpoint, window_filter)
+    logits = cache.load()
+    if logits is None:
+        raise FileNotFoundError(
+            'No cached validation logits of the {} model. Run inference.py --split validation with --cache_logits first.'.format(name))
+    return logits
+
+
+def main(config):
+    valid = FeatureStore(os.path.join(config.file_path, 'validation_features'))
+    validation = pd.read_pickle(os.path.join(config.file_path, 'validation.pkl'))
+    window_filter = None if config.top_k_windows is None else {'top_k_windows': config.top_k_windows}
+
+    small_logits = load_cached_logits(
+        valid,
+        checkpoint_fingerprint(config.small_model_fn, config.small_optimized_fn, config.small_artifact_dir),
+        window_filter,
+        'small')
+    large_logits = load_cached_logits(
+        valid,
+        ensemble_fingerprint(config.model_fn, config.optimized_fn, config.artifact_dir, config.ensemble_weights),
+        window_filter,
+        'large')
+
+    offsets = offsets_to_array(valid['offset_mapping'], small_logits[0].shape[1])
+    feature_example_ids = list(valid['example_id'])
+    question_ids = validation['question_id'].tolist()
+    scorer = SquadV2Scorer.from_examples(validation)
+
+    scores = {}
+    for name, (start_logits, end_logits) in (('small', small_logits), ('large', large_logits)):
+        predictions = postprocess_predictions(
+            start_logits,
+            end_logits,
+            offsets,
+            feature_example_ids,
+            question_ids,
+            validation['context'].tolist(),
+            n_best=config.n_best,
+            max_answer_length=config.max_answer_length)
+        exact, f1 = scorer.score_questions(predictions)
+        scores[name] = (np.asarray(exact), np.asarray(f1))
+
+    confidence = example_confidence(
+        small_logits[0],
+        small_logits[1],
+        offsets,
+        feature_example_ids,
+        question_ids,
+        n_best=config.n_best,
+        max_answer_length=config.max_answer_length)
+
+    thresholds, escalated, exact = cascade_curve(confidence, scores['small'][0], scores['large'][0])
+    _, _, f1 = cascade_curve(confidence, scores['small'][1], scores['large'][1])
+
+    # the curve at every 10% of escalated questions
+    print('{:>12}{:>12}{:>10}{:>10}'.format('escalated', 'threshold', 'exact', 'f1'))
+    for fraction in np.linspace(0, 1, 11):
+        i = min(np.searchsorted(escalated, fraction), len(escalated) - 1)
+        print('{:>12.1%}{:>12.4f}{:>10.2f}{:>10.2f}'.format(escalated[i], thresholds[i], 100 * exact[i], 100 * f1[i]))
+
+    threshold, escalated_fraction, cascade_exact = calibrate_threshold(
+        confidence, scores['small'][0], scores['large'][0], config.max_exact_loss)
+    i = np.searchsorted(thresholds, threshold)
+    result = {
+        'threshold': threshold,
+        'escalated': escalated_fraction,
+        'exact': cascade_exact,
+        'f1': 100 * float(f1[i]),
+        'small': {'exact': 100 * scores['small'][0].mean(), 'f1': 100 * scores['small'][1].mean()},
+        'large': {'exact': 100 * scores['large'][0].mean(), 'f1': 100 * scores['large'][1].mean()},
+    }
+    print('small exact {:.2f} f1 {:.2f}, large exact {:.2f} f1 {:.2f}'.format(
+        result['small']['exact'], result['small']['f1'], result['large']['exact'], result['large']['f1']))
+    print('threshold {:.4f}: {:.1%} of questions escalated, exact {:.2f} f1 {:.2f}'.format(
+        threshold, escalated_fraction, result['exact'], result['f1']))
+
+    if config.report_fn is not None:
+        with open(config.report_fn, 'w') as fw:
+            json.dump({
+                **result,
+                'max_exact_loss': config.max_exact_loss,
+                'curve': [{'threshold': float(t), 'escalated': float(e), 'exact': 100 * float(x), 'f1': 100 * float(y)}
+                          for t, e, x, y in zip(thresholds, escalated, exact, f1)],
+            }, fw, indent=2)
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    main(config)
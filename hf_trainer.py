@@ -1,21 +1,28 @@
 import os
+import json
+import time
 import argparse
-import pickle
 
 import pandas as pd
 import numpy as np
 import torch
-import collections
 
 from transformers import AutoTokenizer
 from transformers import AutoModelForQuestionAnswering
 from transformers import TrainingArguments
 from transformers import Trainer
 
-from datasets import load_metric
-metric = load_metric("squad_v2")
-
+from modules.autotune import AUTOTUNE_FILE, DEFAULT_BATCH_SIZES, apply_threads, resolve_setting
 from modules.dataset import QADataset, QADatasetValid, QADatasetTest
+from modules.dataset import LengthGroupedSampler, NegativeSubsampledSampler, DynamicPaddingCollator
+from modules.feature_store import FeatureStore
+from modules.logit_cache import LogitCache, checkpoint_fingerprint
+from modules.metrics import compute_metrics
+from modules.postprocess import mask_padding
+from modules.modeling import load_model, save_model_artifact
+from modules.negative_sampling import negative_windows, reweighted_span_loss
+from modules.distillation import DistillationDataset, precompute_teacher_logits, teacher_fingerprint, distillation_loss
+from modules.profiler import Profiler
 
 
 def define_argparser():
@@ -34,95 +41,198 @@ def define_argparser():
                     default='monologg/kobigbird-bert-base',
                     help="Set pretrained model. (Examples: klue/bert-base, monologg/kobert, ...")
 
-    p.add_argument('--batch_size_per_device', type=int, default=16)
+    p.add_argument('--artifact_dir',
+                    default=None,
+                    help="Directory to save config, tokenizer and weights for inference.py --artifact_dir. Defaults to <--model_fn without extension>_artifact.")
+
+    p.add_argument('--batch_size_per_device',
+                    type=int,
+                    default=None,
+                    help="Defaults to the batch size found by --autotune for this model, max_length and host, or 16.")
+    p.add_argument('--autotune',
+                    action='store_true',
+                    help="Time training steps over batch sizes and intra-/inter-op thread counts on CPU, cache the fastest setting in --autotune_fn and use it. Later runs use the cached setting without this flag.")
+    p.add_argument('--autotune_fn', default=None, help="Json file of autotune settings. Defaults to autotune.json in --file_path.")
+    p.add_argument('--autotune_batch_sizes', type=int, nargs='+', default=list(DEFAULT_BATCH_SIZES))
+    p.add_argument('--max_memory_mb',
+                    type=float,
+                    default=None,
+                    help="Peak memory the autotuned setting may use. Defaults to 80%% of the physical memory.")
     p.add_argument('--n_epochs', type=int, default=2)
     p.add_argument('--warmup_ratio', type=float, default=.1)
     p.add_argument('--n_best', type=int, default=5)
     p.add_argument('--max_answer_length', type=int, default=40)
+    p.add_argument('--teacher_fn',
+                    default=None,
+                    help="Fine-tuned teacher state dict saved by an earlier run with --model_fn. Trains --pretrained_model_name as a distilled student.")
+    p.add_argument('--teacher_model_name',
+                    default=None,
+                    help="Pretrained model of the teacher checkpoint. It has to share the student's tokenizer. Defaults to --pretrained_model_name.")
+    p.add_argument('--distill_alpha', type=float, default=.5, help="Weight of the KL term, the cross-entropy gets 1 - alpha.")
+    p.add_argument('--distill_temperature', type=float, default=2.)
+    p.add_argument('--negative_ratio',
+                    type=float,
+                    default=None,
+                    help="Train every epoch on all windows holding the answer and a new random sample of this ratio of the no-answer windows, whose loss is weighted by 1 / ratio.")
+    p.add_argument('--report_fn', default=None, help="Write the training wall time, skipped features and exact/F1 to this json file.")
+    p.add_argument('--baseline_report_fn',
+                    default=None,
+                    help="--report_fn of an earlier run, e.g. on all features, to compare exact/F1 and wall time with.")
+    p.add_argument('--cache_logits',
+                    action='store_true',
+                    help="Save the validation logits of the trained model next to the features, for tune_decoding.py.")
+    p.add_argument('--profile_fn',
+                    default=None,
+                    help="Write wall time, peak memory and padding of the train and predict batches to this json file.")
+    p.add_argument('--trace_fn', default=None, help="Write a torch profiler chrome trace of the validation predictions.")
 
     config = p.parse_args()
+    if config.negative_ratio is not None and not 0 < config.negative_ratio <= 1:
+        p.error('--negative_ratio has to be in (0, 1].')
+    if config.artifact_dir is None:
+        config.artifact_dir = os.path.splitext(config.model_fn)[0] + '_artifact'
 
     return config
 
-def compute_metrics(start_logits, end_logits, features, examples):  
-    n_best = config.n_best
-    example_to_features = collections.defaultdict(list)
-    for idx, feature in enumerate(features):
-        example_to_features[feature["example_id"]].append(idx)
-    
-    # The dictionaries we have to fill.
-    predictions = collections.OrderedDict()
-
-    for i in range(len(examples)):
-        example_id = examples.loc[i]["question_id"]
-        context = examples.loc[i]["context"]
-        answers = []
-
-        for feature_index in example_to_features[example_id]:
-            start_logit = start_logits[feature_index]    
-            end_logit = end_logits[feature_index]
-            offsets = features[feature_index]["offset_mapping"]
-
-            start_indexes = np.argsort(start_logit)[-1 : -n_best - 1 : -1].tolist()   
-            end_indexes = np.argsort(end_logit)[-1 : -n_best - 1 : -1].tolist()
-            for start_index in start_indexes:      
-                for end_index in end_indexes:
-                  if offsets[start_index] is None or offsets[end_index] is None:
-                    continue
-                  if (end_index < start_index
-                        or end_index - start_index + 1 > config.max_answer_length):
-                    continue
-
-                  answer = {
-                        "text": context[offsets[start_index][0] : offsets[end_index][1]],   
-                        "logit_score": start_logit[start_index] + end_logit[end_index]}
-                  answers.append(answer)
-
-        # Select the answer with the best score
-        if len(answers) > 0:
-          best_answer = sorted(answers, key=lambda x: x["logit_score"], reverse=True)[0]
-        else:
-          best_answer = {"text": "", "score": 0.0}
-
-        answer = best_answer["text"]
-        predictions[examples.loc[i]["question_id"]] = answer  
-    
-    predicted_answers = [{"id": k, "prediction_text": v, "no_answer_probability": 0.0} for k, v in predictions.items()]
-    theoretical_answers = []
-    for i in range(len(examples)):
-      if len(examples.loc[i]["text"]) == 0:
-        theoretical_answers.append({"id": examples.loc[i]["question_id"], "answers": {'text': [""], 'answer_start': examples.loc[i]['answer_start']}})
-      else:
-        theoretical_answers.append({"id": examples.loc[i]["question_id"], "answers": {'text': examples.loc[i]["text"], 'answer_start': examples.loc[i]['answer_start']}})
-    
-    result = metric.compute(predictions=predicted_answers, references=theoretical_answers)
-
-    return {
-        "exact": result['exact'],
-        "f1": result['f1']}
+
+class LengthGroupedTrainer(Trainer):
+    '''
+    Trainer that batches training features of similar length together.
+
+    With negative_ratio, every epoch trains on all positive features and a new
+    sample of the negative ones (negatives is their mask), whose loss is
+    weighted by 1 / negative_ratio. Logs report the skipped features.
+    '''
+
+    def __init__(self, *args, negatives=None, negative_ratio=None, cls_token_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.negatives = negatives
+        self.negative_ratio = negative_ratio
+        self.cls_token_id = cls_token_id
+        self.negative_sampler = None
+
+    def _get_train_sampler(self, train_dataset=None):
+        lengths = self.train_dataset.input_ids.lengths()
+        if self.negative_ratio is None:
+            return LengthGroupedSampler(lengths, self.args.train_batch_size, shuffle=True, seed=self.args.seed)
+        self.negative_sampler = NegativeSubsampledSampler(
+            lengths, self.negatives, self.negative_ratio, self.args.train_batch_size, seed=self.args.seed)
+        return self.negative_sampler
+
+    def span_loss(self, outputs, inputs):
+        if self.negative_ratio is None:
+            return outputs.loss
+        # a feature is negative when its label is the position of the CLS token
+        negative = inputs['input_ids'].gather(1, inputs['start_positions'][:, None])[:, 0] == self.cls_token_id
+        return reweighted_span_loss(
+            outputs.start_logits, outputs.end_logits, inputs['start_positions'], inputs['end_positions'], negative, 1 / self.negative_ratio)
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        if self.negative_ratio is None:
+            return super().compute_loss(model, inputs, return_outputs, **kwargs)
+        outputs = model(**inputs)
+        loss = self.span_loss(outputs, inputs)
+        return (loss, outputs) if return_outputs else loss
+
+    def log(self, logs, *args, **kwargs):
+        if self.negative_sampler is not None:
+            logs = dict(logs, skipped_features_per_epoch=self.negative_sampler.n_skipped)
+        super().log(logs, *args, **kwargs)
+
+
+class DistillationTrainer(LengthGroupedTrainer):
+    '''
+    Trainer mixing the start/end cross-entropy with the KL divergence to the
+    precomputed teacher logits of every batch.
+    '''
+
+    def __init__(self, *args, alpha=.5, temperature=2., **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        teacher_logits = inputs.pop('teacher_logits', None)
+        outputs = model(**inputs)
+        loss = self.span_loss(outputs, inputs)
+        if teacher_logits is not None:
+            kd_loss = distillation_loss(outputs.start_logits, outputs.end_logits, teacher_logits, inputs['attention_mask'], self.temperature)
+            loss = (1 - self.alpha) * loss + self.alpha * kd_loss
+        return (loss, outputs) if return_outputs else loss
 
 
 def main(config):
+    profiler = Profiler(enabled=config.profile_fn is not None, trace_fn=config.trace_fn)
 
     # read preprocessed data files
-    with open(os.path.join(config.file_path, 'preprocessed_train.pickle'), 'rb') as fr:
-      train = pickle.load(fr)
-    with open(os.path.join(config.file_path, 'preprocessed_validation.pickle'), 'rb') as fr:
-      valid = pickle.load(fr)
-    validation = pd.read_pickle(os.path.join(config.file_path, 'validation.pkl'))
+    with profiler.stage('feature_io'):
+        train = FeatureStore(os.path.join(config.file_path, 'train_features'))
+        valid = FeatureStore(os.path.join(config.file_path, 'validation_features'))
+        validation = pd.read_pickle(os.path.join(config.file_path, 'validation.pkl'))
+    profiler.record_split('validation', len(validation), len(valid), valid.meta['n_tokens'])
 
     train_dataset = QADataset(train['input_ids'], train['token_type_ids'], train['attention_mask'], train['start_positions'], train['end_positions'])
     validation_dataset = QADatasetValid(valid['input_ids'], valid['token_type_ids'], valid['attention_mask'], valid['offset_mapping'], valid['example_id'])
     print(len(train_dataset), len(validation_dataset))
 
+    # import tokenizer, model
+    with profiler.stage('model_load'):
+        tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+        model = AutoModelForQuestionAnswering.from_pretrained(config.pretrained_model_name)
+
+    # batch size and threads of an earlier --autotune run with this model, max_length and host
+    setting = None
+    if not torch.cuda.is_available():
+        with profiler.stage('autotune'):
+            setting = resolve_setting(
+                model,
+                train,
+                config.autotune_fn or os.path.join(config.file_path, AUTOTUNE_FILE),
+                probe=config.autotune,
+                train=True,
+                batch_sizes=config.autotune_batch_sizes,
+                max_memory_mb=config.max_memory_mb,
+                pad_token_id=tokenizer.pad_token_id)
+    elif config.autotune:
+        print('--autotune only tunes CPU runs')
+    if config.batch_size_per_device is None:
+        config.batch_size_per_device = 16 if setting is None else setting['batch_size']
+    if setting is not None:
+        apply_threads(setting)
+        print('autotune: batch_size_per_device {} intra_op_threads {} inter_op_threads {}'.format(
+            config.batch_size_per_device, setting['intra_op_threads'], setting['inter_op_threads']))
+
+    # every epoch trains on all positive windows and a sample of the negative ones
+    negatives = None
+    n_epoch_features = len(train_dataset)
+    if config.negative_ratio is not None:
+        negatives = negative_windows(train['input_ids'], train['start_positions'], tokenizer.cls_token_id)
+        n_epoch_features = int((~negatives).sum()) + int(round(negatives.sum() * config.negative_ratio))
+        print('{} of {} training features are negative windows, {} of them are skipped every epoch'.format(
+            negatives.sum(), len(negatives), len(train_dataset) - n_epoch_features))
+
     total_batch_size = config.batch_size_per_device * torch.cuda.device_count() if torch.cuda.is_available() else 1
-    n_total_iterations = int(len(train_dataset) / total_batch_size * config.n_epochs)
+    n_total_iterations = int(n_epoch_features / total_batch_size * config.n_epochs)
     n_warmup_steps = int(n_total_iterations * config.warmup_ratio)
     print('#total_iters =', n_total_iterations, '#warmup_iters =', n_warmup_steps)
-    
-    # import tokenizer, model
-    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
-    model = AutoModelForQuestionAnswering.from_pretrained(config.pretrained_model_name)
+
+    # distillation: the teacher runs once over the training features, its logits are stored with them
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    if config.teacher_fn is not None:
+        teacher_model_name = config.teacher_model_name or config.pretrained_model_name
+        if AutoTokenizer.from_pretrained(teacher_model_name).get_vocab() != tokenizer.get_vocab():
+            raise ValueError('Teacher {} and student {} do not share a tokenizer.'.format(teacher_model_name, config.pretrained_model_name))
+
+        with profiler.stage('teacher_logits'):
+            teacher = load_model(config.teacher_fn, teacher_model_name, device)
+            teacher_logits = precompute_teacher_logits(
+                teacher, train, config.batch_size_per_device, tokenizer.pad_token_id, teacher_fingerprint(config.teacher_fn, teacher_model_name))
+            # the student trains on the stored logits, the teacher is loaded again for the report
+            del teacher
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        train_dataset = DistillationDataset(
+            train['input_ids'], train['token_type_ids'], train['attention_mask'], train['start_positions'], train['end_positions'], teacher_logits)
 
     # fine-tuning using huggingface trainer
     training_args = TrainingArguments(
@@ -132,26 +242,81 @@ def main(config):
         per_device_eval_batch_size=config.batch_size_per_device,
         warmup_steps=n_warmup_steps,
         weight_decay=0.01,
-        fp16=True,
+        fp16=torch.cuda.is_available(),
         evaluation_strategy='epoch',
         save_strategy='epoch',
         logging_steps=n_total_iterations // 100,
         save_steps=n_total_iterations // config.n_epochs)
 
-    trainer = Trainer(
+    trainer_class, trainer_kwargs = LengthGroupedTrainer, {}
+    if config.teacher_fn is not None:
+        trainer_class, trainer_kwargs = DistillationTrainer, {'alpha': config.distill_alpha, 'temperature': config.distill_temperature}
+    if negatives is not None:
+        trainer_kwargs.update(negatives=negatives, negative_ratio=config.negative_ratio, cls_token_id=tokenizer.cls_token_id)
+    trainer = trainer_class(
                 model=model,
                 args=training_args, 
+                data_collator=profiler.collator(DynamicPaddingCollator(tokenizer.pad_token_id)),
                 train_dataset=train_dataset,  
                 eval_dataset=validation_dataset,
-                tokenizer=tokenizer)
+                tokenizer=tokenizer,
+                **trainer_kwargs)
 
-    trainer.train()
+    with profiler.stage('train'):
+        started = time.perf_counter()
+        trainer.train()
+        train_seconds = time.perf_counter() - started
 
     torch.save(model.state_dict(), config.model_fn)
-
-    predictions, _, _ = trainer.predict(validation_dataset)
-    start_logits, end_logits = predictions
-    print(compute_metrics(start_logits, end_logits, validation_dataset, validation))
+    save_model_artifact(model, tokenizer, config.artifact_dir)
+
+    with profiler.stage('forward'), profiler.trace():
+        started = time.perf_counter()
+        predictions, _, _ = trainer.predict(validation_dataset)
+        seconds = time.perf_counter() - started
+    # the trainer pads with model outputs and -100, masked as predict_logits does
+    start_logits, end_logits = [mask_padding(logits, valid['input_ids'].lengths()) for logits in predictions]
+    if config.cache_logits:
+        LogitCache(valid, checkpoint_fingerprint(config.model_fn)).save(start_logits, end_logits)
+    result = compute_metrics(start_logits, end_logits, validation_dataset, validation, config.n_best, config.max_answer_length, profiler)
+
+    train_report = {
+        'negative_ratio': config.negative_ratio,
+        'features_per_epoch': n_epoch_features,
+        'skipped_features_per_epoch': len(train_dataset) - n_epoch_features,
+        'train_seconds': train_seconds,
+        **result,
+    }
+    if config.baseline_report_fn is not None:
+        # e.g. subsampled negatives against training on all features
+        with open(config.baseline_report_fn) as fr:
+            baseline = json.load(fr)
+        train_report['exact_change'] = result['exact'] - baseline['exact']
+        train_report['f1_change'] = result['f1'] - baseline['f1']
+        train_report['train_speedup'] = baseline['train_seconds'] / train_seconds
+    if config.report_fn is not None:
+        with open(config.report_fn, 'w') as fw:
+            json.dump(train_report, fw, indent=2)
+
+    if config.teacher_fn is None:
+        print(json.dumps(train_report, indent=2))
+    else:
+        # the teacher is evaluated with the same arguments and batches as the student
+        teacher = load_model(config.teacher_fn, teacher_model_name, device)
+        teacher_trainer = Trainer(model=teacher, args=training_args, data_collator=DynamicPaddingCollator(tokenizer.pad_token_id))
+        started = time.perf_counter()
+        teacher_predictions, _, _ = teacher_trainer.predict(validation_dataset)
+        teacher_seconds = time.perf_counter() - started
+        teacher_logits = [mask_padding(logits, valid['input_ids'].lengths()) for logits in teacher_predictions]
+        teacher_result = compute_metrics(*teacher_logits, validation_dataset, validation, config.n_best, config.max_answer_length)
+
+        report = {
+            'teacher': {'features_per_sec': len(validation_dataset) / teacher_seconds, **teacher_result},
+            'student': {'features_per_sec': len(validation_dataset) / seconds, **result},
+        }
+        report['speedup'] = report['student']['features_per_sec'] / report['teacher']['features_per_sec']
+        print(json.dumps(report, indent=2))
+    profiler.save(config.profile_fn)
 
 
 if __name__ == "__main__":
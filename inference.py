@@ -1,20 +1,26 @@
 import os
+import json
 import argparse
-import pickle
+import functools
 from tqdm import tqdm
 
 import pandas as pd
 import numpy as np
-import collections
 
 from transformers import AutoTokenizer
-from transformers import AutoModelForQuestionAnswering
 import torch
-from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
-from transformers import default_data_collator
 
-from modules.dataset import QADataset, QADatasetValid, QADatasetTest
+from modules.autotune import AUTOTUNE_FILE, DEFAULT_BATCH_SIZES, apply_threads, resolve_setting
+from modules.cascade import example_confidence
+from modules.dataset import QADatasetValid, QADatasetTest
+from modules.dataset import LengthGroupedSampler, batch_dataloader
+from modules.feature_store import FeatureStore
+from modules.logit_cache import LogitCache, ensemble_fingerprint
+from modules.modeling import load_model, load_model_artifact, load_optimized_model, predict_logits, WeightedEnsemble
+from modules.postprocess import offsets_to_array, postprocess_predictions, StreamingDecoder
+from modules.profiler import Profiler
+from modules.sharded_inference import predict_sharded
+from modules.window_filter import WindowIndex, select_windows
 
 
 def define_argparser():
@@ -23,102 +29,411 @@ def define_argparser():
     '''
     p = argparse.ArgumentParser()
 
-    p.add_argument('--model_fn', required=True)
+    p.add_argument('--model_fn',
+                    nargs='+',
+                    default=None,
+                    help="Fine-tuned weights. Several checkpoints sharing a tokenizer are run as a weighted ensemble.")
+    p.add_argument('--artifact_dir',
+                    nargs='+',
+                    default=None,
+                    help="Model artifacts written by hf_trainer.py, used instead of --model_fn and --pretrained_model_name. Loads without the hub.")
+    p.add_argument('--optimized_fn',
+                    default=None,
+                    help="Quantized and/or traced model exported by optimize.py, used instead of --model_fn.")
     p.add_argument('--file_path', required=True)
-    p.add_argument('--pretrained_model_name', required=True)
-    p.add_argument('--batch_size', type=int, default=16)
+    p.add_argument('--pretrained_model_name',
+                    nargs='+',
+                    default=None,
+                    help="Pretrained model of every --model_fn, or a single one shared by all of them.")
+    p.add_argument('--ensemble_weights',
+                    type=float,
+                    nargs='+',
+                    default=None,
+                    help="Weight of every checkpoint in the ensemble, normalized to sum to 1. Defaults to equal weights.")
+    p.add_argument('--batch_size',
+                    type=int,
+                    default=None,
+                    help="Defaults to the batch size found by --autotune for this model, max_length and host, or 16.")
+    p.add_argument('--autotune',
+                    action='store_true',
+                    help="Time batch sizes and intra-/inter-op thread counts on the features on CPU, cache the fastest setting in --autotune_fn and use it. Later runs use the cached setting without this flag.")
+    p.add_argument('--autotune_fn', default=None, help="Json file of autotune settings. Defaults to autotune.json in --file_path.")
+    p.add_argument('--autotune_batch_sizes', type=int, nargs='+', default=list(DEFAULT_BATCH_SIZES))
+    p.add_argument('--max_memory_mb',
+                    type=float,
+                    default=None,
+                    help="Peak memory the autotuned setting may use. Defaults to 80%% of the physical memory.")
     p.add_argument('--n_best', type=int, default=5)
     p.add_argument('--max_answer_length', type=int, default=40)
+    p.add_argument('--output_fn',
+                    default=None,
+                    help="Stream predictions to this json lines file, decoding each example as soon as all of its features are predicted.")
+    p.add_argument('--num_workers',
+                    type=int,
+                    default=1,
+                    help="Split the features into contiguous shards predicted by this many CPU processes.")
+    p.add_argument('--threads_per_worker',
+                    type=int,
+                    default=None,
+                    help="Intra-op threads of every worker. Defaults to the number of cores divided by --num_workers.")
+    p.add_argument('--split',
+                    choices=['test', 'validation'],
+                    default='test',
+                    help="Predict the test features or the validation features of the preprocessed data.")
+    p.add_argument('--cache_logits',
+                    action='store_true',
+                    help="Save the logits next to the features, keyed by checkpoint and features. Later runs with the same checkpoint skip the model, see tune_decoding.py.")
+    p.add_argument('--top_k_windows',
+                    type=int,
+                    default=None,
+                    help="Only predict the k overflow windows of every question with the highest BM25 score. Needs preprocess.py --window_index.")
+    p.add_argument('--small_model_fn',
+                    default=None,
+                    help="Fine-tuned weights of a fast model for a cascade. Every question is answered by it first and only questions it is unsure about are run through the model of --model_fn.")
+    p.add_argument('--small_artifact_dir', default=None, help="Model artifact of the small cascade model, used instead of --small_model_fn.")
+    p.add_argument('--small_optimized_fn', default=None, help="Optimized model of the small cascade model, used instead of --small_model_fn.")
+    p.add_argument('--small_pretrained_model_name', default=None)
+    p.add_argument('--cascade_threshold',
+                    type=float,
+                    default=None,
+                    help="Escalate questions whose margin between the best span and the no-answer score of the small model is below this value, see calibrate_cascade.py.")
+    p.add_argument('--profile_fn',
+                    default=None,
+                    help="Write wall time, peak memory and padding of the forward batches to this json file.")
+    p.add_argument('--trace_fn', default=None, help="Write a torch profiler chrome trace of the forward passes.")
 
     config = p.parse_args()
+    if config.model_fn is None and config.optimized_fn is None and config.artifact_dir is None:
+        p.error('Set --model_fn, --optimized_fn or --artifact_dir.')
+    if config.artifact_dir is None and config.pretrained_model_name is None:
+        p.error('Set --pretrained_model_name or --artifact_dir.')
+    if config.model_fn is not None and config.pretrained_model_name is not None and len(config.pretrained_model_name) not in (1, len(config.model_fn)):
+        p.error('Set one --pretrained_model_name or one for every --model_fn.')
+    n_checkpoints = len(config.artifact_dir or config.model_fn or [config.optimized_fn])
+    if config.ensemble_weights is not None and len(config.ensemble_weights) != n_checkpoints:
+        p.error('Set one --ensemble_weights value for every checkpoint.')
+    if (config.small_model_fn or config.small_artifact_dir or config.small_optimized_fn) is not None:
+        if config.cascade_threshold is None:
+            p.error('Set --cascade_threshold for the cascade, see calibrate_cascade.py.')
+        if config.small_artifact_dir is None and config.small_pretrained_model_name is None:
+            p.error('Set --small_pretrained_model_name or --small_artifact_dir.')
+        if config.cache_logits:
+            p.error('--cache_logits caches the logits of a single model, cache the small and the large model in separate runs.')
+    elif config.cascade_threshold is not None:
+        p.error('Set --small_model_fn, --small_optimized_fn or --small_artifact_dir for the cascade.')
 
     return config
 
 
-def main(config):
-    with open(os.path.join(config.file_path, 'preprocessed_test.pickle'), 'rb') as fr:
-      preprocessed_test = pickle.load(fr)
-    test = pd.read_pickle(os.path.join(config.file_path, 'test.pkl'))
+def load_tokenizer(config):
+    '''
+    Tokenizer of the checkpoints, which all have to share it.
+    '''
+    names = config.artifact_dir or config.pretrained_model_name
+    tokenizer = AutoTokenizer.from_pretrained(names[0])
+    for name in names[1:]:
+        if AutoTokenizer.from_pretrained(name).get_vocab() != tokenizer.get_vocab():
+            raise ValueError('Ensemble members {} and {} do not share a tokenizer.'.format(names[0], name))
+    return tokenizer
 
-    test_dataset = QADatasetValid(preprocessed_test['input_ids'], preprocessed_test['token_type_ids'], preprocessed_test['attention_mask'], preprocessed_test['offset_mapping'], preprocessed_test['example_id'])
-    test_set = QADatasetTest(preprocessed_test['input_ids'], preprocessed_test['token_type_ids'], preprocessed_test['attention_mask'])
 
-    saved_data = torch.load(
-        config.model_fn,
-        map_location='cuda:0' if torch.cuda.is_available() else 'cpu'
-    )
+def load_checkpoints(config, device):
+    '''
+    Eager model of --artifact_dir or --model_fn, or the weighted ensemble of several of them.
+    '''
+    if config.artifact_dir is not None:
+        models = [load_model_artifact(artifact_dir, device) for artifact_dir in config.artifact_dir]
+    else:
+        names = config.pretrained_model_name * len(config.model_fn) if len(config.pretrained_model_name) == 1 else config.pretrained_model_name
+        models = [load_model(model_fn, name, device) for model_fn, name in zip(config.model_fn, names)]
+    if len(models) == 1:
+        return models[0]
+    return WeightedEnsemble(models, config.ensemble_weights).eval()
 
-    with torch.no_grad():
-        # Declare model and load pre-trained weights.
-        tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
-        model = AutoModelForQuestionAnswering.from_pretrained(config.pretrained_model_name)
-        model.load_state_dict(saved_data) 
 
-        if torch.cuda.is_available():
-            model.cuda()
-        device = next(model.parameters()).device
+def small_model_config(config):
+    '''
+    Copy of config with the checkpoint arguments of the small cascade model, or
+    None without a cascade.
+    '''
+    if (config.small_model_fn or config.small_artifact_dir or config.small_optimized_fn) is None:
+        return None
+    as_list = lambda value: None if value is None else [value]
+    return argparse.Namespace(**{
+        **vars(config),
+        'model_fn': as_list(config.small_model_fn),
+        'artifact_dir': as_list(config.small_artifact_dir),
+        'optimized_fn': config.small_optimized_fn,
+        'pretrained_model_name': as_list(config.small_pretrained_model_name),
+        'ensemble_weights': None,
+    })
+
+
+def load_inference_model(config):
+    '''
+    Model of the checkpoint arguments of config and the device of its batches.
+    With several workers an optimized model is a loader called by every worker.
+    '''
+    if config.num_workers > 1:
+        # workers run on CPU and share the eager model, an optimized model is loaded by every worker
+        if config.optimized_fn is not None:
+            return functools.partial(load_optimized_model, config.optimized_fn), torch.device('cpu')
+        return load_checkpoints(config, 'cpu'), torch.device('cpu')
+    if config.optimized_fn is not None:
+        # int8 / TorchScript models run on CPU
+        return load_optimized_model(config.optimized_fn), torch.device('cpu')
+    # ensemble members run one after another on every batch, which is loaded once
+    model = load_checkpoints(config, 'cuda:0' if torch.cuda.is_available() else 'cpu')
+    return model, next(model.parameters()).device
 
-        test_dataloader = DataLoader(test_set, collate_fn=default_data_collator, batch_size=config.batch_size, shuffle=False)
 
-        # Don't forget turn-on evaluation mode.
+def apply_autotune(config, model, device, store, pad_token_id, profiler):
+    '''
+    Copy of config with the batch size of the autotune setting of model, whose
+    thread counts are applied as well. The setting is probed with --autotune or
+    cached by an earlier run, a --batch_size given on the command line is kept.
+    '''
+    setting = None
+    if device.type == 'cpu':
+        # quantized and traced models can not be pickled, the probe processes load them
+        loader = functools.partial(load_optimized_model, config.optimized_fn) if config.optimized_fn is not None else None
+        with profiler.stage('autotune'):
+            setting = resolve_setting(
+                model if isinstance(model, torch.nn.Module) else model(),
+                store,
+                config.autotune_fn or os.path.join(config.file_path, AUTOTUNE_FILE),
+                probe=config.autotune,
+                loader=loader,
+                batch_sizes=config.autotune_batch_sizes,
+                max_memory_mb=config.max_memory_mb,
+                pad_token_id=pad_token_id)
+    elif config.autotune:
+        print('--autotune only tunes CPU runs')
+
+    config = argparse.Namespace(**vars(config))
+    if config.batch_size is None:
+        config.batch_size = 16 if setting is None else setting['batch_size']
+    if setting is not None:
+        # workers set their own threads, see --threads_per_worker
+        if config.num_workers == 1:
+            apply_threads(setting)
+        print('autotune: batch_size {} intra_op_threads {} inter_op_threads {}'.format(
+            config.batch_size, setting['intra_op_threads'], setting['inter_op_threads']))
+    return config
+
+
+def predict_features(model, device, store, feature_order, config, pad_token_id, profiler, cache=None, decoder=None):
+    '''
+    Run the features of feature_order in batches of config.batch_size. Logits
+    are handed to the cache and the streaming decoder as they are produced.
+    Without a decoder they are returned as (n_features, longest feature)
+    arrays in feature order, -inf for features that are not predicted.
+    '''
+    lengths = store['input_ids'].lengths()
+    if isinstance(model, torch.nn.Module):
         model.eval()
 
-        # Predictions
-        start_logits = []
-        end_logits = []
+    if config.num_workers > 1:
+        start_logits, end_logits = predict_sharded(
+            model,
+            store.path,
+            feature_order,
+            config.batch_size,
+            pad_token_id,
+            config.num_workers,
+            config.threads_per_worker)
+        if cache is not None:
+            cache.put(range(len(lengths)), start_logits, end_logits)
+
+        # the workers ran the same batches as the single process loop
+        for begin in range(0, len(feature_order), config.batch_size):
+            feature_indexes = feature_order[begin:begin + config.batch_size]
+            width = lengths[feature_indexes].max()
+            profiler.record_batch(np.arange(width)[None, :] < lengths[feature_indexes][:, None])
+            if decoder is not None:
+                decoder.put(feature_indexes, start_logits[feature_indexes, :width], end_logits[feature_indexes, :width])
+        return (start_logits, end_logits) if decoder is None else None
+
+    # whole padded batches are gathered from the feature store and moved to the device once
+    test_set = QADatasetTest(store['input_ids'], store['token_type_ids'], store['attention_mask'], pad_token_id)
+    test_dataloader = batch_dataloader(test_set, feature_order, config.batch_size, pin_memory=device.type == 'cuda')
+
+    # Streaming mode decodes on a worker thread while the next batch runs,
+    # otherwise logits are collected in the original feature order
+    if decoder is None:
+        start_logits = np.full((len(test_set), lengths.max(initial=0)), -np.inf, dtype=np.float32)
+        end_logits = np.full((len(test_set), lengths.max(initial=0)), -np.inf, dtype=np.float32)
+
+    n_features = 0
+    with torch.no_grad():
         for batch in tqdm(test_dataloader):
-            x = torch.tensor(batch['input_ids']).to(device)
-            token_type_ids = torch.tensor(batch['token_type_ids']).to(device)
-            attention_mask = torch.tensor(batch['attention_mask']).to(device)
-            outputs = model(x,  token_type_ids=token_type_ids, attention_mask=attention_mask)
-            start_logits.append(outputs.start_logits.cpu().numpy())
-            end_logits.append(outputs.end_logits.cpu().numpy())
-            
-        start_logits = np.concatenate(start_logits)
-        end_logits = np.concatenate(end_logits)
-        start_logits = start_logits[: len(test_dataset)]
-        end_logits = end_logits[: len(test_dataset)]
-    
+            profiler.record_batch(batch['attention_mask'])
+            batch = {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+            start_logit, end_logit = predict_logits(model, batch)
+            start_logit = start_logit.cpu().numpy()
+            end_logit = end_logit.cpu().numpy()
+
+            feature_indexes = feature_order[n_features:n_features + len(start_logit)]
+            if cache is not None:
+                cache.put(feature_indexes, start_logit, end_logit)
+            if decoder is not None:
+                decoder.put(feature_indexes, start_logit, end_logit)
+            else:
+                start_logits[feature_indexes, :start_logit.shape[1]] = start_logit
+                end_logits[feature_indexes, :end_logit.shape[1]] = end_logit
+            n_features += len(start_logit)
+    return (start_logits, end_logits) if decoder is None else None
+
+
+def main(config):
+    profiler = Profiler(enabled=config.profile_fn is not None, trace_fn=config.trace_fn)
+
+    with profiler.stage('feature_io'):
+        preprocessed_test = FeatureStore(os.path.join(config.file_path, config.split + '_features'))
+        test = pd.read_pickle(os.path.join(config.file_path, config.split + '.pkl'))
+    profiler.record_split(config.split, len(test), len(preprocessed_test), preprocessed_test.meta['n_tokens'])
+
+    test_dataset = QADatasetValid(preprocessed_test['input_ids'], preprocessed_test['token_type_ids'], preprocessed_test['attention_mask'], preprocessed_test['offset_mapping'], preprocessed_test['example_id'])
+
+    # windows unlikely to contain the answer are not sent to the model
+    keep = None
+    window_filter = None
+    if config.top_k_windows is not None:
+        if not WindowIndex.exists(preprocessed_test):
+            raise FileNotFoundError('No window index of the current features in {}, run preprocess.py with --window_index.'.format(preprocessed_test.path))
+        with profiler.stage('window_filter'):
+            scores = WindowIndex(preprocessed_test.path).scores()
+            keep = select_windows(scores, preprocessed_test['example_index'], config.top_k_windows)
+        window_filter = {'top_k_windows': config.top_k_windows}
+        print('{} of {} windows kept'.format(keep.sum(), len(keep)))
+
+    # logits of an earlier run of the same checkpoint on the same features skip the model
+    cache = None
+    cached_logits = None
+    if config.cache_logits:
+        cache = LogitCache(
+            preprocessed_test,
+            ensemble_fingerprint(config.model_fn, config.optimized_fn, config.artifact_dir, config.ensemble_weights),
+            window_filter)
+        with profiler.stage('cache_io'):
+            cached_logits = cache.load()
+
+    small_config = small_model_config(config)
+    decoder = None
+    if cached_logits is not None:
+        print('reusing logits of {}'.format(cache.logits_fn))
+        start_logits, end_logits = cached_logits
+    else:
+        with torch.no_grad():
+            with profiler.stage('model_load'):
+                tokenizer = load_tokenizer(config)
+                if small_config is not None and load_tokenizer(small_config).get_vocab() != tokenizer.get_vocab():
+                    raise ValueError('The small and the large cascade model do not share a tokenizer.')
+
+            # Sort features by length within local groups so batches need little padding
+            lengths = preprocessed_test['input_ids'].lengths()
+            ordered_features = lambda batch_size: [i for i in LengthGroupedSampler(lengths, batch_size, shuffle=False) if keep is None or keep[i]]
+
+            if small_config is not None:
+                # every question is answered by the small model, the large one only sees the unsure ones
+                with profiler.stage('model_load'):
+                    small_model, small_device = load_inference_model(small_config)
+                small_config = apply_autotune(small_config, small_model, small_device, preprocessed_test, tokenizer.pad_token_id, profiler)
+                feature_order = ordered_features(small_config.batch_size)
+                with profiler.stage('small_forward'):
+                    start_logits, end_logits = predict_features(
+                        small_model, small_device, preprocessed_test, feature_order, small_config, tokenizer.pad_token_id, profiler)
+                del small_model
+
+                with profiler.stage('cascade'):
+                    confidence = example_confidence(
+                        start_logits,
+                        end_logits,
+                        offsets_to_array(preprocessed_test['offset_mapping'], start_logits.shape[1]),
+                        preprocessed_test['example_id'],
+                        test['question_id'].tolist(),
+                        n_best=config.n_best,
+                        max_answer_length=config.max_answer_length)
+                    escalated = set(test['question_id'].to_numpy()[confidence < config.cascade_threshold])
+                    example_ids = preprocessed_test['example_id']
+                    feature_order = [i for i in feature_order if example_ids[i] in escalated]
+                print('{} of {} questions ({:.1%}) escalated to the large model'.format(
+                    len(escalated), len(test), len(escalated) / max(len(test), 1)))
+
+            else:
+                # Declare model and load pre-trained weights.
+                with profiler.stage('model_load'):
+                    model, device = load_inference_model(config)
+                config = apply_autotune(config, model, device, preprocessed_test, tokenizer.pad_token_id, profiler)
+                feature_order = ordered_features(config.batch_size)
+
+            if small_config is None and config.output_fn is not None:
+                # examples are decoded as soon as all of their windows are predicted
+                decoder = StreamingDecoder(
+                    preprocessed_test['offset_mapping'],
+                    preprocessed_test['example_id'],
+                    test['question_id'].tolist(),
+                    test['context'].tolist(),
+                    config.output_fn,
+                    n_best=config.n_best,
+                    max_answer_length=config.max_answer_length,
+                    feature_indexes=feature_order)
+
+            if small_config is not None and len(feature_order) > 0:
+                with profiler.stage('model_load'):
+                    model, device = load_inference_model(config)
+                config = apply_autotune(config, model, device, preprocessed_test, tokenizer.pad_token_id, profiler)
+
+            if small_config is None or len(feature_order) > 0:
+                # Predictions
+                with profiler.stage('forward'), profiler.trace():
+                    logits = predict_features(
+                        model, device, preprocessed_test, feature_order, config, tokenizer.pad_token_id, profiler, cache, decoder)
+
+                if small_config is not None:
+                    # answers of escalated questions are replaced by the large model's
+                    start_logits[feature_order] = logits[0][feature_order]
+                    end_logits[feature_order] = logits[1][feature_order]
+                elif decoder is None:
+                    start_logits, end_logits = logits
+
+        if cache is not None:
+            with profiler.stage('cache_io'):
+                cache.close()
+
+    if decoder is not None:
+        # examples are decoded during the forward passes, this waits for the rest
+        with profiler.stage('decode'):
+            n_written = decoder.close()
+        print('{} predictions written to {}'.format(n_written, config.output_fn))
+        profiler.save(config.profile_fn)
+        return
+
     # create answers
-    n_best = config.n_best
-
-    example_to_features = collections.defaultdict(list)
-    for idx, feature in enumerate(test_dataset):
-        example_to_features[feature["example_id"]].append(idx)  
-
-    predicted_answers = []
-    for i in range(len(test)):
-        example_id = test.loc[i]["question_id"]
-        context = test.loc[i]["context"]
-        answers = []
-    
-        for feature_index in example_to_features[example_id]:
-            start_logit = start_logits[feature_index]   
-            end_logit = end_logits[feature_index]
-            offsets = test_dataset[feature_index]["offset_mapping"]
-
-            start_indexes = np.argsort(start_logit)[-1 : -n_best - 1 : -1].tolist()   
-            end_indexes = np.argsort(end_logit)[-1 : -n_best - 1 : -1].tolist()
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    if offsets[start_index] is None or offsets[end_index] is None:
-                        continue
-                    if (end_index < start_index
-                        or end_index - start_index + 1 > config.max_answer_length):
-                        continue
-
-                    answer = {"text": context[offsets[start_index][0] : offsets[end_index][1]],   
-                            "logit_score": start_logit[start_index] + end_logit[end_index]}
-                    answers.append(answer)
-
-        if len(answers) > 0:
-            best_answer = max(answers, key=lambda x: x["logit_score"])
-            predicted_answers.append({"id": example_id, "prediction_text": best_answer["text"]})
-        else:
-            predicted_answers.append({"id": example_id, "prediction_text": ""}) 
-           
-    for i in range(len(predicted_answers)):
-        print(predicted_answers[i])
+    with profiler.stage('decode'):
+        offsets = offsets_to_array(preprocessed_test['offset_mapping'], start_logits.shape[1])
+        predictions = postprocess_predictions(
+            start_logits,
+            end_logits,
+            offsets,
+            preprocessed_test['example_id'],
+            test['question_id'].tolist(),
+            test['context'].tolist(),
+            n_best=config.n_best,
+            max_answer_length=config.max_answer_length)
+
+    predicted_answers = [{"id": k, "prediction_text": v} for k, v in predictions.items()]
+
+    if config.output_fn is not None:
+        # same json lines as the streaming decoder writes
+        with open(config.output_fn, 'w', encoding='utf-8') as fw:
+            for predicted_answer in predicted_answers:
+                fw.write(json.dumps(predicted_answer, ensure_ascii=False) + '\n')
+        print('{} predictions written to {}'.format(len(predicted_answers), config.output_fn))
+    else:
+        for i in range(len(predicted_answers)):
+            print(predicted_answers[i])
+    profiler.save(config.profile_fn)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+import os
+import copy
+import json
+import time
+import socket
+import hashlib
+import platform
+import concurrent.futures
+
+import torch
+import torch.multiprocessing as mp
+
+from modules.dataset import QADataset, QADatasetTest, LengthGroupedSampler, batch_dataloader
+from modules.feature_store import FeatureStore
+from modules.modeling import predict_logits
+from modules.profiler import PeakRSS
+
+
+AUTOTUNE_FILE = 'autotune.json'
+DEFAULT_BATCH_SIZES = (4, 8, 16, 32, 64)
+
+
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def total_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 20
+
+
+def host_fingerprint():
+    return {
+        'hostname': socket.gethostname(),
+        'machine': platform.machine(),
+        'n_cores': available_cores(),
+        'memory_mb': round(total_memory_mb()),
+        'torch': torch.__version__,
+    }
+
+
+def graph_signature(graph):
+    '''
+    Operators of a TorchScript graph in order, with the shape and dtype of its
+    tensor constants but not their values.
+    '''
+    signature = []
+    for node in graph.nodes():
+        entry = [node.kind()] + [str(output.type()) for output in node.outputs()]
+        if node.kind() == 'prim::Constant' and node.output().type().kind() == 'TensorType':
+            value = node.output().toIValue()
+            entry += [list(value.shape), str(value.dtype)]
+        signature.append(entry)
+        for block in node.blocks():
+            signature.append(graph_signature(block))
+    return signature
+
+
+def model_fingerprint(model):
+    '''
+    Architecture of model: its class, the number and dtypes of its parameters,
+    the types of its modules and the size of its config. A traced model holds
+    its weights as constants of its graph, so the graph is hashed instead.
+    Fine-tuned weights of one pretrained model share it, a quantized or traced
+    model has its own.
+    '''
+    parameters = list(model.parameters())
+    fingerprint = {
+        'class': type(model).__name__,
+        'n_parameters': sum(parameter.numel() for parameter in parameters),
+        'dtypes': sorted({str(parameter.dtype) for parameter in parameters}),
+    }
+    if isinstance(model, torch.jit.ScriptModule):
+        signature = json.dumps(graph_signature(model.inlined_graph))
+        fingerprint['graph'] = hashlib.sha1(signature.encode()).hexdigest()
+    else:
+        fingerprint['modules'] = sorted({type(module).__name__ for module in model.modules()})
+    config = getattr(model, 'config', None)
+    if config is not None:
+        keys = ('model_type', 'hidden_size', 'num_hidden_layers', 'num_attention_heads', 'intermediate_size')
+        fingerprint['config'] = {key: getattr(config, key, None) for key in keys}
+    return fingerprint
+
+
+def autotune_fingerprint(model, max_length, train=False):
+    return {
+        'model': model_fingerprint(model),
+        'max_length': int(max_length),
+        'host': host_fingerprint(),
+        'mode': 'train' if train else 'inference',
+    }
+
+
+def default_thread_settings(n_cores=None):
+    '''
+    (intra-op, inter-op) thread counts to probe: powers of two up to the number
+    of cores and the number of cores itself, with one or two inter-op threads.
+    '''
+    n_cores = n_cores or available_cores()
+    intra = sorted({2 ** i for i in range(n_cores.bit_length()) if 2 ** i <= n_cores} | {n_cores})
+    inter = sorted({1, min(2, n_cores)})
+    return [(intra_op, inter_op) for intra_op in intra for inter_op in inter]
+
+
+def _set_threads(intra_op_threads, inter_op_threads):
+    torch.set_num_threads(intra_op_threads)
+    torch.set_num_interop_threads(inter_op_threads)
+
+
+def _probe(model, store_path, batch_sizes, n_batches, max_memory_mb, train, pad_token_id):
+    if not isinstance(model, torch.nn.Module):
+        # loader of a quantized or traced model, which can not be shared
+        model = model()
+    store = FeatureStore(store_path)
+    lengths = store['input_ids'].lengths()
+    if train:
+        # the shared weights are left as they are
+        model = copy.deepcopy(model).train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+        dataset = QADataset(store['input_ids'], store['token_type_ids'], store['attention_mask'], store['start_positions'], store['end_positions'], pad_token_id)
+    else:
+        dataset = QADatasetTest(store['input_ids'], store['token_type_ids'], store['attention_mask'], pad_token_id)
+
+    def run(batch):
+        if train:
+            model(**batch).loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        else:
+            with torch.no_grad():
+                predict_logits(model, batch)
+
+    results = []
+    for batch_size in sorted(batch_sizes):
+        # batches of similar length, drawn the way the training and inference loops draw them
+        feature_order = list(LengthGroupedSampler(lengths, batch_size, shuffle=True, seed=0))[:batch_size * (n_batches + 1)]
+        batches = list(batch_dataloader(dataset, feature_order, batch_size))
+        if len(batches) < 2:
+            break
+
+        with PeakRSS() as rss:
+            # the first batch warms up the allocator and is not timed
+            run(batches[0])
+            started = time.perf_counter()
+            for batch in batches[1:]:
+                run(batch)
+            seconds = time.perf_counter() - started
+
+        n_samples = sum(len(batch['input_ids']) for batch in batches[1:])
+        results.append({'batch_size': batch_size, 'samples_per_sec': n_samples / seconds, 'peak_rss_mb': rss.peak / 2 ** 20})
+        if max_memory_mb is not None and rss.peak / 2 ** 20 > max_memory_mb:
+            # larger batches need even more memory
+            break
+    return results
+
+
+def autotune(model, store_path, batch_sizes=DEFAULT_BATCH_SIZES, thread_settings=None, max_memory_mb=None,
+             train=False, n_batches=3, pad_token_id=0):
+    '''
+    Time n_batches batches of the features at store_path for every batch size
+    and (intra-op, inter-op) thread setting, running the model forward or, with
+    train=True, forward, backward and an optimizer step. Every thread setting
+    runs in a new process, since inter-op threads can only be set before the
+    first parallel work of a process. model is an eager model, shared without
+    copying, or a picklable function loading it.
+
+    Returns the fastest setting whose peak memory stays below max_memory_mb
+    (default 80% of the physical memory) and the results of all probes.
+    '''
+    thread_settings = thread_settings or default_thread_settings()
+    max_memory_mb = max_memory_mb or .8 * total_memory_mb()
+    if isinstance(model, torch.nn.Module):
+        model = model.cpu().share_memory()
+
+    results = []
+    for intra_op_threads, inter_op_threads in thread_settings:
+        with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=mp.get_context('spawn'), initializer=_set_threads, initargs=(intra_op_threads, inter_op_threads)) as executor:
+            probes = executor.submit(_probe, model, store_path, batch_sizes, n_batches, max_memory_mb, train, pad_token_id).result()
+        for probe in probes:
+            results.append({'intra_op_threads': intra_op_threads, 'inter_op_threads': inter_op_threads, **probe})
+            print('intra_op_threads {intra_op_threads} inter_op_threads {inter_op_threads} batch_size {batch_size}: '
+                  '{samples_per_sec:.1f} samples/sec, peak {peak_rss_mb:.0f} MB'.format(**results[-1]))
+
+    fitting = [result for result in results if result['peak_rss_mb'] <= max_memory_mb]
+    if len(fitting) == 0:
+        raise ValueError('No batch size runs within {:.0f} MB.'.format(max_memory_mb))
+    best = max(fitting, key=lambda result: result['samples_per_sec'])
+    return dict(best, max_memory_mb=max_memory_mb), results
+
+
+def _key(fingerprint):
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_autotune(path, fingerprint):
+    '''
+    Setting cached in the json file at path for this fingerprint, or None.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as fr:
+        entry = json.load(fr).get(_key(fingerprint))
+    return None if entry is None else entry['setting']
+
+
+def save_autotune(path, fingerprint, setting, results):
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as fr:
+            entries = json.load(fr)
+    entries[_key(fingerprint)] = {'fingerprint': fingerprint, 'setting': setting, 'results': results}
+    with open(path, 'w') as fw:
+        json.dump(entries, fw, indent=2)
+
+
+def apply_threads(setting):
+    torch.set_num_threads(setting['intra_op_threads'])
+    try:
+        torch.set_num_interop_threads(setting['inter_op_threads'])
+    except RuntimeError:
+        # already fixed by earlier parallel work of this process
+        print('inter-op threads stay at {}'.format(torch.get_num_interop_threads()))
+
+
+def resolve_setting(model, store, autotune_fn, probe=False, train=False, loader=None, **kwargs):
+    '''
+    Autotune setting of model on the features of store: probed and cached in
+    autotune_fn with probe=True, otherwise the setting cached by an earlier run
+    with the same model, longest feature and host, or None. loader replaces
+    model in the probe processes, e.g. for models that can not be pickled.
+    '''
+    fingerprint = autotune_fingerprint(model, store['input_ids'].lengths().max(initial=0), train)
+    if not probe:
+        return load_autotune(autotune_fn, fingerprint)
+
+    setting, results = autotune(loader or model, store.path, train=train, **kwargs)
+    save_autotune(autotune_fn, fingerprint, setting, results)
+    return setting
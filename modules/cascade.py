@@ -0,0 +1,85 @@
+import numpy as np
+
+from modules.postprocess import select_best_spans
+
+
+def example_confidence(start_logits, end_logits, offsets, feature_example_ids, example_ids, n_best=20, max_answer_length=30):
+    '''
+    Margin between the best answer span and the no-answer (CLS) score of every
+    example, in example_ids order. Both are the highest over the windows of the
+    example, as postprocess_predictions picks the answer. A small margin means
+    the model hardly prefers its answer over no answer or the other way round.
+    Examples without a valid span or without predicted windows get an
+    infinite margin.
+    '''
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+
+    # the first token is the no-answer span, left out of the span candidates
+    span_offsets = np.array(offsets, copy=True)
+    span_offsets[:, 0] = -1
+    _, _, span_scores = select_best_spans(
+        start_logits, end_logits, span_offsets, n_best=n_best, max_answer_length=max_answer_length)
+    null_scores = start_logits[:, 0] + end_logits[:, 0]
+
+    position = {example_id: i for i, example_id in enumerate(example_ids)}
+    feature_examples = np.array([position.get(e, -1) for e in feature_example_ids], dtype=np.int64)
+    known = feature_examples >= 0
+
+    best_span = np.full(len(position), -np.inf, dtype=np.float32)
+    best_null = np.full(len(position), -np.inf, dtype=np.float32)
+    np.maximum.at(best_span, feature_examples[known], span_scores[known])
+    np.maximum.at(best_null, feature_examples[known], null_scores[known])
+
+    finite = np.isfinite(best_span) & np.isfinite(best_null)
+    margin = np.full(len(position), np.inf, dtype=np.float32)
+    margin[finite] = np.abs(best_span[finite] - best_null[finite])
+    return margin
+
+
+def cascade_curve(confidence, small_scores, large_scores):
+    '''
+    Mean score of the cascade for every threshold that escalates a different
+    set of questions, a question is escalated when its confidence is below the
+    threshold.
+
+    small_scores, large_scores: per question score (e.g. exact match) of the
+    small and the large model
+
+    Returns (thresholds, escalated fraction, mean score) arrays, ordered by
+    increasing threshold. Questions with infinite confidence are never escalated.
+    '''
+    confidence = np.asarray(confidence, dtype=np.float64)
+    small_scores = np.asarray(small_scores, dtype=np.float64)
+    large_scores = np.asarray(large_scores, dtype=np.float64)
+    n = len(confidence)
+
+    order = np.argsort(confidence, kind='stable')
+    # threshold i escalates the i least confident questions
+    thresholds = np.r_[confidence[order], np.inf]
+    gains = np.r_[0., np.cumsum(large_scores[order] - small_scores[order])]
+    # a threshold can not split questions of equal confidence
+    cuts = np.r_[True, thresholds[:-1] < thresholds[1:]]
+
+    scores = (small_scores.sum() + gains) / max(n, 1)
+    escalated = np.arange(n + 1) / max(n, 1)
+    return thresholds[cuts], escalated[cuts], scores[cuts]
+
+
+def calibrate_threshold(confidence, small_exact, large_exact, max_exact_loss=1.):
+    '''
+    Lowest threshold whose cascade exact match is at most max_exact_loss points
+    below the large model alone, or the one escalating the most questions when
+    none is close enough.
+
+    small_exact, large_exact: per question exact match (0 or 1) of both models
+
+    Returns (threshold, escalated fraction, cascade exact).
+    '''
+    thresholds, escalated, exact = cascade_curve(confidence, small_exact, large_exact)
+    exact = 100.0 * exact
+    large = 100.0 * np.mean(large_exact) if len(large_exact) > 0 else 0.
+    # rounding must not make escalating every question miss the target
+    feasible = np.flatnonzero(large - exact <= max_exact_loss + 1e-9)
+    i = feasible[0] if len(feasible) > 0 else len(thresholds) - 1
+    return float(thresholds[i]), float(escalated[i]), float(exact[i])
@@ -1,20 +1,70 @@
+import numpy as np
 import torch
-from torch.utils.data import Dataset
-
-
-class QADataset(Dataset): 
-
-    def __init__(self, input_ids, token_type_ids, attention_mask, start_positions, end_positions):
+from torch.utils.data import Dataset, Sampler, BatchSampler, DataLoader
+
+
+def take_padded(column, indexes, pad_value=0, dtype=np.int64):
+    '''
+    Rows indexes of a token level column padded to the longest one. Columns of a
+    FeatureStore gather the batch from their flat values, lists are copied row by row.
+    '''
+    if hasattr(column, 'take'):
+        return column.take(indexes, pad_value, dtype)
+    rows = [np.asarray(column[i], dtype=dtype) for i in indexes]
+    result = np.full((len(rows), max(len(row) for row in rows)) + rows[0].shape[1:], pad_value, dtype=dtype)
+    for i, row in enumerate(rows):
+        result[i, :len(row)] = row
+    return result
+
+
+class BatchIndexedDataset(Dataset):
+    '''
+    dataset[i] returns the unpadded feature i for DynamicPaddingCollator, while
+    dataset[indexes] with a list of feature indexes returns the model inputs of
+    the whole batch as padded arrays, see batch_dataloader.
+    '''
+
+    token_columns = ('input_ids', 'token_type_ids', 'attention_mask')
+    feature_columns = ()
+
+    def get_batch(self, indexes):
+        batch = {}
+        for name in self.token_columns:
+            pad_value = self.pad_token_id if name == 'input_ids' else 0
+            batch[name] = take_padded(getattr(self, name), indexes, pad_value)
+        for name in self.feature_columns:
+            batch[name] = np.asarray(getattr(self, name))[indexes].astype(np.int64)
+        return batch
+
+
+def batch_dataloader(dataset, feature_order, batch_size, pin_memory=False):
+    '''
+    DataLoader over whole batches of feature_order. The sampler yields lists of
+    indexes, dataset[indexes] builds each padded batch at once and the arrays
+    become tensors without another copy.
+    '''
+    sampler = BatchSampler(feature_order, batch_size, drop_last=False)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, pin_memory=pin_memory)
+
+
+class QADataset(BatchIndexedDataset): 
+
+    feature_columns = ('start_positions', 'end_positions')
+
+    def __init__(self, input_ids, token_type_ids, attention_mask, start_positions, end_positions, pad_token_id=0):
         self.input_ids = input_ids
         self.token_type_ids = token_type_ids 
         self.attention_mask = attention_mask
         self.start_positions = start_positions
         self.end_positions = end_positions
+        self.pad_token_id = pad_token_id
 
     def __len__(self):
         return len(self.input_ids)
 
     def __getitem__(self, item):              
+        if not np.isscalar(item):
+            return self.get_batch(item)
         input_id = self.input_ids[item]
         token_type_id = self.token_type_ids[item]
         attention_mask = self.attention_mask[item]
@@ -30,19 +80,22 @@ class QADataset(Dataset):
         }
 
 
-class QADatasetValid(Dataset): 
+class QADatasetValid(BatchIndexedDataset): 
 
-    def __init__(self, input_ids, token_type_ids, attention_mask, offset_mapping, example_id):
+    def __init__(self, input_ids, token_type_ids, attention_mask, offset_mapping, example_id, pad_token_id=0):
       self.input_ids = input_ids
       self.token_type_ids = token_type_ids 
       self.attention_mask = attention_mask
       self.offset_mapping = offset_mapping
       self.example_id = example_id
+      self.pad_token_id = pad_token_id
 
     def __len__(self):
       return len(self.input_ids)
 
     def __getitem__(self, item):
+      if not np.isscalar(item):
+        return self.get_batch(item)
       input_id = self.input_ids[item]
       token_type_id = self.token_type_ids[item]
       attention_mask = self.attention_mask[item]
@@ -57,17 +110,20 @@ class QADatasetValid(Dataset):
       return result
 
 
-class QADatasetTest(Dataset): 
+class QADatasetTest(BatchIndexedDataset): 
 
-    def __init__(self, input_ids, token_type_ids, attention_mask):
+    def __init__(self, input_ids, token_type_ids, attention_mask, pad_token_id=0):
       self.input_ids = input_ids
       self.token_type_ids = token_type_ids 
       self.attention_mask = attention_mask
+      self.pad_token_id = pad_token_id
 
     def __len__(self):
       return len(self.input_ids)
 
     def __getitem__(self, item):
+      if not np.isscalar(item):
+        return self.get_batch(item)
       input_id = self.input_ids[item]
       token_type_id = self.token_type_ids[item]
       attention_mask = self.attention_mask[item]
@@ -76,4 +132,123 @@ class QADatasetTest(Dataset):
       result = {'input_ids': input_id,
             'token_type_ids' : token_type_id,             
             'attention_mask' : attention_mask}
-      return result
\ No newline at end of file
+      return result
+
+
+class LengthGroupedSampler(Sampler):
+    '''
+    Yield feature indices so that every run of batch_size consecutive indices
+    holds features of similar length.
+
+    Indices are split into mega batches of batch_size * mega_batch_mult features
+    which are sorted by length. With shuffle=True the mega batches are drawn from
+    a new permutation every epoch and the resulting batches are shuffled.
+    Without shuffling the mega batches are consecutive features, so the original
+    order is only permuted locally and can be restored from the yielded indices.
+    '''
+
+    def __init__(self, lengths, batch_size, shuffle=True, mega_batch_mult=50, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.mega_batch_size = batch_size * mega_batch_mult
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _epoch_indices(self, rng):
+        return rng.permutation(len(self.lengths))
+
+    def __iter__(self):
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            self.epoch += 1
+            indices = self._epoch_indices(rng)
+        else:
+            indices = np.arange(len(self.lengths))
+
+        batches = []
+        for begin in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[begin:begin + self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(-self.lengths[mega_batch], kind='stable')]
+            batches.extend(mega_batch[i:i + self.batch_size] for i in range(0, len(mega_batch), self.batch_size))
+
+        if self.shuffle and len(batches) > 1:
+            # keep a smaller batch at the end so batch boundaries stay aligned
+            n_full = len(batches) if len(batches[-1]) == self.batch_size else len(batches) - 1
+            batches = [batches[i] for i in rng.permutation(n_full)] + batches[n_full:]
+
+        for batch in batches:
+            yield from batch.tolist()
+
+
+class NegativeSubsampledSampler(LengthGroupedSampler):
+    '''
+    Shuffled LengthGroupedSampler over all positive features and a new random
+    sample of negative_ratio of the negative features (windows labeled with the
+    no-answer span) every epoch.
+    '''
+
+    def __init__(self, lengths, negatives, negative_ratio, batch_size, mega_batch_mult=50, seed=42):
+        super().__init__(lengths, batch_size, shuffle=True, mega_batch_mult=mega_batch_mult, seed=seed)
+        negatives = np.asarray(negatives, dtype=bool)
+        self.positives = np.flatnonzero(~negatives)
+        self.negatives = np.flatnonzero(negatives)
+        self.n_sampled = int(round(len(self.negatives) * negative_ratio))
+
+    def __len__(self):
+        return len(self.positives) + self.n_sampled
+
+    @property
+    def n_skipped(self):
+        return len(self.negatives) - self.n_sampled
+
+    def _epoch_indices(self, rng):
+        sampled = rng.choice(self.negatives, self.n_sampled, replace=False)
+        return rng.permutation(np.concatenate([self.positives, sampled]))
+
+
+class DynamicPaddingCollator:
+    '''
+    Pad unpadded features only to the longest item of the batch and return tensors.
+    Keys that are not model inputs (offset_mapping, example_id) are dropped, except
+    for teacher_logits of distillation, which are padded with zeros.
+    '''
+
+    def __init__(self, pad_token_id=0, pad_to_multiple_of=None):
+        self.pad_values = {
+            'input_ids': pad_token_id,
+            'token_type_ids': 0,
+            'attention_mask': 0,
+        }
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        max_length = max(len(feature['input_ids']) for feature in features)
+        if self.pad_to_multiple_of is not None:
+            max_length = -(-max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = {}
+        for key, pad_value in self.pad_values.items():
+            if key not in features[0]:
+                continue
+            tensor = torch.full((len(features), max_length), pad_value, dtype=torch.long)
+            for i, feature in enumerate(features):
+                tensor[i, :len(feature[key])] = torch.from_numpy(np.array(feature[key], dtype=np.int64))
+            batch[key] = tensor
+
+        for key in ('start_positions', 'end_positions'):
+            if key in features[0]:
+                batch[key] = torch.tensor([int(feature[key]) for feature in features], dtype=torch.long)
+
+        if 'teacher_logits' in features[0]:
+            tensor = torch.zeros((len(features), max_length, 2), dtype=torch.float32)
+            for i, feature in enumerate(features):
+                tensor[i, :len(feature['teacher_logits'])] = torch.from_numpy(np.array(feature['teacher_logits'], dtype=np.float32))
+            batch['teacher_logits'] = tensor
+        return batch
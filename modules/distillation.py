@@ -0,0 +1,111 @@
+import os
+import json
+from tqdm import tqdm
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from modules.dataset import QADataset, QADatasetTest
+from modules.dataset import LengthGroupedSampler, batch_dataloader, take_padded
+from modules.feature_store import RaggedColumn
+from modules.logit_cache import store_fingerprint
+from modules.modeling import predict_logits
+
+
+TEACHER_LOGITS_FILE = 'teacher_logits.bin'
+TEACHER_META_FILE = 'teacher_logits.json'
+
+
+def teacher_fingerprint(teacher_fn, teacher_model_name):
+    stat = os.stat(teacher_fn)
+    return {
+        'teacher_fn': os.path.abspath(teacher_fn),
+        'teacher_model_name': teacher_model_name,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+@torch.no_grad()
+def precompute_teacher_logits(model, store, batch_size, pad_token_id, fingerprint):
+    '''
+    Start and end logits of the teacher for every token of the feature store,
+    written next to its columns as a (n_tokens, 2) float32 file and returned as
+    a RaggedColumn. Logits of an earlier run with the same teacher on the same
+    features are reused.
+    '''
+    logits_fn = os.path.join(store.path, TEACHER_LOGITS_FILE)
+    meta_fn = os.path.join(store.path, TEACHER_META_FILE)
+    # preprocess.py rewrites the store in place, so the features are part of the key
+    fingerprint = {'teacher': fingerprint, 'features': store_fingerprint(store)}
+    if os.path.exists(meta_fn):
+        with open(meta_fn) as fr:
+            if json.load(fr) == fingerprint:
+                print('reusing teacher logits of {}'.format(store.path))
+                return RaggedColumn(logits_fn, np.float32, 2, store.row_splits)
+        os.remove(meta_fn)
+
+    model.eval()
+    device = next(model.parameters()).device
+    lengths = store['input_ids'].lengths()
+    feature_order = list(LengthGroupedSampler(lengths, batch_size, shuffle=False))
+    dataset = QADatasetTest(store['input_ids'], store['token_type_ids'], store['attention_mask'], pad_token_id)
+    dataloader = batch_dataloader(dataset, feature_order, batch_size, pin_memory=device.type == 'cuda')
+
+    logits = np.memmap(logits_fn, dtype=np.float32, mode='w+', shape=(max(int(store.row_splits[-1]), 1), 2))
+    n_features = 0
+    for batch in tqdm(dataloader):
+        batch = {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+        start_logits, end_logits = predict_logits(model, batch)
+        start_logits = start_logits.float().cpu().numpy()
+        end_logits = end_logits.float().cpu().numpy()
+
+        for i, feature_index in enumerate(feature_order[n_features:n_features + len(start_logits)]):
+            begin, end = store.row_splits[feature_index], store.row_splits[feature_index + 1]
+            logits[begin:end, 0] = start_logits[i, :end - begin]
+            logits[begin:end, 1] = end_logits[i, :end - begin]
+        n_features += len(start_logits)
+    logits.flush()
+    del logits
+
+    # written last, so interrupted runs are recomputed
+    with open(meta_fn, 'w') as fw:
+        json.dump(fingerprint, fw, indent=2)
+    return RaggedColumn(logits_fn, np.float32, 2, store.row_splits)
+
+
+class DistillationDataset(QADataset):
+
+    def __init__(self, input_ids, token_type_ids, attention_mask, start_positions, end_positions, teacher_logits, pad_token_id=0):
+        super().__init__(input_ids, token_type_ids, attention_mask, start_positions, end_positions, pad_token_id)
+        self.teacher_logits = teacher_logits
+
+    def get_batch(self, indexes):
+        batch = super().get_batch(indexes)
+        batch['teacher_logits'] = take_padded(self.teacher_logits, indexes, 0, np.float32)
+        return batch
+
+    def __getitem__(self, item):
+        result = super().__getitem__(item)
+        if np.isscalar(item):
+            result['teacher_logits'] = self.teacher_logits[item]
+        return result
+
+
+def distillation_loss(start_logits, end_logits, teacher_logits, attention_mask, temperature=2.):
+    '''
+    KL divergence from the teacher's to the student's start and end distributions
+    over the real tokens, scaled by temperature ** 2 to keep the gradient size.
+    '''
+    padding = attention_mask == 0
+    loss = 0.
+    for student, teacher in ((start_logits, teacher_logits[..., 0]), (end_logits, teacher_logits[..., 1])):
+        student = (student.float() / temperature).masked_fill(padding, torch.finfo(torch.float32).min)
+        teacher = (teacher.float() / temperature).masked_fill(padding, torch.finfo(torch.float32).min)
+        loss = loss + F.kl_div(
+            F.log_softmax(student, dim=-1),
+            F.log_softmax(teacher, dim=-1),
+            reduction='batchmean',
+            log_target=True)
+    return loss / 2 * temperature ** 2
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import sqlite3
+
+
+def tokenizer_fingerprint(tokenizer, max_length, stride):
+    '''
+    Hash of everything besides the example itself that changes the tokenized features.
+    '''
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode('utf-8'))
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode('utf-8'))
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode('utf-8'))
+    h.update(json.dumps([max_length, stride]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def example_key(fingerprint, question, context, answer_start=None, text=None):
+    h = hashlib.sha1(fingerprint.encode('utf-8'))
+    h.update(json.dumps([question, context, answer_start, text], ensure_ascii=False).encode('utf-8'))
+    return h.hexdigest()
+
+
+class FeatureCache:
+    '''
+    Content-addressed store of the tokenized features of single examples.
+
+    Entries live in one sqlite file. Every read refreshes the access time of an
+    entry and evict() removes least recently used entries until the cache fits
+    in max_bytes, never touching entries used by the current run.
+    '''
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(path, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.started = time.time()
+        self.db = sqlite3.connect(os.path.join(path, 'features.sqlite'))
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS features '
+            '(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)')
+        self.db.commit()
+
+    def contains(self, keys):
+        found = set()
+        keys = list(keys)
+        for begin in range(0, len(keys), 500):
+            chunk = keys[begin:begin + 500]
+            query = 'SELECT key FROM features WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+            found.update(row[0] for row in self.db.execute(query, chunk))
+        return found
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = {}
+        for begin in range(0, len(keys), 500):
+            chunk = keys[begin:begin + 500]
+            query = 'SELECT key, value FROM features WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+            result.update((key, pickle.loads(value)) for key, value in self.db.execute(query, chunk))
+        now = time.time()
+        self.db.executemany('UPDATE features SET last_access = ? WHERE key = ?', [(now, key) for key in result])
+        self.db.commit()
+        return result
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, features in items:
+            value = pickle.dumps(features, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, value, len(value), now))
+        self.db.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def evict(self):
+        total = self.size()
+        n_evicted = 0
+        rows = self.db.execute(
+            'SELECT key, size FROM features WHERE last_access < ? ORDER BY last_access', (self.started,)).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM features WHERE key = ?', (key,))
+            total -= size
+            n_evicted += 1
+        self.db.commit()
+        if n_evicted > 0:
+            self.db.execute('VACUUM')
+        return n_evicted
+
+    def close(self):
+        self.db.close()
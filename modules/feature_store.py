@@ -0,0 +1,295 @@
+import os
+import json
+
+import numpy as np
+
+
+META_FILE = 'meta.json'
+ROW_SPLITS_FILE = 'row_splits.bin'
+EXAMPLE_IDS_FILE = 'example_ids.json'
+CONTEXT_OFFSETS_FILE = 'context_offsets.bin'
+CONTEXT_SPLITS_FILE = 'context_splits.bin'
+
+
+def _open_memmap(path, dtype, shape):
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+class FeatureStoreWriter:
+    '''
+    Append tokenized features to a directory of flat binary columns.
+
+    Token level columns (input_ids, token_type_ids, attention_mask, offset_mapping)
+    are concatenated over all features and split by a shared row_splits index.
+    Feature level columns (start_positions, end_positions, ...) hold one value per
+    feature. example_id is stored as an int32 index into example_ids.json.
+    None offsets are written as -1.
+
+    Features built on shared contexts pass context_offsets, the offsets of every
+    context of the shard, instead of offset_mapping. Those are stored once per
+    context and context_index is made global over all shards. Contexts with the
+    same context_keys entry as one of an earlier shard are not stored again.
+    '''
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = {}
+        self.files = {}
+        self.row_splits = [0]
+        self.example_ids = []
+        self.example_index = {}
+        self.context_splits = [0]
+        self.context_keys = {}
+        self.context_file = None
+
+    def _file(self, name, dtype, width, ragged):
+        if name not in self.files:
+            self.columns[name] = {'dtype': np.dtype(dtype).name, 'width': width, 'ragged': ragged}
+            self.files[name] = open(os.path.join(self.path, name + '.bin'), 'wb')
+        return self.files[name]
+
+    def _append_contexts(self, context_offsets, context_keys=None):
+        # global index of every context of the shard
+        if self.context_file is None:
+            self.context_file = open(os.path.join(self.path, CONTEXT_OFFSETS_FILE), 'wb')
+        indexes = []
+        for i, offsets in enumerate(context_offsets):
+            key = None if context_keys is None else context_keys[i]
+            if key in self.context_keys:
+                indexes.append(self.context_keys[key])
+                continue
+            indexes.append(len(self.context_splits) - 1)
+            if key is not None:
+                self.context_keys[key] = indexes[-1]
+            offsets = np.asarray(offsets, dtype=np.int32).reshape(-1, 2)
+            self.context_file.write(offsets.tobytes())
+            self.context_splits.append(self.context_splits[-1] + len(offsets))
+        return indexes
+
+    def append(self, features):
+        if 'context_offsets' in features:
+            features = dict(features)
+            indexes = self._append_contexts(features.pop('context_offsets'), features.pop('context_keys', None))
+            features['context_index'] = [indexes[index] for index in features['context_index']]
+
+        n_features = len(features['input_ids'])
+        lengths = [len(input_ids) for input_ids in features['input_ids']]
+
+        for name, values in features.items():
+            if len(values) != n_features:
+                raise ValueError('Column {} has {} rows, expected {}'.format(name, len(values), n_features))
+
+            if name == 'example_id':
+                indexes = []
+                for example_id in values:
+                    if example_id not in self.example_index:
+                        self.example_index[example_id] = len(self.example_ids)
+                        self.example_ids.append(example_id)
+                    indexes.append(self.example_index[example_id])
+                self._file('example_index', np.int32, 1, False).write(np.asarray(indexes, dtype=np.int32).tobytes())
+
+            elif name == 'offset_mapping':
+                fw = self._file(name, np.int32, 2, True)
+                for offsets, length in zip(values, lengths):
+                    if not isinstance(offsets, np.ndarray):
+                        offsets = [o if o is not None else (-1, -1) for o in offsets]
+                    fw.write(np.asarray(offsets, dtype=np.int32).reshape(length, 2).tobytes())
+
+            elif n_features > 0 and isinstance(values[0], (list, tuple, np.ndarray)):
+                fw = self._file(name, np.int32, 1, True)
+                for row, length in zip(values, lengths):
+                    if len(row) != length:
+                        raise ValueError('Column {} is not aligned with input_ids'.format(name))
+                    fw.write(np.asarray(row, dtype=np.int32).tobytes())
+
+            else:
+                self._file(name, np.int32, 1, False).write(np.asarray(values, dtype=np.int32).tobytes())
+
+        for length in lengths:
+            self.row_splits.append(self.row_splits[-1] + length)
+
+    def close(self):
+        for fw in self.files.values():
+            fw.close()
+        if self.context_file is not None:
+            self.context_file.close()
+            with open(os.path.join(self.path, CONTEXT_SPLITS_FILE), 'wb') as fw:
+                fw.write(np.asarray(self.context_splits, dtype=np.int64).tobytes())
+
+        row_splits = np.asarray(self.row_splits, dtype=np.int64)
+        with open(os.path.join(self.path, ROW_SPLITS_FILE), 'wb') as fw:
+            fw.write(row_splits.tobytes())
+        with open(os.path.join(self.path, EXAMPLE_IDS_FILE), 'w', encoding='utf-8') as fw:
+            json.dump(self.example_ids, fw, ensure_ascii=False)
+
+        meta = {
+            'n_features': len(row_splits) - 1,
+            'n_tokens': int(row_splits[-1]),
+            'columns': self.columns,
+        }
+        if self.context_file is not None:
+            meta['n_contexts'] = len(self.context_splits) - 1
+        with open(os.path.join(self.path, META_FILE), 'w') as fw:
+            json.dump(meta, fw, indent=2)
+
+
+class RaggedColumn:
+    '''
+    Token level column, column[i] returns the (memory-mapped) values of feature i.
+    '''
+
+    def __init__(self, path, dtype, width, row_splits):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.row_splits = row_splits
+        self._values = None
+
+    @property
+    def values(self):
+        # opened lazily so that worker processes map the file instead of copying it
+        if self._values is None:
+            shape = (int(self.row_splits[-1]),) if self.width == 1 else (int(self.row_splits[-1]), self.width)
+            self._values = _open_memmap(self.path, self.dtype, shape)
+        return self._values
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_values'] = None
+        return state
+
+    def __len__(self):
+        return len(self.row_splits) - 1
+
+    def __getitem__(self, item):
+        return self.values[self.row_splits[item]:self.row_splits[item + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.row_splits)
+
+    def take(self, indexes, fill=0, dtype=None):
+        '''
+        Rows indexes as one array of shape (len(indexes), longest row[, width])
+        padded with fill, gathered from the flat values in a single copy.
+        '''
+        indexes = np.asarray(indexes, dtype=np.int64)
+        begins = self.row_splits[indexes]
+        lengths = self.row_splits[indexes + 1] - begins
+        positions = np.arange(lengths.max(initial=0))
+        mask = positions[None, :] < lengths[:, None]
+
+        shape = mask.shape if self.width == 1 else mask.shape + (self.width,)
+        result = np.full(shape, fill, dtype=dtype or self.dtype)
+        result[mask] = self.values[(begins[:, None] + positions[None, :])[mask]]
+        return result
+
+
+class ExampleIdColumn:
+    '''
+    example_id of every feature, backed by an int32 index into the example id list.
+    '''
+
+    def __init__(self, example_ids, example_index):
+        self.example_ids = example_ids
+        self.example_index = example_index
+
+    def __len__(self):
+        return len(self.example_index)
+
+    def __getitem__(self, item):
+        return self.example_ids[self.example_index[item]]
+
+    def __iter__(self):
+        for i in self.example_index:
+            yield self.example_ids[i]
+
+
+class ContextOffsetColumn:
+    '''
+    offset_mapping of features built on shared contexts. Row i is -1 except for
+    the first token, (0, 0), and the context tokens of the window, whose offsets
+    are read from the offsets stored once per context.
+    '''
+
+    def __init__(self, context_offsets, context_index, context_start, context_offset, context_length, row_splits):
+        self.context_offsets = context_offsets
+        self.context_index = context_index
+        self.context_start = context_start
+        self.context_offset = context_offset
+        self.context_length = context_length
+        self.row_splits = row_splits
+
+    def __len__(self):
+        return len(self.row_splits) - 1
+
+    def __getitem__(self, item):
+        row = np.full((self.row_splits[item + 1] - self.row_splits[item], 2), -1, dtype=np.int32)
+        row[0] = 0
+        start = self.context_start[item]
+        offset = self.context_offset[item]
+        length = self.context_length[item]
+        row[offset:offset + length] = self.context_offsets[self.context_index[item]][start:start + length]
+        return row
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.row_splits)
+
+
+class FeatureStore:
+    '''
+    Read-only, memory-mapped view of a directory written by FeatureStoreWriter.
+    store[name] returns a RaggedColumn, an int32 array, an ExampleIdColumn or,
+    for offset_mapping of shared context features, a ContextOffsetColumn.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as fr:
+            self.meta = json.load(fr)
+        with open(os.path.join(path, EXAMPLE_IDS_FILE), encoding='utf-8') as fr:
+            self.example_ids = json.load(fr)
+
+        n_features = self.meta['n_features']
+        self.row_splits = np.fromfile(os.path.join(path, ROW_SPLITS_FILE), dtype=np.int64)
+        self.columns = {}
+        for name, column in self.meta['columns'].items():
+            filename = os.path.join(path, name + '.bin')
+            if column['ragged']:
+                self.columns[name] = RaggedColumn(filename, column['dtype'], column['width'], self.row_splits)
+            else:
+                self.columns[name] = _open_memmap(filename, column['dtype'], (n_features,))
+
+        if 'n_contexts' in self.meta and 'offset_mapping' not in self.columns:
+            context_splits = np.fromfile(os.path.join(path, CONTEXT_SPLITS_FILE), dtype=np.int64)
+            self.columns['offset_mapping'] = ContextOffsetColumn(
+                RaggedColumn(os.path.join(path, CONTEXT_OFFSETS_FILE), np.int32, 2, context_splits),
+                self.columns['context_index'],
+                self.columns['context_start'],
+                self.columns['context_offset'],
+                self.columns['context_length'],
+                self.row_splits)
+
+    def __len__(self):
+        return self.meta['n_features']
+
+    def __contains__(self, name):
+        return name in self.columns or (name == 'example_id' and 'example_index' in self.columns)
+
+    def __getitem__(self, name):
+        if name == 'example_id':
+            return ExampleIdColumn(self.example_ids, self.columns['example_index'])
+        return self.columns[name]
+
+    def keys(self):
+        return list(self.columns.keys())
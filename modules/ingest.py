@@ -0,0 +1,125 @@
+import re
+import json
+
+
+TRAIN_FIELDS = ('context', 'question_id', 'question', 'answer_start', 'text')
+TEST_FIELDS = ('context', 'question_id', 'question')
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonStream:
+    '''
+    Incremental reader that decodes one json value at a time from a text file,
+    keeping only the not yet consumed part of the file in memory.
+    '''
+
+    def __init__(self, fr, chunk_size):
+        self.fr = fr
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self, size=None):
+        data = self.fr.read(size or self.chunk_size)
+        if not data:
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # skip whitespace and return the next character, '' at the end of the file
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at offset {} of the json stream'.format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # incomplete value, read at least as much again as is buffered
+                if not self._fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(path, key='data', chunk_size=1 << 20):
+    '''
+    Yield the elements of the array stored under key of the top-level json object
+    one at a time, without loading the whole file.
+    '''
+    with open(path, encoding='utf-8') as fr:
+        stream = _JsonStream(fr, chunk_size)
+        stream.expect('{')
+        while stream.peek() != '}':
+            name = stream.value()
+            stream.expect(':')
+            if name != key:
+                stream.value()
+            else:
+                stream.expect('[')
+                while stream.peek() != ']':
+                    yield stream.value()
+                    if stream.peek() == ',':
+                        stream.pos += 1
+                stream.expect(']')
+            if stream.peek() == ',':
+                stream.pos += 1
+
+
+def iter_train_records(path):
+    return flatten_train_rows(iter_json_array(path))
+
+
+def iter_test_records(path):
+    return flatten_test_rows(iter_json_array(path))
+
+
+def flatten_train_rows(rows):
+    '''
+    Flat (context, question_id, question, answer_start, text) records of the first
+    question of every paragraph. answer_start is shifted by one where the answer
+    text does not match the context at the given position.
+    '''
+    for row in rows:
+        for paragraph in row['paragraphs']:
+            context = paragraph['context']
+            qa = paragraph['qas'][0]
+
+            if len(qa['answers']) != 0:
+                answer_start = qa['answers'][0]['answer_start']
+                text = qa['answers'][0]['text']
+                # answer_start correction
+                if context[answer_start: answer_start + len(text)] != text:
+                    answer_start += 1
+                yield context, qa['question_id'], qa['question'], [answer_start], [text]
+            else:
+                yield context, qa['question_id'], qa['question'], [], []
+
+
+def flatten_test_rows(rows):
+    '''
+    Flat (context, question_id, question) records of every question.
+    '''
+    for row in rows:
+        for paragraph in row['paragraphs']:
+            context = paragraph['context']
+            for qa in paragraph['qas']:
+                yield context, qa['question_id'], qa['question']
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from modules.feature_store import META_FILE, RaggedColumn
+
+
+def checkpoint_fingerprint(model_fn=None, optimized_fn=None, artifact_dir=None):
+    '''
+    Fingerprint of the weights file inference.py loads for these arguments.
+    '''
+    if optimized_fn is not None:
+        weights_fn = optimized_fn
+    elif artifact_dir is not None:
+        # imported here, so decoding from cached logits does not import transformers
+        from modules.modeling import ARTIFACT_WEIGHTS_FILE
+        weights_fn = os.path.join(artifact_dir, ARTIFACT_WEIGHTS_FILE)
+    else:
+        weights_fn = model_fn
+    stat = os.stat(weights_fn)
+    return {
+        'weights_fn': os.path.abspath(weights_fn),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def ensemble_fingerprint(model_fns=None, optimized_fn=None, artifact_dirs=None, weights=None):
+    '''
+    Fingerprint of the checkpoints inference.py runs for these arguments. A single
+    checkpoint has the fingerprint of checkpoint_fingerprint, an ensemble the
+    fingerprints of all members and their normalized weights.
+    '''
+    if optimized_fn is not None:
+        return checkpoint_fingerprint(optimized_fn=optimized_fn)
+    if artifact_dirs is not None:
+        members = [checkpoint_fingerprint(artifact_dir=artifact_dir) for artifact_dir in artifact_dirs]
+    else:
+        members = [checkpoint_fingerprint(model_fn=model_fn) for model_fn in model_fns]
+    if len(members) == 1:
+        return members[0]
+    weights = [1.] * len(members) if weights is None else list(weights)
+    return {'members': members, 'weights': [weight / sum(weights) for weight in weights]}
+
+
+def store_fingerprint(store):
+    stat = os.stat(os.path.join(store.path, META_FILE))
+    return {
+        'path': os.path.abspath(store.path),
+        'n_features': len(store),
+        'n_tokens': store.meta['n_tokens'],
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def _checkpoint_exists(checkpoint):
+    '''
+    Whether the weights files of a checkpoint or ensemble fingerprint are still
+    the files it was taken from.
+    '''
+    for member in checkpoint.get('members', [checkpoint]):
+        if not os.path.exists(member['weights_fn']):
+            return False
+        stat = os.stat(member['weights_fn'])
+        if (stat.st_size, stat.st_mtime_ns) != (member['size'], member['mtime_ns']):
+            return False
+    return True
+
+
+def evict_stale_logits(store):
+    '''
+    Remove the cached logits of store that can not be read anymore: logits of an
+    earlier preprocessing run or of a weights file that was overwritten or
+    removed. Returns the removed logits files.
+    '''
+    features = store_fingerprint(store)
+    removed = []
+    for name in sorted(os.listdir(store.path)):
+        if not (name.startswith('logits_') and name.endswith('.json')):
+            continue
+        meta_fn = os.path.join(store.path, name)
+        with open(meta_fn) as fr:
+            fingerprint = json.load(fr)
+        if fingerprint.get('features') == features and _checkpoint_exists(fingerprint['checkpoint']):
+            continue
+        logits_fn = meta_fn[:-len('.json')] + '.bin'
+        os.remove(meta_fn)
+        if os.path.exists(logits_fn):
+            os.remove(logits_fn)
+        removed.append(logits_fn)
+    return removed
+
+
+class LogitCache:
+    '''
+    Start and end logits of one checkpoint for every token of a feature store,
+    written next to its columns as a (n_tokens, 2) float32 file like the teacher
+    logits of distillation. Files are named by a hash of the checkpoint and store
+    fingerprints, so every checkpoint keeps its own logits and a new checkpoint
+    or a new preprocessing run never reads stale ones. Writing logits removes
+    those left by an earlier preprocessing run or an overwritten checkpoint.
+    Features that are not predicted, e.g. windows skipped by a window filter,
+    keep -inf logits.
+    '''
+
+    def __init__(self, store, checkpoint, window_filter=None):
+        self.store = store
+        self.fingerprint = {'checkpoint': checkpoint, 'features': store_fingerprint(store)}
+        if window_filter is not None:
+            self.fingerprint['window_filter'] = window_filter
+        key = hashlib.sha1(json.dumps(self.fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+        self.logits_fn = os.path.join(store.path, 'logits_{}.bin'.format(key))
+        self.meta_fn = os.path.join(store.path, 'logits_{}.json'.format(key))
+        self._logits = None
+
+    def exists(self):
+        if not os.path.exists(self.meta_fn):
+            return False
+        with open(self.meta_fn) as fr:
+            return json.load(fr) == self.fingerprint
+
+    def load(self):
+        '''
+        (start_logits, end_logits) of shape (n_features, longest feature), -inf
+        after the end of every feature, or None when nothing is cached.
+        '''
+        if not self.exists():
+            return None
+        column = RaggedColumn(self.logits_fn, np.float32, 2, self.store.row_splits)
+        logits = column.take(np.arange(len(self.store)), -np.inf)
+        return np.ascontiguousarray(logits[..., 0]), np.ascontiguousarray(logits[..., 1])
+
+    def put(self, feature_indexes, start_logits, end_logits):
+        '''
+        Write the logits of a batch, padded logits beyond a feature are ignored.
+        '''
+        if self._logits is None:
+            # the metadata is written by close, so interrupted runs are recomputed
+            if os.path.exists(self.meta_fn):
+                os.remove(self.meta_fn)
+            self._logits = np.memmap(self.logits_fn, dtype=np.float32, mode='w+', shape=(max(self.store.meta['n_tokens'], 1), 2))
+            self._logits[:] = -np.inf
+
+        row_splits = self.store.row_splits
+        for i, feature_index in enumerate(feature_indexes):
+            begin, end = row_splits[feature_index], row_splits[feature_index + 1]
+            self._logits[begin:end, 0] = start_logits[i, :end - begin]
+            self._logits[begin:end, 1] = end_logits[i, :end - begin]
+
+    def close(self):
+        if self._logits is None:
+            return
+        self._logits.flush()
+        self._logits = None
+        with open(self.meta_fn, 'w') as fw:
+            json.dump(self.fingerprint, fw, indent=2)
+        evict_stale_logits(self.store)
+
+    def save(self, start_logits, end_logits):
+        self.put(range(len(self.store)), start_logits, end_logits)
+        self.close()
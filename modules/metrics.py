@@ -0,0 +1,93 @@
+import re
+import string
+import collections
+
+from modules.postprocess import offsets_to_array, postprocess_predictions
+from modules.profiler import Profiler
+
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+_ARTICLES = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+
+
+def normalize_answer(text):
+    '''
+    Lower text and remove punctuation, articles and extra whitespace,
+    as the official SQuAD v2 evaluation script does.
+    '''
+    text = text.lower().translate(_PUNCTUATION)
+    return ' '.join(_ARTICLES.sub(' ', text).split())
+
+
+def _f1(gold_tokens, gold_counter, pred_tokens, pred_counter):
+    if len(gold_tokens) == 0 or len(pred_tokens) == 0:
+        # no-answer on either side: 1 if both are no-answer, 0 otherwise
+        return int(gold_tokens == pred_tokens)
+    num_same = sum((gold_counter & pred_counter).values())
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / len(pred_tokens)
+    recall = 1.0 * num_same / len(gold_tokens)
+    return (2 * precision * recall) / (precision + recall)
+
+
+class SquadV2Scorer:
+    '''
+    Exact match and token F1 of the squad_v2 metric (with a no-answer probability
+    of 0) against references that are normalized once, so the same examples can be
+    scored for many predictions. Unanswerable questions only match an empty answer.
+    '''
+
+    def __init__(self, question_ids, answer_texts):
+        self.question_ids = list(question_ids)
+        self.references = []
+        for texts in answer_texts:
+            golds = [normalize_answer(text) for text in texts]
+            golds = [gold for gold in golds if gold] or ['']
+            self.references.append([(gold, gold.split(), collections.Counter(gold.split())) for gold in golds])
+
+    @classmethod
+    def from_examples(cls, examples):
+        return cls(examples['question_id'].tolist(), examples['text'].tolist())
+
+    def score_questions(self, predictions):
+        '''
+        Exact match (0 or 1) and F1 lists of every question with a prediction,
+        in the order of question_ids.
+        '''
+        exact_scores, f1_scores = [], []
+        for question_id, references in zip(self.question_ids, self.references):
+            if question_id not in predictions:
+                continue
+            prediction = normalize_answer(predictions[question_id])
+            pred_tokens = prediction.split()
+            pred_counter = collections.Counter(pred_tokens)
+
+            exact_scores.append(max(int(gold == prediction) for gold, _, _ in references))
+            f1_scores.append(max(_f1(tokens, counter, pred_tokens, pred_counter) for _, tokens, counter in references))
+        return exact_scores, f1_scores
+
+    def score(self, predictions):
+        '''
+        predictions: dict of question id -> predicted answer text.
+        Questions without a prediction are left out, as in squad_v2.
+        '''
+        exact_scores, f1_scores = self.score_questions(predictions)
+        total = len(exact_scores)
+        if total == 0:
+            raise ValueError('None of the {} questions has a prediction.'.format(len(self.question_ids)))
+        return {
+            "exact": 100.0 * sum(exact_scores) / total,
+            "f1": 100.0 * sum(f1_scores) / total}
+
+
+def compute_metrics(start_logits, end_logits, features, examples, n_best=5, max_answer_length=40, profiler=None, scorer=None):
+    profiler = profiler or Profiler(enabled=False)
+    with profiler.stage('decode'):
+        offsets = offsets_to_array(features.offset_mapping, start_logits.shape[1])
+        predictions = postprocess_predictions(start_logits, end_logits, offsets, features.example_id,
+            examples["question_id"].tolist(), examples["context"].tolist(), n_best=n_best, max_answer_length=max_answer_length)
+
+    with profiler.stage('metric'):
+        scorer = scorer or SquadV2Scorer.from_examples(examples)
+        return scorer.score(predictions)
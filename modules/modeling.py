@@ -0,0 +1,178 @@
+import os
+import contextlib
+
+import torch
+
+from transformers import AutoConfig
+from transformers import AutoModelForQuestionAnswering
+from transformers.modeling_outputs import QuestionAnsweringModelOutput
+
+
+# same name as the HuggingFace weights file, so from_pretrained can read an artifact too
+ARTIFACT_WEIGHTS_FILE = 'pytorch_model.bin'
+
+
+def load_model(model_fn, pretrained_model_name, device='cpu'):
+    '''
+    Build the model from the pretrained checkpoint and load the fine-tuned weights.
+    '''
+    saved_data = torch.load(model_fn, map_location=device)
+    model = AutoModelForQuestionAnswering.from_pretrained(pretrained_model_name)
+    model.load_state_dict(saved_data)
+    return model.to(device).eval()
+
+
+def save_model_artifact(model, tokenizer, path):
+    '''
+    Write the model config, tokenizer files and fine-tuned weights to the
+    directory path, everything load_model_artifact needs without the hub.
+    '''
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    torch.save({key: value.cpu().contiguous() for key, value in model.state_dict().items()}, os.path.join(path, ARTIFACT_WEIGHTS_FILE))
+
+
+@contextlib.contextmanager
+def _empty_weights():
+    # parameters are created on the meta device, so building a model neither
+    # allocates nor randomly initializes them. Buffers are kept, some of them
+    # (e.g. position ids) are not part of the state dict.
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = torch.nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+
+    torch.nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def load_model_artifact(path, device='cpu'):
+    '''
+    Build the model of an artifact written by save_model_artifact. The weights
+    file is memory-mapped and its tensors become the parameters, so they are
+    read once and never held twice.
+    '''
+    config = AutoConfig.from_pretrained(path)
+    weights_fn = os.path.join(path, ARTIFACT_WEIGHTS_FILE)
+    try:
+        saved_data = torch.load(weights_fn, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1 can neither memory-map the file nor assign its tensors as parameters
+        model = AutoModelForQuestionAnswering.from_config(config)
+        model.load_state_dict(torch.load(weights_fn, map_location='cpu'))
+        return model.to(device).eval()
+
+    with _empty_weights():
+        model = AutoModelForQuestionAnswering.from_config(config)
+    model.load_state_dict(saved_data, assign=True)
+    return model.to(device).eval()
+
+
+class WeightedEnsemble(torch.nn.Module):
+    '''
+    Models sharing a tokenizer, run one after another on every batch. Their start
+    and end logits are added up with weights normalized to sum to 1 as they are
+    produced, so a batch only ever holds one set of logits.
+    '''
+
+    def __init__(self, models, weights=None):
+        super().__init__()
+        weights = [1.] * len(models) if weights is None else list(weights)
+        if len(weights) != len(models):
+            raise ValueError('{} ensemble weights for {} models'.format(len(weights), len(models)))
+        self.models = torch.nn.ModuleList(models)
+        self.weights = [weight / sum(weights) for weight in weights]
+
+    def forward(self, **batch):
+        start_logits, end_logits = 0., 0.
+        for model, weight in zip(self.models, self.weights):
+            outputs = model(**batch)
+            start_logits = start_logits + weight * outputs.start_logits
+            end_logits = end_logits + weight * outputs.end_logits
+        return QuestionAnsweringModelOutput(start_logits=start_logits, end_logits=end_logits)
+
+
+class QALogits(torch.nn.Module):
+    '''
+    Return (start_logits, end_logits) from positional tensors so that
+    torch.jit.trace can follow the model.
+    '''
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        outputs = self.model(
+            input_ids=input_ids,
+            token_type_ids=token_type_ids,
+            attention_mask=attention_mask,
+            return_dict=False)
+        return outputs[0], outputs[1]
+
+
+def quantize_model(model):
+    '''
+    Dynamic int8 quantization of all Linear layers, for CPU inference.
+    '''
+    return torch.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def trace_model(model, batch):
+    '''
+    Trace the model with an example batch from the DynamicPaddingCollator.
+    Batch size and sequence length stay dynamic for BERT style models. Models
+    that branch on the sequence length (e.g. block sparse BigBird) keep the
+    branch taken for the example batch.
+    '''
+    with torch.no_grad():
+        traced = torch.jit.trace(
+            QALogits(model).eval(),
+            (batch['input_ids'], batch['token_type_ids'], batch['attention_mask']),
+            check_trace=False)
+    return torch.jit.freeze(traced.eval())
+
+
+def save_optimized_model(model, path):
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, path)
+    else:
+        torch.save(model, path)
+
+
+def load_optimized_model(path):
+    '''
+    Load an artifact written by save_optimized_model, either a TorchScript module
+    or a pickled (quantized) model.
+    '''
+    try:
+        return torch.jit.load(path, map_location='cpu').eval()
+    except RuntimeError:
+        pass
+    try:
+        model = torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch versions without the weights_only argument
+        model = torch.load(path, map_location='cpu')
+    return model.eval()
+
+
+def predict_logits(model, batch):
+    '''
+    Start and end logits of a collated batch for both eager and traced models.
+    Logits of padding are -inf, so decoding does not depend on how features
+    were batched and equals decoding logits that were stored without padding.
+    '''
+    if isinstance(model, torch.jit.ScriptModule):
+        start_logits, end_logits = model(batch['input_ids'], batch['token_type_ids'], batch['attention_mask'])
+    else:
+        outputs = model(**batch)
+        start_logits, end_logits = outputs.start_logits, outputs.end_logits
+    padding = batch['attention_mask'] == 0
+    return start_logits.masked_fill(padding, float('-inf')), end_logits.masked_fill(padding, float('-inf'))
@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def negative_windows(input_ids, start_positions, cls_token_id):
+    '''
+    Mask of the training features labeled with the no-answer span: overflow
+    windows without the answer and windows of unanswerable questions.
+
+    input_ids: RaggedColumn of the features, start_positions: their labels
+    '''
+    starts = np.asarray(start_positions, dtype=np.int64)
+    return np.asarray(input_ids.values[input_ids.row_splits[:-1] + starts] == cls_token_id)
+
+
+def reweighted_span_loss(start_logits, end_logits, start_positions, end_positions, negative, negative_weight):
+    '''
+    Start/end cross-entropy of the QA head, averaged with weight negative_weight
+    for the negative features of the batch. Trained on a sample of ratio r of the
+    negatives with negative_weight = 1 / r, the loss has the expectation of the
+    loss over all features, so the no-answer score keeps its calibration.
+    '''
+    ignored_index = start_logits.size(1)
+    start_positions = start_positions.clamp(0, ignored_index)
+    end_positions = end_positions.clamp(0, ignored_index)
+    loss = (F.cross_entropy(start_logits.float(), start_positions, ignore_index=ignored_index, reduction='none')
+            + F.cross_entropy(end_logits.float(), end_positions, ignore_index=ignored_index, reduction='none')) / 2
+
+    weights = torch.where(negative, torch.full_like(loss, negative_weight), torch.ones_like(loss))
+    return (loss * weights).sum() / weights.sum()
@@ -0,0 +1,246 @@
+import collections
+import json
+import queue
+import threading
+
+import numpy as np
+
+
+def offsets_to_array(offset_mapping, length=None):
+    '''
+    Convert offset mappings (lists of (start, end) tuples with None for
+    non-context tokens, or int arrays using -1 for them) to an int32 array
+    of shape (n_features, length, 2). Masked positions are filled with -1.
+    '''
+    if length is None:
+        length = max((len(offsets) for offsets in offset_mapping), default=0)
+
+    result = np.full((len(offset_mapping), length, 2), -1, dtype=np.int32)
+    for i, offsets in enumerate(offset_mapping):
+        if isinstance(offsets, np.ndarray):
+            row = offsets[:length]
+        else:
+            row = [o if o is not None else (-1, -1) for o in offsets[:length]]
+        if len(row) > 0:
+            result[i, :len(row)] = row
+    return result
+
+
+def mask_padding(logits, lengths):
+    '''
+    Copy of padded (n_features, seq_len) logits with -inf after the end of every
+    feature, like the logits of predict_logits.
+    '''
+    logits = np.array(logits, dtype=np.float32)
+    logits[np.arange(logits.shape[1])[None, :] >= np.asarray(lengths)[:, None]] = -np.inf
+    return logits
+
+
+def _top_k(logits, k):
+    # indices of the k largest logits per row, sorted by descending logit
+    if k < logits.shape[1]:
+        indexes = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+    else:
+        indexes = np.broadcast_to(np.arange(logits.shape[1]), logits.shape)
+    order = np.argsort(-np.take_along_axis(logits, indexes, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(indexes, order, axis=1)
+
+
+def select_best_spans(start_logits, end_logits, offsets, n_best=20, max_answer_length=30, chunk_size=2048):
+    '''
+    Score every valid (start, end) pair among the n_best start and end candidates
+    of each feature and return the best one.
+
+    start_logits, end_logits: float arrays of shape (n_features, seq_len)
+    offsets: int array of shape (n_features, seq_len, 2), -1 where the offset is None
+
+    Returns (start_char, end_char, score) arrays of shape (n_features,).
+    Features without any valid span get a score of -inf.
+    '''
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+    n_features, seq_len = start_logits.shape
+
+    start_chars = np.zeros(n_features, dtype=np.int64)
+    end_chars = np.zeros(n_features, dtype=np.int64)
+    scores = np.full(n_features, -np.inf, dtype=np.float32)
+    if n_features == 0 or seq_len == 0:
+        return start_chars, end_chars, scores
+
+    k = min(n_best, seq_len)
+    for begin in range(0, n_features, chunk_size):
+        end = min(begin + chunk_size, n_features)
+        start_logit = start_logits[begin:end]
+        end_logit = end_logits[begin:end]
+        offset = offsets[begin:end, :seq_len]
+        valid = offset[..., 0] >= 0
+
+        start_indexes = _top_k(start_logit, k)
+        end_indexes = _top_k(end_logit, k)
+
+        # (chunk, k, k) candidate scores, rows are start candidates and columns end candidates
+        pair_scores = (np.take_along_axis(start_logit, start_indexes, axis=1)[:, :, None]
+                       + np.take_along_axis(end_logit, end_indexes, axis=1)[:, None, :])
+        lengths = end_indexes[:, None, :] - start_indexes[:, :, None] + 1
+        mask = (np.take_along_axis(valid, start_indexes, axis=1)[:, :, None]
+                & np.take_along_axis(valid, end_indexes, axis=1)[:, None, :]
+                & (lengths >= 1)
+                & (lengths <= max_answer_length))
+        pair_scores = np.where(mask, pair_scores, -np.inf).reshape(end - begin, k * k)
+
+        rows = np.arange(end - begin)
+        best = pair_scores.argmax(axis=1)
+        best_start = start_indexes[rows, best // k]
+        best_end = end_indexes[rows, best % k]
+
+        start_chars[begin:end] = offset[rows, best_start, 0]
+        end_chars[begin:end] = offset[rows, best_end, 1]
+        scores[begin:end] = pair_scores[rows, best]
+
+    return start_chars, end_chars, scores
+
+
+def postprocess_predictions(start_logits, end_logits, offsets, feature_example_ids, example_ids, contexts,
+                            n_best=20, max_answer_length=30):
+    '''
+    Extract the best answer text for each example from the logits of its features.
+
+    feature_example_ids: example id of every feature
+    example_ids, contexts: example ids and contexts in output order
+
+    Returns an OrderedDict of example id -> predicted answer text.
+    '''
+    start_chars, end_chars, scores = select_best_spans(
+        start_logits, end_logits, offsets, n_best=n_best, max_answer_length=max_answer_length)
+
+    position = {example_id: i for i, example_id in enumerate(example_ids)}
+    feature_examples = np.array([position.get(e, -1) for e in feature_example_ids], dtype=np.int64)
+
+    # best feature per example, earlier features win ties
+    order = np.lexsort((-scores, feature_examples))
+    grouped = feature_examples[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = grouped[1:] != grouped[:-1]
+
+    predictions = collections.OrderedDict((example_id, "") for example_id in example_ids)
+    for feature_index in order[first]:
+        example_index = feature_examples[feature_index]
+        if example_index < 0 or not np.isfinite(scores[feature_index]):
+            continue
+        context = contexts[example_index]
+        predictions[example_ids[example_index]] = context[start_chars[feature_index]:end_chars[feature_index]]
+
+    return predictions
+
+
+def _stack_rows(rows, fill):
+    width = max(len(row) for row in rows)
+    result = np.full((len(rows), width), fill, dtype=rows[0].dtype)
+    for i, row in enumerate(rows):
+        result[i, :len(row)] = row
+    return result
+
+
+class StreamingDecoder:
+    '''
+    Decode answers on a worker thread while the model runs the next batch.
+
+    Logits are handed over per batch with put(). An example is decoded as soon
+    as all of its overflow windows have logits, its prediction is written to
+    output_fn as a json line and its logits are released, so memory depends on
+    the batch size rather than on the number of features. When only some of the
+    windows are predicted, feature_indexes lists them.
+    '''
+
+    def __init__(self, offset_mapping, feature_example_ids, example_ids, contexts, output_fn,
+                 n_best=20, max_answer_length=30, max_pending=4, feature_indexes=None):
+        self.offset_mapping = offset_mapping
+        self.feature_example_ids = feature_example_ids
+        self.n_best = n_best
+        self.max_answer_length = max_answer_length
+
+        self.example_ids = list(example_ids)
+        self.contexts = contexts
+        self.position = {example_id: i for i, example_id in enumerate(self.example_ids)}
+        if feature_indexes is None:
+            self.remaining = collections.Counter(feature_example_ids)
+        else:
+            self.remaining = collections.Counter(feature_example_ids[i] for i in feature_indexes)
+        self.n_written = 0
+
+        self.output = open(output_fn, 'w', encoding='utf-8')
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, feature_indexes, start_logits, end_logits):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((list(feature_indexes), np.asarray(start_logits), np.asarray(end_logits)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            # examples without any feature have nothing to decode
+            for example_id in self.example_ids:
+                if example_id not in self.remaining:
+                    self._write(example_id, "")
+        self.output.close()
+        if self.error is not None:
+            raise self.error
+        return self.n_written
+
+    def _write(self, example_id, text):
+        self.output.write(json.dumps({"id": example_id, "prediction_text": text}, ensure_ascii=False) + '\n')
+        self.n_written += 1
+
+    def _run(self):
+        pending = collections.defaultdict(list)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                feature_indexes, start_logits, end_logits = item
+
+                ready = []
+                for i, feature_index in enumerate(feature_indexes):
+                    example_id = self.feature_example_ids[feature_index]
+                    pending[example_id].append((feature_index, start_logits[i], end_logits[i]))
+                    self.remaining[example_id] -= 1
+                    if self.remaining[example_id] == 0:
+                        ready.append(example_id)
+
+                if len(ready) > 0:
+                    self._decode([(example_id, pending.pop(example_id)) for example_id in ready])
+                    self.output.flush()
+        except Exception as e:
+            self.error = e
+            # keep draining so that put() never blocks on a dead worker
+            while self.queue.get() is not None:
+                pass
+
+    def _decode(self, examples):
+        features = [feature for _, example_features in examples for feature in example_features]
+        start_logits = _stack_rows([start for _, start, _ in features], -np.inf)
+        end_logits = _stack_rows([end for _, _, end in features], -np.inf)
+        offsets = offsets_to_array([self.offset_mapping[i] for i, _, _ in features], start_logits.shape[1])
+
+        example_ids = [example_id for example_id, _ in examples]
+        contexts = [self.contexts[self.position[example_id]] if example_id in self.position else ""
+                    for example_id in example_ids]
+        predictions = postprocess_predictions(
+            start_logits,
+            end_logits,
+            offsets,
+            [self.feature_example_ids[i] for i, _, _ in features],
+            example_ids,
+            contexts,
+            n_best=self.n_best,
+            max_answer_length=self.max_answer_length)
+
+        for example_id, text in predictions.items():
+            if example_id in self.position:
+                self._write(example_id, text)
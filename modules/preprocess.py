@@ -1,7 +1,10 @@
 import os
+import sys
 import argparse
+import hashlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-import pickle
 
 import pandas as pd
 import numpy as np
@@ -10,6 +13,13 @@ from sklearn.model_selection import train_test_split
 from transformers import AutoTokenizer
 from transformers import AutoModelForQuestionAnswering
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.feature_cache import FeatureCache, tokenizer_fingerprint, example_key
+from modules.ingest import iter_json_array, flatten_train_rows, flatten_test_rows, TRAIN_FIELDS, TEST_FIELDS
+from modules.profiler import Profiler
+from modules.window_filter import build_window_index
+
 
 def define_argparser():
     p = argparse.ArgumentParser()
@@ -37,85 +47,121 @@ def define_argparser():
     
     p.add_argument('--max_length', type=int, default=384)
     p.add_argument('--stride', type=int, default=50)
+    p.add_argument('--chunk_size',
+                    type=int,
+                    default=1000,
+                    help="Number of examples tokenized and written to the feature store at once.")
+    p.add_argument('--num_workers',
+                    type=int,
+                    default=1,
+                    help="Number of processes tokenizing shards of chunk_size examples in parallel.")
+    p.add_argument('--cache_dir',
+                    default=None,
+                    help="Directory of the feature cache. Examples tokenized by earlier runs with the same tokenizer, max_length and stride are reused.")
+    p.add_argument('--cache_size_mb', type=int, default=4096)
+    p.add_argument('--window_index',
+                    action='store_true',
+                    help="Build a BM25 index over the overflow windows of the validation and test features, for inference.py --top_k_windows.")
+    p.add_argument('--profile_fn',
+                    default=None,
+                    help="Write wall time and peak memory per stage and the overflow windows per split to this json file.")
 
     config = p.parse_args()
     return config
 
+def _sequence_arrays(inputs, length):
+    # sequence ids of every feature as an (n_features, length) array, -1 for special tokens and padding
+    sequence_ids = np.full((len(inputs["input_ids"]), length), -1, dtype=np.int8)
+    for i in range(len(sequence_ids)):
+        row = np.array(inputs.sequence_ids(i), dtype=np.float32)
+        sequence_ids[i, :len(row)] = np.nan_to_num(row, nan=-1)
+    return sequence_ids
+
+
+def align_answer_positions(inputs, offset_mapping, sample_map, answer_starts, texts, cls_token_id):
+    '''
+    Token start/end positions of the answers of all features at once.
+
+    Features whose window does not contain the answer are labeled (0, 0) and
+    unanswerable examples are labeled at the cls token.
+    '''
+    n_features = len(offset_mapping)
+    length = max((len(offset) for offset in offset_mapping), default=0)
+    rows = np.arange(n_features)
+    sample_map = np.asarray(sample_map, dtype=np.int64)
+
+    offsets = np.full((n_features, length, 2), -1, dtype=np.int64)
+    input_ids = np.full((n_features, length), -1, dtype=np.int64)
+    for i, offset in enumerate(offset_mapping):
+        if len(offset) > 0:
+            offsets[i, :len(offset)] = [o if o is not None else (-1, -1) for o in offset]
+            input_ids[i, :len(offset)] = inputs["input_ids"][i]
+    sequence_ids = _sequence_arrays(inputs, length)
+
+    has_answer = np.array([len(answer_start) > 0 for answer_start in answer_starts], dtype=bool)[sample_map]
+    start_chars = np.array([answer_start[0] if len(answer_start) > 0 else 0 for answer_start in answer_starts], dtype=np.int64)
+    end_chars = start_chars + np.array([len(text[0]) if len(text) > 0 else 0 for text in texts], dtype=np.int64)
+    start_chars = start_chars[sample_map][:, None]
+    end_chars = end_chars[sample_map][:, None]
+
+    # first and last context token of every window
+    is_context = sequence_ids == 1
+    context_start = is_context.argmax(axis=1)
+    context_end = length - 1 - is_context[:, ::-1].argmax(axis=1)
+    positions = np.arange(length)[None, :]
+    in_context = (positions >= context_start[:, None]) & (positions <= context_end[:, None])
+
+    outside = ((offsets[rows, context_start, 0] > start_chars[:, 0])
+               | (offsets[rows, context_end, 1] < end_chars[:, 0]))
+
+    # last context token starting at or before start_char
+    after_start = in_context & (offsets[..., 0] > start_chars)
+    start_positions = np.where(after_start.any(axis=1), after_start.argmax(axis=1), context_end + 1) - 1
+
+    # first context token ending at or after end_char
+    before_end = in_context & (offsets[..., 1] < end_chars)
+    end_positions = np.where(before_end.any(axis=1), length - 1 - before_end[:, ::-1].argmax(axis=1), context_start - 1) + 1
+
+    start_positions = np.where(outside, 0, start_positions)
+    end_positions = np.where(outside, 0, end_positions)
+
+    cls_index = (input_ids == cls_token_id).argmax(axis=1)
+    start_positions = np.where(has_answer, start_positions, cls_index)
+    end_positions = np.where(has_answer, end_positions, cls_index)
+    return start_positions.tolist(), end_positions.tolist()
+
+
 # preprocess_training_example function
-def preprocess_training_examples(examples):
-    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+def preprocess_training_examples(examples, tokenizer, max_length, stride):
     inputs = tokenizer(
         examples["question"].tolist(),
         examples["context"].tolist(),
-        max_length= config.max_length,
+        max_length=max_length,
         truncation="only_second",
-        stride=config.stride,
+        stride=stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
-        padding="max_length",
     )
 
     offset_mapping = inputs.pop("offset_mapping")
     sample_map = inputs.pop("overflow_to_sample_mapping")
-    answer_starts = examples['answer_start']
-    texts = examples['text']
-    start_positions = []
-    end_positions = []
-
-    for i, offset in enumerate(offset_mapping):
-        input_ids = inputs["input_ids"][i]
-        cls_index = input_ids.index(tokenizer.cls_token_id)
-        sequence_ids = inputs.sequence_ids(i)
-        sample_idx = sample_map[i]
-        answer_start = answer_starts[sample_idx]
-        text = texts[sample_idx]
-
-        if len(answer_start) == 0:
-            start_positions.append(cls_index)
-            end_positions.append(cls_index)
-
-        else:
-            start_char = answer_start[0]
-            end_char = answer_start[0] + len(text[0])
-        
-            idx = 0
-            while sequence_ids[idx] != 1:
-                idx += 1
-            context_start = idx
-            while sequence_ids[idx] == 1:
-                idx += 1
-            context_end = idx - 1
-            
-            if offset[context_start][0] > start_char or offset[context_end][1] < end_char:
-                start_positions.append(0)
-                end_positions.append(0)
-            else:
-                idx = context_start
-                while idx <= context_end and offset[idx][0] <= start_char:
-                    idx += 1
-                start_positions.append(idx - 1)
-
-                idx = context_end
-                while idx >= context_start and offset[idx][1] >= end_char:
-                    idx -= 1
-                end_positions.append(idx + 1)
+    start_positions, end_positions = align_answer_positions(
+        inputs, offset_mapping, sample_map, examples['answer_start'].tolist(), examples['text'].tolist(), tokenizer.cls_token_id)
 
     inputs["start_positions"] = start_positions
     inputs["end_positions"] = end_positions
     return inputs
 
 # preprocess_validation_example function
-def preprocess_validation_examples(examples):
-    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+def preprocess_validation_examples(examples, tokenizer, max_length, stride):
     inputs = tokenizer(
-        examples["question"].tolist(),
-        examples["context"].tolist(),
-        max_length=config.max_length,
+        list(examples["question"]),
+        list(examples["context"]),
+        max_length=max_length,
         truncation="only_second",
-        stride=config.stride,
+        stride=stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
-        padding="max_length",
     )
 
     sample_map = inputs.pop("overflow_to_sample_mapping")
@@ -133,100 +179,291 @@ def preprocess_validation_examples(examples):
     return inputs
 
 
+def _pair_layout(tokenizer):
+    # special token ids and token types around the question (0) and the context (1)
+    # of a pair, probed on a dummy pair as fast tokenizers add them in the post processor
+    inputs = tokenizer("a", "b")
+    layout = []
+    for k, sequence_id in enumerate(inputs.sequence_ids(0)):
+        token_type = inputs["token_type_ids"][k] if "token_type_ids" in inputs else None
+        if sequence_id is None:
+            layout.append((None, inputs["input_ids"][k], token_type))
+        elif len(layout) == 0 or layout[-1][0] != sequence_id:
+            layout.append((sequence_id, None, token_type))
+    return layout
+
+
+def _window_starts(n_tokens, max_context_length, stride):
+    # overflow windows of only_second truncation: a window starts every
+    # max_context_length - stride tokens until one reaches the end of the context
+    if n_tokens > max_context_length and max_context_length <= stride:
+        raise ValueError('stride {} leaves no room for the context of a question, increase max_length'.format(stride))
+    starts = [0]
+    while starts[-1] + max_context_length < n_tokens:
+        starts.append(starts[-1] + max_context_length - stride)
+    return starts
+
+
+# preprocess_shared_context_example function
+def preprocess_shared_context_examples(examples, tokenizer, max_length, stride):
+    '''
+    The features of preprocess_validation_examples, built without tokenizing a
+    context once per question.
+
+    Every unique context of the shard is tokenized once, questions are tokenized
+    on their own and attached to the overflow windows of their context. Instead
+    of offset_mapping, context_offsets holds the offsets once per context and each
+    feature points into them with context_index/start/offset/length. context_keys
+    hash the contexts, so FeatureStoreWriter also stores a context shared by
+    several shards once.
+    '''
+    layout = _pair_layout(tokenizer)
+    n_special_tokens = sum(sequence_id is None for sequence_id, _, _ in layout)
+
+    contexts = pd.unique(examples["context"])
+    context_index = {context: i for i, context in enumerate(contexts)}
+    context_inputs = tokenizer(contexts.tolist(), add_special_tokens=False, return_offsets_mapping=True)
+    question_ids = tokenizer(examples["question"].tolist(), add_special_tokens=False)["input_ids"]
+
+    features = collections.defaultdict(list)
+    for example_id, question, context in zip(examples["question_id"], question_ids, examples["context"]):
+        index = context_index[context]
+        context_ids = context_inputs["input_ids"][index]
+        max_context_length = max_length - len(question) - n_special_tokens
+
+        for start in _window_starts(len(context_ids), max_context_length, stride):
+            window = context_ids[start:start + max_context_length]
+            input_ids = []
+            token_type_ids = []
+            for sequence_id, token_id, token_type in layout:
+                if sequence_id is None:
+                    tokens = [token_id]
+                elif sequence_id == 0:
+                    tokens = question
+                else:
+                    context_offset = len(input_ids)
+                    tokens = window
+                input_ids.extend(tokens)
+                token_type_ids.extend([token_type] * len(tokens))
+
+            features["input_ids"].append(input_ids)
+            if layout[0][2] is not None:
+                features["token_type_ids"].append(token_type_ids)
+            features["attention_mask"].append([1] * len(input_ids))
+            features["example_id"].append(example_id)
+            features["context_index"].append(index)
+            features["context_start"].append(start)
+            features["context_offset"].append(context_offset)
+            features["context_length"].append(len(window))
+
+    features["context_offsets"] = [np.asarray(offsets, dtype=np.int32).reshape(-1, 2) for offsets in context_inputs["offset_mapping"]]
+    features["context_keys"] = [hashlib.sha1(context.encode('utf-8')).hexdigest() for context in contexts]
+    return dict(features)
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(pretrained_model_name):
+    # each worker process loads the tokenizer once and tokenizes its shards single-threaded
+    global _worker_tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name)
+
+
+def _preprocess_shard(preprocess_fn, examples, max_length, stride):
+    return dict(preprocess_fn(examples, _worker_tokenizer, max_length, stride))
+
+
+def _map_ordered(executor, fn, iterable, max_pending):
+    # like executor.map, but keeps at most max_pending shards in flight
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def tokenize_shards(examples, preprocess_fn, config, tokenizer=None):
+    '''
+    Tokenize examples shard by shard and yield the features of every shard.
+    With config.num_workers > 1 shards are tokenized in a process pool and
+    yielded in their original order, so the output equals the serial one.
+    '''
+    shards = ((preprocess_fn, examples.iloc[begin:begin + config.chunk_size].reset_index(drop=True), config.max_length, config.stride)
+              for begin in range(0, len(examples), config.chunk_size))
+    n_shards = -(-len(examples) // config.chunk_size)
+
+    if config.num_workers > 1:
+        with ProcessPoolExecutor(config.num_workers, initializer=_init_worker, initargs=(config.pretrained_model_name,)) as executor:
+            yield from tqdm(_map_ordered(executor, _preprocess_shard, shards, config.num_workers * 2), total=n_shards)
+    else:
+        for fn, shard, max_length, stride in tqdm(shards, total=n_shards):
+            yield fn(shard, tokenizer, max_length, stride)
+
+
+def write_features(examples, preprocess_fn, path, config, tokenizer=None, profiler=None):
+    profiler = profiler or Profiler(enabled=False)
+    writer = FeatureStoreWriter(path)
+    for features in profiler.iterate('tokenization', tokenize_shards(examples, preprocess_fn, config, tokenizer)):
+        with profiler.stage('feature_io'):
+            writer.append(features)
+    with profiler.stage('feature_io'):
+        writer.close()
+
+
+# preprocess_cache_example function
+def preprocess_cache_examples(examples, tokenizer, max_length, stride):
+    '''
+    Features of every single example for the feature cache: offsets masked as in
+    preprocess_validation_examples, plus start/end labels when the examples have
+    answers, so the same entry serves the train and the validation split.
+    '''
+    inputs = tokenizer(
+        examples["question"].tolist(),
+        examples["context"].tolist(),
+        max_length=max_length,
+        truncation="only_second",
+        stride=stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+    )
+
+    sample_map = inputs.pop("overflow_to_sample_mapping")
+    offset_mapping = inputs.pop("offset_mapping")
+    for i in range(len(offset_mapping)):
+        sequence_ids = inputs.sequence_ids(i)
+        offset_mapping[i] = [o if k==0 or sequence_ids[k] == 1 else None for k, o in enumerate(offset_mapping[i])]
+
+    columns = {key: inputs[key] for key in inputs.keys()}
+    columns["offset_mapping"] = [
+        np.array([o if o is not None else (-1, -1) for o in offset], dtype=np.int32).reshape(-1, 2) for offset in offset_mapping]
+    if "answer_start" in examples:
+        columns["start_positions"], columns["end_positions"] = align_answer_positions(
+            inputs, offset_mapping, sample_map, examples['answer_start'].tolist(), examples['text'].tolist(), tokenizer.cls_token_id)
+
+    per_example = [collections.defaultdict(list) for _ in range(len(examples))]
+    for i, sample_idx in enumerate(sample_map):
+        for key, values in columns.items():
+            value = values[i]
+            per_example[sample_idx][key].append(np.asarray(value, dtype=np.int32) if isinstance(value, list) else value)
+    return {"features": [dict(features) for features in per_example]}
+
+
+def cache_features(examples, cache, fingerprint, config, tokenizer=None, profiler=None):
+    '''
+    Return the cache key of every example, tokenizing only examples missing from the cache.
+    '''
+    profiler = profiler or Profiler(enabled=False)
+    has_answers = "answer_start" in examples
+    keys = [
+        example_key(fingerprint, question, context, answer_start, text)
+        for question, context, answer_start, text in zip(
+            examples["question"],
+            examples["context"],
+            examples["answer_start"] if has_answers else [None] * len(examples),
+            examples["text"] if has_answers else [None] * len(examples))]
+
+    with profiler.stage('cache_io'):
+        cached = cache.contains(keys)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    print('{} of {} examples cached, tokenizing {}'.format(len(keys) - len(missing), len(keys), len(missing)))
+
+    missing_examples = examples.iloc[missing]
+    missing_keys = iter([keys[i] for i in missing])
+    for shard in profiler.iterate('tokenization', tokenize_shards(missing_examples, preprocess_cache_examples, config, tokenizer)):
+        with profiler.stage('cache_io'):
+            cache.put_many((next(missing_keys), features) for features in shard["features"])
+    return keys
+
+
+TRAIN_COLUMNS = ('input_ids', 'token_type_ids', 'attention_mask', 'start_positions', 'end_positions')
+EVAL_COLUMNS = ('input_ids', 'token_type_ids', 'attention_mask', 'offset_mapping', 'example_id')
+
+
+def write_cached_features(examples, columns, cache, path, chunk_size, profiler=None):
+    profiler = profiler or Profiler(enabled=False)
+    writer = FeatureStoreWriter(path)
+    for begin in tqdm(range(0, len(examples), chunk_size)):
+        chunk = examples.iloc[begin:begin + chunk_size]
+        with profiler.stage('cache_io'):
+            cached = cache.get_many(set(chunk["cache_key"]))
+
+        features = collections.defaultdict(list)
+        for key, example_id in zip(chunk["cache_key"], chunk["question_id"]):
+            example = cached[key]
+            for column in columns:
+                if column == "example_id":
+                    features[column].extend([example_id] * len(example["input_ids"]))
+                elif column in example:
+                    features[column].extend(example[column])
+        with profiler.stage('feature_io'):
+            writer.append(features)
+    with profiler.stage('feature_io'):
+        writer.close()
+
+
 def main(config):
     datapath = config.data_path
     savepath = config.save_path
 
-    # read data files into dataframe
-    train = pd.read_json(os.path.join(datapath, 'train.json'))
-    test = pd.read_json(os.path.join(datapath, 'test.json'))
-
-    # train data
-    cols = ['context', 'question_id', 'question', 'answer_start', 'text']
-
-    comp_list = []
-    for row in train['data']:
-        for i in range(len(row['paragraphs'])):
-            if len(row['paragraphs'][i]['qas'][0]['answers']) !=0:
-                temp_list = []
-                temp_list.append(row['paragraphs'][i]['context'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['question_id'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['question'])
-                temp_list.append([row['paragraphs'][i]['qas'][0]['answers'][0]['answer_start']])
-                temp_list.append([row['paragraphs'][i]['qas'][0]['answers'][0]['text']])
-                comp_list.append(temp_list)
-
-            else:
-                temp_list = []
-                temp_list.append(row['paragraphs'][i]['context'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['question_id'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['question'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['answers'])
-                temp_list.append(row['paragraphs'][i]['qas'][0]['answers'])
-                comp_list.append(temp_list)
-
-    train = pd.DataFrame(comp_list, columns=cols) 
-
-    # test data
-    cols = ['context', 'question_id', 'question']
-
-    comp_list = []
-    for row in test['data']:
-        for i in range(len(row['paragraphs'])):
-            for j in range(len(row['paragraphs'][i]['qas'])):
-                temp_list = []
-                temp_list.append(row['paragraphs'][i]['context'])
-                temp_list.append(row['paragraphs'][i]['qas'][j]['question_id'])
-                temp_list.append(row['paragraphs'][i]['qas'][j]['question'])
-                comp_list.append(temp_list)
-
-    test = pd.DataFrame(comp_list, columns=cols) 
-
-    # answer_start correction
-    text_comparision = []
-    for i in range(len(train['context'])):
-        if len(train['answer_start'][i]) !=0:
-            text_comparision.append([train['context'][i][train['answer_start'][i][0]: train['answer_start'][i][0]+len(train['text'][i][0])]])
-        else:
-            text_comparision.append(train['text'][i])
-
-    train['text_comparision'] = text_comparision
+    profiler = Profiler(enabled=config.profile_fn is not None)
 
-    answer_start = []
-    for i in range(len(train['answer_start'])):
-        if train['text'][i]!= train['text_comparision'][i]:
-            answer_start.append([train['answer_start'][i][0]+1])
-        else:
-            answer_start.append(train['answer_start'][i])
-
-    train['answer_start'] = answer_start
-    train = train.drop(['text_comparision'], axis=1)
+    # stream data files into flat records, answer_start is corrected while reading
+    with profiler.stage('flatten'):
+        train_rows = profiler.iterate('json_load', iter_json_array(os.path.join(datapath, 'train.json')))
+        test_rows = profiler.iterate('json_load', iter_json_array(os.path.join(datapath, 'test.json')))
+        train = pd.DataFrame.from_records(flatten_train_rows(train_rows), columns=TRAIN_FIELDS)
+        test = pd.DataFrame.from_records(flatten_test_rows(test_rows), columns=TEST_FIELDS)
     print('Train shape', train.shape)
 
+    # tokenize examples that are not in the feature cache yet
+    with profiler.stage('tokenizer_load'):
+        tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+    cache = None
+    if config.cache_dir is not None:
+        cache = FeatureCache(config.cache_dir, config.cache_size_mb * 2 ** 20)
+        fingerprint = tokenizer_fingerprint(tokenizer, config.max_length, config.stride)
+        train['cache_key'] = cache_features(train, cache, fingerprint, config, tokenizer, profiler)
+        test['cache_key'] = cache_features(test, cache, fingerprint, config, tokenizer, profiler)
+
     # train and validation split
     train, validation = train_test_split(train, test_size=config.test_size, random_state=42, shuffle=True)
     train = train.reset_index()
     validation = validation.reset_index(drop=True)
     print('train length: {}, validation length: {}'.format(len(train), len(validation)))
 
-    # preprocess data
-    preprocessed_train = preprocess_training_examples(train[0::])
-    preprocessed_validation = preprocess_validation_examples(validation[0::])
-    preprocessed_test = preprocess_validation_examples(test[0::])
- 
-    # save files
-    with open(os.path.join(savepath, 'preprocessed_train.pickle'),'wb') as fw:
-        pickle.dump(preprocessed_train, fw)
-
-    with open(os.path.join(savepath, 'preprocessed_validation.pickle'),'wb') as fw:
-        pickle.dump(preprocessed_validation, fw)
-
-    with open(os.path.join(savepath, 'preprocessed_test.pickle'),'wb') as fw:
-        pickle.dump(preprocessed_test, fw)
-
-    validation = validation.to_pickle(os.path.join(savepath, 'validation.pkl'))
-    test = test.to_pickle(os.path.join(savepath, 'test.pkl'))
+    # preprocess data and write feature stores
+    splits = (
+        ('train', train, preprocess_training_examples, TRAIN_COLUMNS),
+        ('validation', validation, preprocess_shared_context_examples, EVAL_COLUMNS),
+        ('test', test, preprocess_shared_context_examples, EVAL_COLUMNS),
+    )
+    for name, examples, preprocess_fn, columns in splits:
+        path = os.path.join(savepath, name + '_features')
+        if cache is None:
+            write_features(examples, preprocess_fn, path, config, tokenizer, profiler)
+        else:
+            write_cached_features(examples, columns, cache, path, config.chunk_size, profiler)
+        store = FeatureStore(path)
+        profiler.record_split(name, len(examples), len(store), store.meta['n_tokens'])
+        if config.window_index and name != 'train':
+            with profiler.stage('window_index'):
+                build_window_index(store, tokenizer.all_special_ids)
+
+    if cache is not None:
+        print('evicted {} cached examples'.format(cache.evict()))
+        cache.close()
+        validation = validation.drop(columns=['cache_key'])
+        test = test.drop(columns=['cache_key'])
+
+    with profiler.stage('pickle_io'):
+        validation = validation.to_pickle(os.path.join(savepath, 'validation.pkl'))
+        test = test.to_pickle(os.path.join(savepath, 'test.pkl'))
     print('finished preprocessing')
+    profiler.save(config.profile_fn)
 
 
 if __name__ == "__main__":
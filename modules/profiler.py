@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+
+import numpy as np
+
+
+def current_rss():
+    # resident set size of this process in bytes
+    try:
+        with open('/proc/self/statm') as fr:
+            return int(fr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss is the peak, not the current size, and in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_peak_rss():
+    # peak resident set size of the largest finished child process (e.g. tokenizer workers) in bytes
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+class PeakRSS:
+    '''
+    Sample the resident set size in a background thread and keep its maximum
+    while the context is active.
+    '''
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class Profiler:
+    '''
+    Wall time and peak memory of named stages, padding of model batches and
+    overflow windows of data splits, collected into one json report.
+
+    Stages may repeat and nest. seconds include nested stages, self_seconds do
+    not. Batches are counted for the innermost active stage. A disabled
+    profiler keeps the interface and records nothing.
+    '''
+
+    def __init__(self, enabled=True, trace_fn=None):
+        self.enabled = enabled
+        self.trace_fn = trace_fn
+        self.started = time.perf_counter()
+        self.stages = collections.OrderedDict()
+        self.batches = collections.OrderedDict()
+        self.splits = collections.OrderedDict()
+        self._active = []
+
+    def _push(self, name):
+        self._active.append([name, 0.])
+        return time.perf_counter()
+
+    def _pop(self, started, peak=None):
+        elapsed = time.perf_counter() - started
+        name, child_seconds = self._active.pop()
+        if self._active:
+            self._active[-1][1] += elapsed
+
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0., 'self_seconds': 0., 'peak_rss_mb': 0.})
+        stage['calls'] += 1
+        stage['seconds'] += elapsed
+        stage['self_seconds'] += elapsed - child_seconds
+        if peak is not None:
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak / 2 ** 20)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        with PeakRSS() as rss:
+            started = self._push(name)
+            try:
+                yield
+            finally:
+                rss.peak = max(rss.peak, current_rss())
+                self._pop(started, rss.peak)
+
+    def iterate(self, name, iterable):
+        '''
+        Yield from iterable, counting only the time spent producing items as the stage.
+        '''
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        with PeakRSS() as rss:
+            while True:
+                started = self._push(name)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._pop(started, rss.peak)
+                yield item
+
+    def record_batch(self, attention_mask):
+        '''
+        Count the real and padded tokens of a collated batch.
+        '''
+        if not self.enabled:
+            return
+        name = self._active[-1][0] if self._active else 'batches'
+        mask = np.asarray(attention_mask.cpu() if hasattr(attention_mask, 'cpu') else attention_mask)
+        self.batches.setdefault(name, []).append((mask.shape[0], int(mask.sum()), int(mask.size)))
+
+    def collator(self, collate_fn):
+        '''
+        Wrap a collate function so every batch it builds is recorded.
+        '''
+        def collate(features):
+            batch = collate_fn(features)
+            self.record_batch(batch['attention_mask'])
+            return batch
+        return collate
+
+    def record_split(self, name, n_examples, n_features, n_tokens=None):
+        if not self.enabled:
+            return
+        self.splits[name] = {
+            'n_examples': n_examples,
+            'n_features': n_features,
+            'features_per_example': n_features / n_examples if n_examples > 0 else None,
+            'overflow_features': n_features - n_examples,
+        }
+        if n_tokens is not None:
+            self.splits[name]['n_tokens'] = n_tokens
+            self.splits[name]['tokens_per_feature'] = n_tokens / n_features if n_features > 0 else None
+
+    def trace(self):
+        '''
+        torch profiler context writing a chrome trace to trace_fn, a no-op without trace_fn.
+        '''
+        if self.trace_fn is None:
+            return contextlib.nullcontext()
+        return _TorchTrace(self.trace_fn)
+
+    def report(self):
+        batches = collections.OrderedDict()
+        for name, rows in self.batches.items():
+            rows = np.array(rows, dtype=np.int64)
+            ratios = rows[:, 1] / np.maximum(rows[:, 2], 1)
+            seconds = self.stages[name]['seconds'] if name in self.stages else None
+            batches[name] = {
+                'n_batches': len(rows),
+                'n_features': int(rows[:, 0].sum()),
+                'real_tokens': int(rows[:, 1].sum()),
+                'pad_tokens': int(rows[:, 2].sum() - rows[:, 1].sum()),
+                'real_token_ratio': float(rows[:, 1].sum() / max(rows[:, 2].sum(), 1)),
+                'real_token_ratio_min': float(ratios.min()),
+                'real_token_ratio_p50': float(np.percentile(ratios, 50)),
+                'real_tokens_per_sec': float(rows[:, 1].sum() / seconds) if seconds else None,
+                'total_tokens_per_sec': float(rows[:, 2].sum() / seconds) if seconds else None,
+            }
+
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'peak_rss_mb': max([stage['peak_rss_mb'] for stage in self.stages.values()] + [current_rss() / 2 ** 20]),
+            'children_peak_rss_mb': children_peak_rss() / 2 ** 20,
+            'stages': self.stages,
+            'batches': batches,
+            'splits': self.splits,
+        }
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        with open(path, 'w') as fw:
+            json.dump(self.report(), fw, indent=2)
+        print('profile written to {}'.format(path))
+
+
+class _TorchTrace:
+
+    def __init__(self, trace_fn):
+        self.trace_fn = trace_fn
+
+    def __enter__(self):
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profile = torch.profiler.profile(activities=activities)
+        self.profile.__enter__()
+        return self.profile
+
+    def __exit__(self, *exc):
+        self.profile.__exit__(*exc)
+        self.profile.export_chrome_trace(self.trace_fn)
+        print('torch profiler trace written to {}'.format(self.trace_fn))
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from modules.dataset import QADatasetTest, batch_dataloader
+from modules.feature_store import FeatureStore
+from modules.modeling import predict_logits
+
+
+def shard_feature_order(feature_order, batch_size, n_shards):
+    '''
+    Split the single process feature order into n_shards contiguous runs of whole
+    batches, so every worker runs exactly the batches the single process would.
+    '''
+    n_batches = -(-len(feature_order) // batch_size)
+    bounds = np.linspace(0, n_batches, n_shards + 1).round().astype(int) * batch_size
+    return [feature_order[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _pin_threads(rank, n_threads):
+    torch.set_num_threads(n_threads)
+    # pin every worker to its own cores when there are enough of them
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= n_threads * (rank + 1):
+            os.sched_setaffinity(0, cores[rank * n_threads:(rank + 1) * n_threads])
+
+
+def _predict_shard(rank, model, store_path, shards, batch_size, pad_token_id, n_threads, start_logits, end_logits):
+    _pin_threads(rank, n_threads)
+    if not isinstance(model, torch.nn.Module):
+        # loader of a quantized or traced model, which can not be shared
+        model = model()
+
+    store = FeatureStore(store_path)
+    dataset = QADatasetTest(store['input_ids'], store['token_type_ids'], store['attention_mask'], pad_token_id)
+    feature_order = shards[rank]
+    dataloader = batch_dataloader(dataset, feature_order, batch_size)
+
+    n_features = 0
+    with torch.no_grad():
+        for batch in dataloader:
+            start_logit, end_logit = predict_logits(model, batch)
+            feature_indexes = feature_order[n_features:n_features + len(start_logit)]
+            start_logits[feature_indexes, :start_logit.shape[1]] = start_logit
+            end_logits[feature_indexes, :end_logit.shape[1]] = end_logit
+            n_features += len(start_logit)
+
+
+def predict_sharded(model, store_path, feature_order, batch_size, pad_token_id, num_workers, threads_per_worker=None):
+    '''
+    Start and end logits of all features of the feature store at store_path,
+    predicted by num_workers CPU processes.
+
+    model is an eager model, which is moved to shared memory and used by all
+    workers without copying, or a picklable function loading the model in every
+    worker (e.g. functools.partial(load_optimized_model, path)). Workers write
+    into shared logit arrays indexed by feature, so the merged result is in
+    feature order and equals the single process one.
+    '''
+    if threads_per_worker is None:
+        n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        threads_per_worker = max(1, n_cores // num_workers)
+
+    lengths = FeatureStore(store_path)['input_ids'].lengths()
+    start_logits = torch.full((len(lengths), lengths.max(initial=0)), -np.inf).share_memory_()
+    end_logits = torch.full((len(lengths), lengths.max(initial=0)), -np.inf).share_memory_()
+    if isinstance(model, torch.nn.Module):
+        model = model.cpu().eval().share_memory()
+
+    shards = shard_feature_order(list(feature_order), batch_size, num_workers)
+    mp.spawn(
+        _predict_shard,
+        args=(model, store_path, shards, batch_size, pad_token_id, threads_per_worker, start_logits, end_logits),
+        nprocs=num_workers,
+        join=True)
+    return start_logits.numpy(), end_logits.numpy()
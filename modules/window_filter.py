@@ -0,0 +1,129 @@
+import os
+import json
+
+import numpy as np
+
+from modules.feature_store import RaggedColumn
+from modules.logit_cache import store_fingerprint
+
+
+WINDOW_INDEX_FILE = 'window_index.json'
+WINDOW_TERMS_FILE = 'window_terms.bin'
+WINDOW_COUNTS_FILE = 'window_counts.bin'
+WINDOW_SPLITS_FILE = 'window_splits.bin'
+QUESTION_TERMS_FILE = 'question_terms.bin'
+QUESTION_SPLITS_FILE = 'question_splits.bin'
+
+
+def build_window_index(store, special_ids):
+    '''
+    Inverted index of the overflow windows of a feature store, written next to
+    its columns: the context subword ids of every window with their counts and
+    the question subword ids of every window. Special tokens are left out.
+    The index records the fingerprint of the store it was built from.
+    '''
+    special_ids = np.asarray(sorted(special_ids), dtype=np.int64)
+    input_ids = store['input_ids']
+    offset_mapping = store['offset_mapping']
+
+    window_splits, question_splits = [0], [0]
+    with open(os.path.join(store.path, WINDOW_TERMS_FILE), 'wb') as terms_file, \
+            open(os.path.join(store.path, WINDOW_COUNTS_FILE), 'wb') as counts_file, \
+            open(os.path.join(store.path, QUESTION_TERMS_FILE), 'wb') as questions_file:
+        for i in range(len(store)):
+            ids = np.asarray(input_ids[i])
+            is_context = np.asarray(offset_mapping[i])[:, 0] >= 0
+            # the first token keeps a (0, 0) offset for the no-answer span
+            is_context[0] = False
+            is_text = ~np.isin(ids, special_ids)
+
+            terms, counts = np.unique(ids[is_context & is_text], return_counts=True)
+            question = np.unique(ids[~is_context & is_text])
+            terms_file.write(terms.astype(np.int32).tobytes())
+            counts_file.write(counts.astype(np.int32).tobytes())
+            questions_file.write(question.astype(np.int32).tobytes())
+            window_splits.append(window_splits[-1] + len(terms))
+            question_splits.append(question_splits[-1] + len(question))
+
+    np.asarray(window_splits, dtype=np.int64).tofile(os.path.join(store.path, WINDOW_SPLITS_FILE))
+    np.asarray(question_splits, dtype=np.int64).tofile(os.path.join(store.path, QUESTION_SPLITS_FILE))
+    # written last, so an interrupted build is not used
+    with open(os.path.join(store.path, WINDOW_INDEX_FILE), 'w') as fw:
+        json.dump({'n_windows': len(store), 'n_postings': window_splits[-1], 'features': store_fingerprint(store)}, fw, indent=2)
+
+
+class WindowIndex:
+    '''
+    Read-only view of the index written by build_window_index.
+    '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, WINDOW_INDEX_FILE)) as fr:
+            self.meta = json.load(fr)
+        window_splits = np.fromfile(os.path.join(path, WINDOW_SPLITS_FILE), dtype=np.int64)
+        question_splits = np.fromfile(os.path.join(path, QUESTION_SPLITS_FILE), dtype=np.int64)
+        self.terms = RaggedColumn(os.path.join(path, WINDOW_TERMS_FILE), np.int32, 1, window_splits)
+        self.counts = RaggedColumn(os.path.join(path, WINDOW_COUNTS_FILE), np.int32, 1, window_splits)
+        self.questions = RaggedColumn(os.path.join(path, QUESTION_TERMS_FILE), np.int32, 1, question_splits)
+
+    @staticmethod
+    def exists(store):
+        '''
+        Whether the store has an index built from its current features. An index
+        left from before preprocess.py rewrote the store without --window_index
+        does not count.
+        '''
+        index_fn = os.path.join(store.path, WINDOW_INDEX_FILE)
+        if not os.path.exists(index_fn):
+            return False
+        with open(index_fn) as fr:
+            return json.load(fr).get('features') == store_fingerprint(store)
+
+    def __len__(self):
+        return self.meta['n_windows']
+
+    def scores(self, k1=1.2, b=.75):
+        '''
+        BM25 score of every window for the question of its feature. Document
+        frequencies are counted over all windows of the store.
+        '''
+        n_windows = len(self)
+        terms = self.terms.values.astype(np.int64)
+        counts = self.counts.values.astype(np.float64)
+        questions = self.questions.values.astype(np.int64)
+        if len(terms) == 0 or len(questions) == 0:
+            return np.zeros(n_windows, dtype=np.float32)
+
+        # window of every posting and every question term
+        windows = np.repeat(np.arange(n_windows), self.terms.lengths())
+        question_windows = np.repeat(np.arange(n_windows), self.questions.lengths())
+
+        n_terms = int(max(terms.max(), questions.max())) + 1
+        df = np.bincount(terms, minlength=n_terms)
+        idf = np.log(1 + (n_windows - df + .5) / (df + .5))
+        window_lengths = np.bincount(windows, weights=counts, minlength=n_windows)
+        norm = k1 * (1 - b + b * window_lengths / max(window_lengths.mean(), 1.))
+
+        # postings whose term is in the question of the same window
+        matches = np.isin(windows * n_terms + terms, question_windows * n_terms + questions)
+        weights = idf[terms] * counts * (k1 + 1) / (counts + norm[windows])
+        return np.bincount(windows[matches], weights=weights[matches], minlength=n_windows).astype(np.float32)
+
+
+def select_windows(scores, example_index, top_k):
+    '''
+    Mask of the top_k highest scoring windows of every example, earlier windows
+    win ties. Examples with at most top_k windows keep all of them.
+    '''
+    scores = np.asarray(scores)
+    example_index = np.asarray(example_index)
+    keep = np.zeros(len(scores), dtype=bool)
+    if len(scores) == 0:
+        return keep
+
+    order = np.lexsort((np.arange(len(scores)), -scores, example_index))
+    grouped = example_index[order]
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    keep[order[rank < top_k]] = True
+    return keep
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import argparse
+import itertools
+
+import pandas as pd
+import numpy as np
+import torch
+
+from transformers import AutoTokenizer
+
+from modules.dataset import QADatasetValid, QADatasetTest
+from modules.dataset import LengthGroupedSampler, DynamicPaddingCollator, batch_dataloader
+from modules.feature_store import FeatureStore
+from modules.metrics import compute_metrics
+from modules.modeling import load_model, quantize_model, trace_model, save_optimized_model, load_optimized_model, predict_logits
+
+
+def define_argparser():
+    '''
+    Define argument parser to export a CPU-optimized model and compare it with the fp32 model.
+    '''
+    p = argparse.ArgumentParser()
+    sub = p.add_subparsers(dest='command', required=True)
+
+    export = sub.add_parser('export', help="Export a dynamically quantized and/or traced model.")
+    export.add_argument('--model_fn', required=True)
+    export.add_argument('--pretrained_model_name', required=True)
+    export.add_argument('--file_path',
+                    required=True,
+                    help="Directory where preprocessed data files located. Validation features are used as trace inputs.")
+    export.add_argument('--output_fn', required=True)
+    export.add_argument('--quantize', action='store_true', help="Quantize Linear layers to int8.")
+    export.add_argument('--trace', action='store_true', help="Save a TorchScript traced module.")
+    export.add_argument('--batch_size', type=int, default=16)
+
+    compare = sub.add_parser('compare', help="Compare throughput, latency and exact/F1 of the fp32 and optimized models.")
+    compare.add_argument('--model_fn', required=True)
+    compare.add_argument('--pretrained_model_name', required=True)
+    compare.add_argument('--optimized_fn', required=True)
+    compare.add_argument('--file_path', required=True)
+    compare.add_argument('--batch_size', type=int, default=16)
+    compare.add_argument('--n_best', type=int, default=5)
+    compare.add_argument('--max_answer_length', type=int, default=40)
+    compare.add_argument('--n_threads', type=int, default=None)
+    compare.add_argument('--report_fn', default=None, help="Also write the report to this json file.")
+
+    config = p.parse_args()
+
+    return config
+
+
+def run_model(model, features, batch_size, pad_token_id, n_warmup=2):
+    '''
+    Logits of all features in their original order and the latency of every batch.
+    The first batch is run n_warmup times beforehand, so TorchScript profiling
+    runs are not timed.
+    '''
+    lengths = features['input_ids'].lengths()
+    dataset = QADatasetTest(features['input_ids'], features['token_type_ids'], features['attention_mask'], pad_token_id)
+    feature_order = list(LengthGroupedSampler(lengths, batch_size, shuffle=False))
+    dataloader = batch_dataloader(dataset, feature_order, batch_size)
+
+    start_logits = np.full((len(dataset), lengths.max(initial=0)), -np.inf, dtype=np.float32)
+    end_logits = np.full((len(dataset), lengths.max(initial=0)), -np.inf, dtype=np.float32)
+    latencies = []
+    n_features = 0
+    with torch.no_grad():
+        for batch in itertools.islice(dataloader, 1):
+            for _ in range(n_warmup):
+                predict_logits(model, batch)
+
+        for batch in dataloader:
+            started = time.perf_counter()
+            start_logit, end_logit = predict_logits(model, batch)
+            latencies.append(time.perf_counter() - started)
+
+            feature_indexes = feature_order[n_features:n_features + len(start_logit)]
+            start_logits[feature_indexes, :start_logit.shape[1]] = start_logit.numpy()
+            end_logits[feature_indexes, :end_logit.shape[1]] = end_logit.numpy()
+            n_features += len(start_logit)
+
+    return start_logits, end_logits, np.array(latencies)
+
+
+def export(config):
+    if not (config.quantize or config.trace):
+        raise ValueError('Set --quantize and/or --trace.')
+
+    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+    model = load_model(config.model_fn, config.pretrained_model_name)
+
+    if config.quantize:
+        model = quantize_model(model)
+    if config.trace:
+        valid = FeatureStore(os.path.join(config.file_path, 'validation_features'))
+        dataset = QADatasetTest(valid['input_ids'], valid['token_type_ids'], valid['attention_mask'])
+        batch = DynamicPaddingCollator(tokenizer.pad_token_id)([dataset[i] for i in range(min(config.batch_size, len(dataset)))])
+        model = trace_model(model, batch)
+
+    save_optimized_model(model, config.output_fn)
+    print('optimized model saved to {} ({:.1f} MB)'.format(config.output_fn, os.path.getsize(config.output_fn) / 2 ** 20))
+
+
+def compare(config):
+    if config.n_threads is not None:
+        torch.set_num_threads(config.n_threads)
+
+    valid = FeatureStore(os.path.join(config.file_path, 'validation_features'))
+    validation = pd.read_pickle(os.path.join(config.file_path, 'validation.pkl'))
+    validation_dataset = QADatasetValid(valid['input_ids'], valid['token_type_ids'], valid['attention_mask'], valid['offset_mapping'], valid['example_id'])
+    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+
+    models = {
+        'fp32': load_model(config.model_fn, config.pretrained_model_name),
+        'optimized': load_optimized_model(config.optimized_fn),
+    }
+
+    report = {}
+    for name, model in models.items():
+        start_logits, end_logits, latencies = run_model(model, valid, config.batch_size, tokenizer.pad_token_id)
+        report[name] = {
+            'features_per_sec': len(valid) / latencies.sum(),
+            'latency_ms_p50': float(np.percentile(latencies, 50) * 1000),
+            'latency_ms_p95': float(np.percentile(latencies, 95) * 1000),
+            **compute_metrics(start_logits, end_logits, validation_dataset, validation, config.n_best, config.max_answer_length),
+        }
+
+    report['delta'] = {
+        'speedup': report['optimized']['features_per_sec'] / report['fp32']['features_per_sec'],
+        'exact': report['optimized']['exact'] - report['fp32']['exact'],
+        'f1': report['optimized']['f1'] - report['fp32']['f1'],
+    }
+    print(json.dumps(report, indent=2))
+
+    if config.report_fn is not None:
+        with open(config.report_fn, 'w') as fw:
+            json.dump(report, fw, indent=2)
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    if config.command == 'export':
+        export(config)
+    else:
+        compare(config)
@@ -0,0 +1,301 @@
+import json
+import time
+import queue
+import argparse
+import threading
+import itertools
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from transformers import AutoTokenizer
+from transformers import AutoModelForQuestionAnswering
+
+from modules.dataset import DynamicPaddingCollator
+from modules.modeling import predict_logits
+from modules.postprocess import offsets_to_array, postprocess_predictions
+from modules.preprocess import preprocess_validation_examples
+
+
+def define_argparser():
+    '''
+    Define argument parser to serve a fine-tuned model over http.
+    '''
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--model_fn', required=True)
+    p.add_argument('--pretrained_model_name', required=True)
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--max_length', type=int, default=384)
+    p.add_argument('--stride', type=int, default=50)
+    p.add_argument('--n_best', type=int, default=5)
+    p.add_argument('--max_answer_length', type=int, default=40)
+    p.add_argument('--max_batch_size',
+                    type=int,
+                    default=16,
+                    help="Maximum number of features in one forward pass.")
+    p.add_argument('--max_wait_ms',
+                    type=float,
+                    default=10.,
+                    help="Latency budget to wait for more requests before running a micro-batch.")
+    p.add_argument('--stats_window',
+                    type=int,
+                    default=10000,
+                    help="Number of latest requests and forward passes GET /stats summarizes.")
+
+    config = p.parse_args()
+
+    return config
+
+
+class BadRequest(ValueError):
+    '''
+    A request that can not be answered, e.g. a question longer than --max_length.
+    '''
+
+
+class _Request:
+
+    def __init__(self, request_id, question, context):
+        self.request_id = request_id
+        self.question = question
+        self.context = context
+        self.arrived = time.perf_counter()
+        self.features = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    '''
+    Collect concurrent (question, context) requests into micro-batches.
+
+    The worker thread tokenizes every request on its own with the overflow/stride
+    logic of preprocess_validation_examples, so an invalid request fails alone.
+    It waits for a first request, then keeps collecting requests until
+    max_wait_ms has passed or max_batch_size features are queued, and answers
+    them by the same forward passes.
+    '''
+
+    def __init__(self, model, tokenizer, config):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.config = config
+        self.device = next(model.parameters()).device
+        self.collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+
+        self.queue = queue.Queue()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        # totals since start, latencies and batch fills of the latest ones only
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = collections.deque(maxlen=config.stats_window)
+        self.batch_fills = collections.deque(maxlen=config.stats_window)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def answer(self, question, context):
+        request = _Request(next(self.ids), question, context)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        with self.lock:
+            n_requests, n_batches = self.n_requests, self.n_batches
+            latencies = np.array(self.latencies)
+            batch_fills = np.array(self.batch_fills)
+        if len(latencies) == 0:
+            return {'n_requests': 0, 'n_batches': 0}
+        return {
+            'n_requests': n_requests,
+            'n_batches': n_batches,
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p95': float(np.percentile(latencies, 95)),
+            'latency_ms_max': float(latencies.max()),
+            'batch_fill_mean': float(batch_fills.mean()),
+        }
+
+    def _tokenize(self, request):
+        examples = {'question_id': [request.request_id], 'question': [request.question], 'context': [request.context]}
+        try:
+            return preprocess_validation_examples(examples, self.tokenizer, self.config.max_length, self.config.stride)
+        except Exception as e:
+            raise BadRequest(str(e)) from e
+
+    def _collect(self):
+        requests = []
+        deadline = None
+        # the last request may overflow max_batch_size, its extra windows go
+        # into one more forward pass
+        n_features = 0
+        while n_features < self.config.max_batch_size:
+            if deadline is None:
+                request = self.queue.get()
+            else:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            try:
+                request.features = self._tokenize(request)
+            except BadRequest as e:
+                request.error = e
+                request.done.set()
+                continue
+            if deadline is None:
+                deadline = request.arrived + self.config.max_wait_ms / 1000
+            requests.append(request)
+            n_features += len(request.features['input_ids'])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            try:
+                self._answer(requests)
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            for request in requests:
+                request.done.set()
+
+    @torch.no_grad()
+    def _answer(self, requests):
+        model_inputs = [key for key in ('input_ids', 'token_type_ids', 'attention_mask') if key in requests[0].features]
+        features = {
+            key: list(itertools.chain.from_iterable(request.features[key] for request in requests))
+            for key in model_inputs + ['offset_mapping', 'example_id']
+        }
+        n_features = len(features['input_ids'])
+
+        start_logits = []
+        end_logits = []
+        batch_fills = []
+        for begin in range(0, n_features, self.config.max_batch_size):
+            end = min(begin + self.config.max_batch_size, n_features)
+            batch = self.collator([{key: features[key][i] for key in model_inputs} for i in range(begin, end)])
+            batch = {key: value.to(self.device) for key, value in batch.items()}
+            # padding gets -inf logits, so the answer does not depend on the other requests of the batch
+            batch_start_logits, batch_end_logits = predict_logits(self.model, batch)
+            start_logits.append(batch_start_logits.cpu().numpy())
+            end_logits.append(batch_end_logits.cpu().numpy())
+            batch_fills.append((end - begin) / self.config.max_batch_size)
+
+        width = max(logits.shape[1] for logits in start_logits)
+        start_logits = np.concatenate([np.pad(logits, ((0, 0), (0, width - logits.shape[1])), constant_values=-np.inf) for logits in start_logits])
+        end_logits = np.concatenate([np.pad(logits, ((0, 0), (0, width - logits.shape[1])), constant_values=-np.inf) for logits in end_logits])
+
+        predictions = postprocess_predictions(
+            start_logits,
+            end_logits,
+            offsets_to_array(features['offset_mapping'], width),
+            features['example_id'],
+            [request.request_id for request in requests],
+            [request.context for request in requests],
+            n_best=self.config.n_best,
+            max_answer_length=self.config.max_answer_length)
+
+        finished = time.perf_counter()
+        with self.lock:
+            self.n_requests += len(requests)
+            self.n_batches += len(batch_fills)
+            self.batch_fills.extend(batch_fills)
+            for request in requests:
+                latency = (finished - request.arrived) * 1000
+                self.latencies.append(latency)
+                request.result = {
+                    'answer': predictions[request.request_id],
+                    'latency_ms': latency,
+                    'n_requests_in_batch': len(requests),
+                    'n_features_in_batch': n_features,
+                    'batch_fill': float(np.mean(batch_fills)),
+                }
+
+
+def make_handler(batcher):
+
+    class QAHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, batcher.stats())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/answer':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                question, context = body['question'], body['context']
+            except (ValueError, KeyError, TypeError):
+                self._send(400, {'error': 'expected a json object with question and context'})
+                return
+            if not isinstance(question, str) or not isinstance(context, str):
+                self._send(400, {'error': 'question and context must be strings'})
+                return
+            try:
+                self._send(200, batcher.answer(question, context))
+            except BadRequest as e:
+                self._send(400, {'error': str(e)})
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return QAHandler
+
+
+def main(config):
+    saved_data = torch.load(
+        config.model_fn,
+        map_location='cuda:0' if torch.cuda.is_available() else 'cpu'
+    )
+
+    # Declare model and load pre-trained weights once for the lifetime of the server.
+    tokenizer = AutoTokenizer.from_pretrained(config.pretrained_model_name)
+    model = AutoModelForQuestionAnswering.from_pretrained(config.pretrained_model_name)
+    model.load_state_dict(saved_data)
+
+    if torch.cuda.is_available():
+        model.cuda()
+    model.eval()
+
+    batcher = MicroBatcher(model, tokenizer, config)
+    server = ThreadingHTTPServer((config.host, config.port), make_handler(batcher))
+    print('serving on http://{}:{} (POST /answer, GET /stats)'.format(config.host, config.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats()))
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    main(config)
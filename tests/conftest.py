@@ -0,0 +1,24 @@
+import os
+import sys
+import string
+import itertools
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def tokenizer(tmp_path_factory):
+    '''
+    WordPiece tokenizer over the letters a-e, so random words split into several
+    subwords and answers may start or end inside a token.
+    '''
+    from transformers import BertTokenizerFast
+
+    letters = 'abcde'
+    words = [''.join(word) for n in (1, 2) for word in itertools.product(letters, repeat=n)]
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list(string.punctuation) + words + ['##' + word for word in words]
+    vocab_fn = tmp_path_factory.mktemp('tokenizer') / 'vocab.txt'
+    vocab_fn.write_text('\n'.join(vocab), encoding='utf-8')
+    return BertTokenizerFast(str(vocab_fn))
@@ -0,0 +1,78 @@
+import copy
+import json
+
+import numpy as np
+import torch
+
+from transformers import BertConfig, BertForQuestionAnswering
+
+from modules.autotune import model_fingerprint, resolve_setting
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.modeling import quantize_model, trace_model
+
+
+def tiny_model(num_hidden_layers=2, seed=0):
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=num_hidden_layers, num_attention_heads=2, intermediate_size=37)
+    return BertForQuestionAnswering(config).eval()
+
+
+def traced(model, tmp_path, name):
+    # traced models are saved and loaded again, as inference.py loads them
+    ids = torch.randint(5, 100, (2, 16))
+    path = str(tmp_path / (name + '.pt'))
+    torch.jit.save(trace_model(model, {'input_ids': ids, 'token_type_ids': torch.zeros_like(ids), 'attention_mask': torch.ones_like(ids)}), path)
+    return torch.jit.load(path)
+
+
+def test_optimized_models_have_their_own_fingerprint(tmp_path):
+    fingerprints = {
+        'eager': model_fingerprint(tiny_model()),
+        'quantized': model_fingerprint(quantize_model(tiny_model())),
+        'traced': model_fingerprint(traced(tiny_model(), tmp_path, 'traced')),
+        'quantized+traced': model_fingerprint(traced(quantize_model(tiny_model()), tmp_path, 'quantized_traced')),
+        'traced, 4 layers': model_fingerprint(traced(tiny_model(4), tmp_path, 'traced_4')),
+        'quantized+traced, 4 layers': model_fingerprint(traced(quantize_model(tiny_model(4)), tmp_path, 'quantized_traced_4')),
+    }
+    keys = {json.dumps(fingerprint, sort_keys=True) for fingerprint in fingerprints.values()}
+    assert len(keys) == len(fingerprints)
+
+    # fine-tuned weights of the same model share a fingerprint
+    assert model_fingerprint(tiny_model(seed=1)) == fingerprints['eager']
+    assert model_fingerprint(traced(tiny_model(seed=1), tmp_path, 'traced_seed_1')) == fingerprints['traced']
+    assert model_fingerprint(traced(quantize_model(tiny_model(seed=1)), tmp_path, 'quantized_traced_seed_1')) == fingerprints['quantized+traced']
+
+
+def test_resolve_setting_probes_and_caches_training(tmp_path):
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(8, 40, size=40)
+    writer = FeatureStoreWriter(str(tmp_path / 'train'))
+    writer.append({
+        'input_ids': [rng.integers(5, 100, size=length).tolist() for length in lengths],
+        'token_type_ids': [[0] * length for length in lengths],
+        'attention_mask': [[1] * length for length in lengths],
+        'start_positions': rng.integers(0, 8, size=len(lengths)).tolist(),
+        'end_positions': rng.integers(0, 8, size=len(lengths)).tolist(),
+    })
+    writer.close()
+    store = FeatureStore(str(tmp_path / 'train'))
+    model = tiny_model()
+    weights = copy.deepcopy(model.state_dict())
+    autotune_fn = str(tmp_path / 'autotune.json')
+
+    assert resolve_setting(model, store, autotune_fn, train=True) is None
+    setting = resolve_setting(model, store, autotune_fn, probe=True, train=True, batch_sizes=(2, 4), thread_settings=[(1, 1)], n_batches=1)
+    assert setting['batch_size'] in (2, 4)
+    assert (setting['intra_op_threads'], setting['inter_op_threads']) == (1, 1)
+    with open(autotune_fn) as fr:
+        entry, = json.load(fr).values()
+    assert entry['fingerprint']['mode'] == 'train'
+    assert [result['batch_size'] for result in entry['results']] == [2, 4]
+
+    # the optimizer steps of the probe run on a copy
+    for name, value in model.state_dict().items():
+        assert torch.equal(value, weights[name])
+
+    # later runs read the cached setting, which is not shared with inference
+    assert resolve_setting(model, store, autotune_fn, train=True) == setting
+    assert resolve_setting(model, store, autotune_fn) is None
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+
+from transformers import BertConfig, BertForQuestionAnswering
+
+from modules.dataset import QADataset, LengthGroupedSampler, DynamicPaddingCollator, batch_dataloader
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+
+
+def random_features(rng, n_features=200, max_length=64):
+    lengths = rng.integers(8, max_length + 1, size=n_features)
+    input_ids = [rng.integers(5, 100, size=length).tolist() for length in lengths]
+    token_type_ids = [[0] * (length // 2) + [1] * (length - length // 2) for length in lengths]
+    attention_mask = [[1] * length for length in lengths]
+    start_positions = rng.integers(0, 8, size=n_features).tolist()
+    end_positions = rng.integers(0, 8, size=n_features).tolist()
+    return input_ids, token_type_ids, attention_mask, start_positions, end_positions
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_length_grouped_sampler_yields_every_feature_once(shuffle):
+    lengths = np.random.default_rng(0).integers(1, 100, size=1001)
+    sampler = LengthGroupedSampler(lengths, batch_size=16, shuffle=shuffle, mega_batch_mult=4)
+    for _ in range(3):
+        indices = list(sampler)
+        assert len(indices) == len(sampler)
+        assert sorted(indices) == list(range(len(lengths)))
+
+
+def test_length_grouped_sampler_reshuffles_every_epoch():
+    lengths = np.random.default_rng(0).integers(1, 100, size=500)
+    sampler = LengthGroupedSampler(lengths, batch_size=16, seed=1)
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    assert list(LengthGroupedSampler(lengths, batch_size=16, seed=1)) == first
+
+
+def test_length_grouped_sampler_reduces_padding():
+    lengths = np.random.default_rng(0).integers(1, 384, size=2000)
+    batch_size = 16
+
+    def padded_tokens(indices):
+        batches = [lengths[indices[i:i + batch_size]] for i in range(0, len(indices), batch_size)]
+        return sum(len(batch) * batch.max() for batch in batches)
+
+    grouped = padded_tokens(np.array(list(LengthGroupedSampler(lengths, batch_size))))
+    shuffled = padded_tokens(np.random.default_rng(1).permutation(len(lengths)))
+    assert grouped < .75 * shuffled
+
+    # without shuffling, a single mega batch comes out sorted by decreasing length
+    ordered = list(LengthGroupedSampler(lengths, batch_size, shuffle=False, mega_batch_mult=len(lengths)))
+    assert (np.diff(lengths[ordered]) <= 0).all()
+
+
+def test_dynamic_padding_collator_pads_to_the_longest_feature():
+    features = [
+        {'input_ids': [5, 6, 7], 'token_type_ids': [0, 0, 1], 'attention_mask': [1, 1, 1], 'start_positions': 1, 'end_positions': 2},
+        {'input_ids': [8], 'token_type_ids': [0], 'attention_mask': [1], 'start_positions': 0, 'end_positions': 0},
+    ]
+    batch = DynamicPaddingCollator(pad_token_id=3)(features)
+    assert batch['input_ids'].tolist() == [[5, 6, 7], [8, 3, 3]]
+    assert batch['token_type_ids'].tolist() == [[0, 0, 1], [0, 0, 0]]
+    assert batch['attention_mask'].tolist() == [[1, 1, 1], [1, 0, 0]]
+    assert batch['start_positions'].tolist() == [1, 0]
+
+    batch = DynamicPaddingCollator(pad_token_id=3, pad_to_multiple_of=8)(features)
+    assert batch['input_ids'].shape == (2, 8)
+
+
+def test_dynamic_padding_keeps_the_logits_of_max_length_padding():
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=37)
+    model = BertForQuestionAnswering(config).eval()
+    input_ids, token_type_ids, attention_mask, start_positions, end_positions = random_features(np.random.default_rng(0), n_features=8)
+    dataset = QADataset(input_ids, token_type_ids, attention_mask, start_positions, end_positions)
+    features = [dataset[i] for i in range(len(dataset))]
+    lengths = [len(ids) for ids in input_ids]
+
+    with torch.no_grad():
+        dynamic = model(**DynamicPaddingCollator()(features))
+        # the original padding='max_length' features
+        padded = model(**DynamicPaddingCollator(pad_to_multiple_of=128)(features))
+    for i, length in enumerate(lengths):
+        assert torch.allclose(dynamic.start_logits[i, :length], padded.start_logits[i, :length], atol=1e-5)
+        assert torch.allclose(dynamic.end_logits[i, :length], padded.end_logits[i, :length], atol=1e-5)
+
+
+@pytest.mark.parametrize('from_store', [False, True])
+def test_batch_indexing_matches_item_collation(tmp_path, from_store):
+    columns = random_features(np.random.default_rng(0))
+    if from_store:
+        writer = FeatureStoreWriter(str(tmp_path))
+        writer.append(dict(zip(('input_ids', 'token_type_ids', 'attention_mask', 'start_positions', 'end_positions'), columns)))
+        writer.close()
+        store = FeatureStore(str(tmp_path))
+        columns = [store[name] for name in ('input_ids', 'token_type_ids', 'attention_mask', 'start_positions', 'end_positions')]
+    dataset = QADataset(*columns, pad_token_id=3)
+    collator = DynamicPaddingCollator(pad_token_id=3)
+
+    feature_order = list(LengthGroupedSampler(columns[0].lengths() if from_store else [len(ids) for ids in columns[0]], 16))
+    batches = list(batch_dataloader(dataset, feature_order, 16))
+    assert len(batches) == -(-len(dataset) // 16)
+    for begin, batch in zip(range(0, len(feature_order), 16), batches):
+        expected = collator([dataset[i] for i in feature_order[begin:begin + 16]])
+        assert batch.keys() == expected.keys()
+        for key in expected:
+            assert torch.equal(batch[key], expected[key])
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.logit_cache import LogitCache, checkpoint_fingerprint, ensemble_fingerprint
+
+
+def write_store(path, n_features, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(4, 20, size=n_features)
+    writer = FeatureStoreWriter(str(path))
+    writer.append({'input_ids': [rng.integers(5, 100, size=length).tolist() for length in lengths]})
+    writer.close()
+    return FeatureStore(str(path))
+
+
+def write_logits(store, checkpoint, seed=0):
+    rng = np.random.default_rng(seed)
+    longest = int(store['input_ids'].lengths().max())
+    cache = LogitCache(store, checkpoint)
+    cache.save(rng.standard_normal((len(store), longest)), rng.standard_normal((len(store), longest)))
+    return cache
+
+
+def logits_files(store):
+    return sorted(name for name in os.listdir(store.path) if name.startswith('logits_'))
+
+
+def test_logit_cache_replaces_stale_logits(tmp_path):
+    small_fn, large_fn = str(tmp_path / 'small.pt'), str(tmp_path / 'large.pt')
+    for fn in (small_fn, large_fn):
+        with open(fn, 'wb') as fw:
+            fw.write(b'weights')
+    store = write_store(tmp_path / 'valid', 30)
+
+    small = write_logits(store, checkpoint_fingerprint(small_fn))
+    large = write_logits(store, checkpoint_fingerprint(large_fn))
+    ensemble = write_logits(store, ensemble_fingerprint([small_fn, large_fn]))
+    # every checkpoint keeps its own logits
+    assert len(logits_files(store)) == 6
+    start_logits, end_logits = small.load()
+    assert np.isneginf(start_logits[store['input_ids'].lengths() < start_logits.shape[1], -1]).all()
+
+    # retraining overwrites the weights file, which replaces its logits and those of the ensemble
+    with open(small_fn, 'wb') as fw:
+        fw.write(b'retrained weights')
+    retrained = write_logits(store, checkpoint_fingerprint(small_fn), seed=1)
+    assert logits_files(store) == sorted(os.path.basename(fn) for cache in (large, retrained) for fn in (cache.logits_fn, cache.meta_fn))
+    assert not small.exists() and not ensemble.exists()
+    assert large.exists() and retrained.exists()
+
+    # a removed weights file and a new preprocessing run leave only the new logits
+    os.remove(large_fn)
+    store = write_store(tmp_path / 'valid', 40, seed=1)
+    rewritten = write_logits(store, checkpoint_fingerprint(small_fn))
+    assert logits_files(store) == sorted(os.path.basename(fn) for fn in (rewritten.logits_fn, rewritten.meta_fn))
+    assert rewritten.load()[0].shape[0] == 40
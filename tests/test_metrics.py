@@ -0,0 +1,107 @@
+import re
+import string
+import collections
+
+import numpy as np
+import pytest
+
+from modules.metrics import SquadV2Scorer
+
+
+# normalize_answer, get_tokens, compute_exact and compute_f1 of the official SQuAD v2.0 evaluation script
+def official_normalize_answer(s):
+    def remove_articles(text):
+        regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+        return re.sub(regex, ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def official_get_tokens(s):
+    if not s:
+        return []
+    return official_normalize_answer(s).split()
+
+
+def official_compute_exact(a_gold, a_pred):
+    return int(official_normalize_answer(a_gold) == official_normalize_answer(a_pred))
+
+
+def official_compute_f1(a_gold, a_pred):
+    gold_toks = official_get_tokens(a_gold)
+    pred_toks = official_get_tokens(a_pred)
+    common = collections.Counter(gold_toks) & collections.Counter(pred_toks)
+    num_same = sum(common.values())
+    if len(gold_toks) == 0 or len(pred_toks) == 0:
+        # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+        return int(gold_toks == pred_toks)
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / len(pred_toks)
+    recall = 1.0 * num_same / len(gold_toks)
+    f1 = (2 * precision * recall) / (precision + recall)
+    return f1
+
+
+def official_scores(question_ids, answer_texts, predictions):
+    # get_raw_scores and make_eval_dict with a no-answer probability of 0
+    exact_scores, f1_scores = {}, {}
+    for question_id, texts in zip(question_ids, answer_texts):
+        gold_answers = [text for text in texts if official_normalize_answer(text)]
+        if not gold_answers:
+            # For unanswerable questions, only correct answer is empty string
+            gold_answers = ['']
+        if question_id not in predictions:
+            continue
+        prediction = predictions[question_id]
+        exact_scores[question_id] = max(official_compute_exact(a, prediction) for a in gold_answers)
+        f1_scores[question_id] = max(official_compute_f1(a, prediction) for a in gold_answers)
+    return exact_scores, f1_scores
+
+
+WORDS = ['The', 'the', 'a', 'An', 'cat', 'cats', 'Seoul', '서울', '대학교', '2021년', 'U.S.', "don't", 'e-mail', '!', ',', 'an', '']
+
+
+def random_answer(rng):
+    return ' '.join(rng.choice(WORDS, size=rng.integers(0, 5))) + str(rng.choice(['', '.', ' ', '?']))
+
+
+def test_scorer_matches_official_squad_v2():
+    rng = np.random.default_rng(0)
+    question_ids = ['q{}'.format(i) for i in range(500)]
+    # unanswerable questions, one or several references, references that normalize to nothing
+    answer_texts = [[random_answer(rng) for _ in range(rng.integers(0, 4))] for _ in question_ids]
+    predictions = {}
+    for question_id, texts in zip(question_ids, answer_texts):
+        if rng.random() < .1:
+            continue
+        predictions[question_id] = texts[0] if len(texts) > 0 and rng.random() < .3 else random_answer(rng)
+
+    exact, f1 = official_scores(question_ids, answer_texts, predictions)
+    scorer = SquadV2Scorer(question_ids, answer_texts)
+    exact_scores, f1_scores = scorer.score_questions(predictions)
+    assert exact_scores == [exact[question_id] for question_id in question_ids if question_id in predictions]
+    assert f1_scores == pytest.approx([f1[question_id] for question_id in question_ids if question_id in predictions])
+
+    result = scorer.score(predictions)
+    assert result['exact'] == pytest.approx(100.0 * sum(exact.values()) / len(exact))
+    assert result['f1'] == pytest.approx(100.0 * sum(f1.values()) / len(f1))
+
+
+def test_scorer_rejects_predictions_without_scored_questions():
+    scorer = SquadV2Scorer(['q0', 'q1'], [['cat'], []])
+    with pytest.raises(ValueError):
+        scorer.score({})
+    with pytest.raises(ValueError):
+        scorer.score({'q2': 'cat'})
+    assert scorer.score({'q1': ''}) == {'exact': 100.0, 'f1': 100.0}
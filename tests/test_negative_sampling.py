@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+import torch
+
+from transformers import BertConfig, BertForQuestionAnswering, TrainingArguments
+
+from modules.dataset import QADataset, NegativeSubsampledSampler, DynamicPaddingCollator
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.negative_sampling import negative_windows, reweighted_span_loss
+
+
+CLS_TOKEN_ID = 2
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=37)
+    return BertForQuestionAnswering(config)
+
+
+@pytest.fixture
+def train_store(tmp_path):
+    '''
+    Training features starting with the CLS token, about two thirds of them
+    negatives labeled at it.
+    '''
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(8, 40, size=90)
+    input_ids = [[CLS_TOKEN_ID] + rng.integers(5, 100, size=length - 1).tolist() for length in lengths]
+    negative = rng.random(len(lengths)) < .65
+    start_positions = np.where(negative, 0, rng.integers(1, 4, size=len(lengths)))
+    end_positions = np.where(negative, 0, start_positions + rng.integers(0, 4, size=len(lengths)))
+
+    writer = FeatureStoreWriter(str(tmp_path))
+    writer.append({
+        'input_ids': input_ids,
+        'token_type_ids': [[0] * length for length in lengths],
+        'attention_mask': [[1] * length for length in lengths],
+        'start_positions': start_positions.tolist(),
+        'end_positions': end_positions.tolist(),
+    })
+    writer.close()
+    return FeatureStore(str(tmp_path))
+
+
+def test_negative_windows(train_store):
+    negatives = negative_windows(train_store['input_ids'], train_store['start_positions'], CLS_TOKEN_ID)
+    np.testing.assert_array_equal(negatives, np.asarray(train_store['start_positions']) == 0)
+
+
+@pytest.mark.parametrize('negative_ratio', [.1, .5, 1.])
+def test_negative_subsampled_sampler_counts(negative_ratio):
+    rng = np.random.default_rng(0)
+    negatives = rng.random(1000) < .8
+    sampler = NegativeSubsampledSampler(rng.integers(1, 100, size=1000), negatives, negative_ratio, batch_size=16)
+    n_sampled = int(round(negatives.sum() * negative_ratio))
+    assert len(sampler) == (~negatives).sum() + n_sampled
+    assert sampler.n_skipped == negatives.sum() - n_sampled
+
+    epochs = [np.array(list(sampler)) for _ in range(3)]
+    for indices in epochs:
+        assert len(indices) == len(sampler) == len(np.unique(indices))
+        # every positive, and n_sampled of the negatives
+        np.testing.assert_array_equal(np.sort(indices[~negatives[indices]]), np.flatnonzero(~negatives))
+        assert negatives[indices].sum() == n_sampled
+    if negative_ratio < 1:
+        # a new sample of negatives every epoch
+        assert set(epochs[0][negatives[epochs[0]]]) != set(epochs[1][negatives[epochs[1]]])
+
+
+def test_reweighted_span_loss_is_the_qa_loss_at_ratio_one(train_store):
+    model = tiny_model().eval()
+    dataset = QADataset(*[train_store[name] for name in ('input_ids', 'token_type_ids', 'attention_mask', 'start_positions', 'end_positions')])
+    batch = DynamicPaddingCollator()([dataset[i] for i in range(16)])
+    negative = batch['start_positions'] == 0
+
+    with torch.no_grad():
+        outputs = model(**batch)
+    loss = reweighted_span_loss(outputs.start_logits, outputs.end_logits, batch['start_positions'], batch['end_positions'], negative, 1.)
+    assert torch.allclose(loss, outputs.loss)
+
+    # negatives weighted by 1 / ratio
+    weighted = reweighted_span_loss(outputs.start_logits, outputs.end_logits, batch['start_positions'], batch['end_positions'], negative, 4.)
+    losses = torch.stack([
+        model(**{key: value[i:i + 1] for key, value in batch.items()}).loss.detach() for i in range(len(negative))])
+    weights = torch.where(negative, torch.tensor(4.), torch.tensor(1.))
+    assert torch.allclose(weighted, (losses * weights).sum() / weights.sum(), atol=1e-5)
+
+
+def test_length_grouped_trainer_trains_on_subsampled_negatives(train_store, tmp_path):
+    pytest.importorskip('accelerate')
+    from hf_trainer import LengthGroupedTrainer
+
+    model = tiny_model()
+    dataset = QADataset(*[train_store[name] for name in ('input_ids', 'token_type_ids', 'attention_mask', 'start_positions', 'end_positions')])
+    negatives = negative_windows(train_store['input_ids'], train_store['start_positions'], CLS_TOKEN_ID)
+    trainer = LengthGroupedTrainer(
+        model=model,
+        args=TrainingArguments(output_dir=str(tmp_path / 'checkpoints'), per_device_train_batch_size=8, max_steps=1,
+                               learning_rate=1e-3, save_strategy='no', report_to=[]),
+        data_collator=DynamicPaddingCollator(),
+        train_dataset=dataset,
+        negatives=negatives,
+        negative_ratio=.25,
+        cls_token_id=CLS_TOKEN_ID)
+
+    # one epoch of the dataloader the trainer builds holds all positives and a quarter of the negatives
+    batches = list(trainer.get_train_dataloader())
+    n_sampled = int(round(negatives.sum() * .25))
+    assert sum(len(batch['input_ids']) for batch in batches) == (~negatives).sum() + n_sampled
+    assert sum(int((batch['start_positions'] == 0).sum()) for batch in batches) == n_sampled
+    assert trainer.negative_sampler.n_skipped == negatives.sum() - n_sampled
+
+    # the trainer loss weights the negatives of the batch by 1 / negative_ratio
+    batch = batches[0]
+    model.eval()
+    with torch.no_grad():
+        loss = trainer.compute_loss(model, batch)
+        outputs = model(**batch)
+    expected = reweighted_span_loss(
+        outputs.start_logits, outputs.end_logits, batch['start_positions'], batch['end_positions'], batch['start_positions'] == 0, 4.)
+    assert loss.item() == pytest.approx(expected.item(), rel=1e-4)
+
+    # one optimizer step through the training loop
+    weights = model.qa_outputs.weight.detach().clone()
+    result = trainer.train()
+    assert result.global_step == 1
+    assert np.isfinite(result.training_loss)
+    assert not torch.equal(model.qa_outputs.weight.detach(), weights)
@@ -0,0 +1,120 @@
+import json
+import collections
+
+import numpy as np
+import pytest
+
+from modules.postprocess import offsets_to_array, mask_padding, postprocess_predictions, StreamingDecoder
+
+
+def baseline_predictions(start_logits, end_logits, offset_mapping, feature_example_ids, example_ids, contexts, n_best, max_answer_length):
+    # the n_best double loop of compute_metrics and inference.py before the vectorized decoder
+    example_to_features = collections.defaultdict(list)
+    for idx, example_id in enumerate(feature_example_ids):
+        example_to_features[example_id].append(idx)
+
+    predictions = collections.OrderedDict()
+    for example_id, context in zip(example_ids, contexts):
+        answers = []
+        for feature_index in example_to_features[example_id]:
+            start_logit = start_logits[feature_index]
+            end_logit = end_logits[feature_index]
+            offsets = offset_mapping[feature_index]
+
+            start_indexes = np.argsort(start_logit)[-1 : -n_best - 1 : -1].tolist()
+            end_indexes = np.argsort(end_logit)[-1 : -n_best - 1 : -1].tolist()
+            for start_index in start_indexes:
+                for end_index in end_indexes:
+                    if offsets[start_index] is None or offsets[end_index] is None:
+                        continue
+                    if (end_index < start_index
+                            or end_index - start_index + 1 > max_answer_length):
+                        continue
+                    answers.append({
+                        "text": context[offsets[start_index][0] : offsets[end_index][1]],
+                        "logit_score": start_logit[start_index] + end_logit[end_index]})
+
+        if len(answers) > 0:
+            predictions[example_id] = max(answers, key=lambda x: x["logit_score"])["text"]
+        else:
+            predictions[example_id] = ""
+    return predictions
+
+
+def random_features(rng, n_examples=30, seq_len=48):
+    '''
+    Examples with one to three overflow windows each, offsets laid out like
+    preprocess_validation_examples: (0, 0) for the first token, None for the
+    question and special tokens, increasing character spans for the context.
+    '''
+    contexts, offset_mapping, feature_example_ids = [], [], []
+    for example_id in range(n_examples):
+        context = ''.join(rng.choice(list('abcde '), size=200))
+        contexts.append(context)
+        for _ in range(rng.integers(1, 4)):
+            question_length = rng.integers(1, 10)
+            context_length = rng.integers(0, seq_len - question_length - 2)
+            starts = np.sort(rng.choice(len(context) - 1, size=context_length, replace=False))
+            offsets = [(0, 0)] + [None] * (question_length + 1)
+            offsets += [(int(start), int(start) + int(rng.integers(1, 4))) for start in starts]
+            offsets += [None]
+            offset_mapping.append(offsets)
+            feature_example_ids.append(example_id)
+    return contexts, offset_mapping, feature_example_ids
+
+
+@pytest.mark.parametrize('n_best', [1, 5, 20, 100])
+@pytest.mark.parametrize('max_answer_length', [1, 4, 30])
+def test_postprocess_predictions_matches_double_loop(n_best, max_answer_length):
+    rng = np.random.default_rng(n_best * 100 + max_answer_length)
+    contexts, offset_mapping, feature_example_ids = random_features(rng)
+    seq_len = max(len(offsets) for offsets in offset_mapping)
+    start_logits = rng.normal(size=(len(offset_mapping), seq_len))
+    end_logits = rng.normal(size=(len(offset_mapping), seq_len))
+    example_ids = list(range(len(contexts)))
+
+    expected = baseline_predictions(
+        start_logits, end_logits, [offsets + [None] * (seq_len - len(offsets)) for offsets in offset_mapping],
+        feature_example_ids, example_ids, contexts, n_best, max_answer_length)
+    predictions = postprocess_predictions(
+        start_logits, end_logits, offsets_to_array(offset_mapping, seq_len), feature_example_ids, example_ids, contexts,
+        n_best=n_best, max_answer_length=max_answer_length)
+    assert predictions == expected
+
+
+def test_postprocess_predictions_ignores_padding():
+    rng = np.random.default_rng(0)
+    contexts, offset_mapping, feature_example_ids = random_features(rng)
+    lengths = [len(offsets) for offsets in offset_mapping]
+    start_logits = mask_padding(rng.normal(size=(len(offset_mapping), max(lengths))), lengths)
+    end_logits = mask_padding(rng.normal(size=(len(offset_mapping), max(lengths))), lengths)
+    example_ids = list(range(len(contexts)))
+    predictions = postprocess_predictions(
+        start_logits, end_logits, offsets_to_array(offset_mapping), feature_example_ids, example_ids, contexts, n_best=5)
+
+    # the same features batched wider, padding logits are -inf as predict_logits returns them
+    padded = [np.pad(logits, ((0, 0), (0, 16)), constant_values=-np.inf) for logits in (start_logits, end_logits)]
+    assert postprocess_predictions(
+        *padded, offsets_to_array(offset_mapping, max(lengths) + 16), feature_example_ids, example_ids, contexts, n_best=5) == predictions
+
+
+def test_streaming_decoder_matches_postprocess_predictions(tmp_path):
+    rng = np.random.default_rng(1)
+    contexts, offset_mapping, feature_example_ids = random_features(rng)
+    seq_len = max(len(offsets) for offsets in offset_mapping)
+    start_logits = rng.normal(size=(len(offset_mapping), seq_len))
+    end_logits = rng.normal(size=(len(offset_mapping), seq_len))
+    example_ids = list(range(len(contexts)))
+    expected = postprocess_predictions(
+        start_logits, end_logits, offsets_to_array(offset_mapping, seq_len), feature_example_ids, example_ids, contexts, n_best=5)
+
+    output_fn = tmp_path / 'predictions.jsonl'
+    decoder = StreamingDecoder(offset_mapping, feature_example_ids, example_ids, contexts, str(output_fn), n_best=5)
+    for begin in range(0, len(offset_mapping), 7):
+        indexes = range(begin, min(begin + 7, len(offset_mapping)))
+        decoder.put(indexes, start_logits[begin:begin + 7], end_logits[begin:begin + 7])
+    assert decoder.close() == len(example_ids)
+
+    with open(output_fn, encoding='utf-8') as fr:
+        predictions = {line['id']: line['prediction_text'] for line in map(json.loads, fr)}
+    assert predictions == dict(expected)
@@ -0,0 +1,173 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.feature_store import FeatureStore, FeatureStoreWriter
+from modules.preprocess import preprocess_training_examples, preprocess_validation_examples, preprocess_shared_context_examples, tokenize_shards
+
+
+WINDOWS = [(32, 8), (48, 16), (24, 4)]
+
+
+def random_text(rng, n_words):
+    words = [''.join(rng.choice(list('abcde'), size=rng.integers(1, 7))) for _ in range(n_words)]
+    return ' '.join(word + str(rng.choice(['', '', '', ',', '.'])) for word in words)
+
+
+def random_examples(rng, n_contexts=20, questions_per_context=3, answer_rate=.7):
+    '''
+    Examples sharing their contexts, answers are random character spans of the
+    context that may start or end inside a word. Unanswerable examples have
+    empty answer_start and text lists.
+    '''
+    rows = []
+    for i in range(n_contexts):
+        context = random_text(rng, rng.integers(5, 60))
+        for j in range(questions_per_context):
+            answer_start, text = [], []
+            if rng.random() < answer_rate:
+                start = int(rng.integers(0, len(context) - 1))
+                end = int(rng.integers(start + 1, min(start + 20, len(context)) + 1))
+                answer_start, text = [start], [context[start:end]]
+            rows.append({
+                'question_id': 'q{}_{}'.format(i, j),
+                'question': random_text(rng, rng.integers(1, 4)),
+                'context': context,
+                'answer_start': answer_start,
+                'text': text,
+            })
+    return pd.DataFrame(rows)
+
+
+def baseline_training_features(examples, tokenizer, max_length, stride):
+    # preprocess_training_examples before the vectorized label alignment, padded to max_length
+    inputs = tokenizer(
+        examples["question"].tolist(),
+        examples["context"].tolist(),
+        max_length=max_length,
+        truncation="only_second",
+        stride=stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        padding="max_length",
+    )
+
+    offset_mapping = inputs.pop("offset_mapping")
+    sample_map = inputs.pop("overflow_to_sample_mapping")
+    answer_starts = examples['answer_start']
+    texts = examples['text']
+    start_positions = []
+    end_positions = []
+
+    for i, offset in enumerate(offset_mapping):
+        input_ids = inputs["input_ids"][i]
+        cls_index = input_ids.index(tokenizer.cls_token_id)
+        sequence_ids = inputs.sequence_ids(i)
+        sample_idx = sample_map[i]
+        answer_start = answer_starts[sample_idx]
+        text = texts[sample_idx]
+
+        if len(answer_start) == 0:
+            start_positions.append(cls_index)
+            end_positions.append(cls_index)
+
+        else:
+            start_char = answer_start[0]
+            end_char = answer_start[0] + len(text[0])
+
+            idx = 0
+            while sequence_ids[idx] != 1:
+                idx += 1
+            context_start = idx
+            while sequence_ids[idx] == 1:
+                idx += 1
+            context_end = idx - 1
+
+            if offset[context_start][0] > start_char or offset[context_end][1] < end_char:
+                start_positions.append(0)
+                end_positions.append(0)
+            else:
+                idx = context_start
+                while idx <= context_end and offset[idx][0] <= start_char:
+                    idx += 1
+                start_positions.append(idx - 1)
+
+                idx = context_end
+                while idx >= context_start and offset[idx][1] >= end_char:
+                    idx -= 1
+                end_positions.append(idx + 1)
+
+    inputs["start_positions"] = start_positions
+    inputs["end_positions"] = end_positions
+    return inputs
+
+
+@pytest.mark.parametrize('max_length,stride', WINDOWS)
+def test_training_labels_match_while_loop(tokenizer, max_length, stride):
+    examples = random_examples(np.random.default_rng(max_length))
+    expected = baseline_training_features(examples, tokenizer, max_length, stride)
+    features = preprocess_training_examples(examples, tokenizer, max_length, stride)
+
+    assert features['start_positions'] == expected['start_positions']
+    assert features['end_positions'] == expected['end_positions']
+    # the same windows, only without padding
+    assert len(features['input_ids']) == len(expected['input_ids'])
+    for input_ids, mask, padded_ids in zip(features['input_ids'], expected['attention_mask'], expected['input_ids']):
+        assert input_ids == padded_ids[:sum(mask)]
+    # both windows labeled with an answer span and windows labeled at the first token occur
+    assert 0 < sum(position > 0 for position in features['start_positions']) < len(features['start_positions'])
+
+
+def test_parallel_shards_match_serial(tokenizer, tmp_path):
+    tokenizer.save_pretrained(str(tmp_path))
+    examples = random_examples(np.random.default_rng(0))
+    config = SimpleNamespace(pretrained_model_name=str(tmp_path), max_length=32, stride=8, chunk_size=7, num_workers=1)
+    serial = list(tokenize_shards(examples, preprocess_training_examples, config, tokenizer))
+
+    config.num_workers = 2
+    parallel = list(tokenize_shards(examples, preprocess_training_examples, config))
+    assert len(parallel) == len(serial) == -(-len(examples) // config.chunk_size)
+    for parallel_shard, serial_shard in zip(parallel, serial):
+        assert {key: list(values) for key, values in parallel_shard.items()} == {key: list(values) for key, values in serial_shard.items()}
+
+
+def write_store(path, shards):
+    writer = FeatureStoreWriter(str(path))
+    for features in shards:
+        writer.append(features)
+    writer.close()
+    return FeatureStore(str(path))
+
+
+@pytest.mark.parametrize('max_length,stride', WINDOWS)
+def test_shared_context_features_match_validation_features(tokenizer, tmp_path, max_length, stride):
+    examples = random_examples(np.random.default_rng(max_length))
+    config = SimpleNamespace(max_length=max_length, stride=stride, chunk_size=7, num_workers=1)
+    expected = write_store(tmp_path / 'validation', tokenize_shards(examples, preprocess_validation_examples, config, tokenizer))
+    store = write_store(tmp_path / 'shared', tokenize_shards(examples, preprocess_shared_context_examples, config, tokenizer))
+
+    assert len(store) == len(expected)
+    assert list(store['example_id']) == list(expected['example_id'])
+    for name in ('input_ids', 'token_type_ids', 'attention_mask', 'offset_mapping'):
+        for row, expected_row in zip(store[name], expected[name]):
+            np.testing.assert_array_equal(row, expected_row)
+
+
+def test_contexts_are_stored_once_across_shards(tokenizer, tmp_path):
+    tokenizer.save_pretrained(str(tmp_path))
+    # questions of a context spread over several shards
+    examples = random_examples(np.random.default_rng(0)).sample(frac=1, random_state=0).reset_index(drop=True)
+    stores = []
+    for chunk_size, num_workers in ((len(examples), 1), (7, 1), (7, 2)):
+        config = SimpleNamespace(pretrained_model_name=str(tmp_path), max_length=32, stride=8, chunk_size=chunk_size, num_workers=num_workers)
+        shards = tokenize_shards(examples, preprocess_shared_context_examples, config, tokenizer)
+        stores.append(write_store(tmp_path / '{}_{}'.format(chunk_size, num_workers), shards))
+
+    for store in stores:
+        assert store.meta['n_contexts'] == examples['context'].nunique()
+        for name in ('context_offsets', 'context_splits', 'context_index'):
+            with open(os.path.join(store.path, name + '.bin'), 'rb') as fr, open(os.path.join(stores[0].path, name + '.bin'), 'rb') as expected:
+                assert fr.read() == expected.read()
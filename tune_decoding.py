@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import argparse
+import itertools
+
+import pandas as pd
+import numpy as np
+
+from modules.feature_store import FeatureStore
+from modules.logit_cache import LogitCache, ensemble_fingerprint
+from modules.metrics import SquadV2Scorer
+from modules.postprocess import offsets_to_array, postprocess_predictions
+from modules.window_filter import WindowIndex, select_windows
+
+
+def define_argparser():
+    '''
+    Define argument parser to tune the decoding parameters on cached validation logits.
+    '''
+    p = argparse.ArgumentParser()
+
+    p.add_argument('--model_fn',
+                    nargs='+',
+                    default=None,
+                    help="Checkpoint (or ensemble members) whose validation logits were cached with --cache_logits.")
+    p.add_argument('--optimized_fn', default=None)
+    p.add_argument('--artifact_dir', nargs='+', default=None)
+    p.add_argument('--ensemble_weights', type=float, nargs='+', default=None)
+    p.add_argument('--file_path',
+                    required=True,
+                    help="Directory where preprocessed data files located.")
+    p.add_argument('--n_best', type=int, nargs='+', default=[1, 5, 20])
+    p.add_argument('--max_answer_length', type=int, nargs='+', default=[20, 30, 40, 60])
+    p.add_argument('--top_k_windows',
+                    type=int,
+                    nargs='+',
+                    default=None,
+                    help="Also decode only the k best BM25 windows of every question, as inference.py --top_k_windows does, and report the forward passes saved.")
+    p.add_argument('--report_fn', default=None, help="Also write the exact/F1 of every setting to this json file.")
+
+    config = p.parse_args()
+    if config.model_fn is None and config.optimized_fn is None and config.artifact_dir is None:
+        p.error('Set --model_fn, --optimized_fn or --artifact_dir.')
+
+    return config
+
+
+def main(config):
+    valid = FeatureStore(os.path.join(config.file_path, 'validation_features'))
+    validation = pd.read_pickle(os.path.join(config.file_path, 'validation.pkl'))
+
+    cache = LogitCache(valid, ensemble_fingerprint(config.model_fn, config.optimized_fn, config.artifact_dir, config.ensemble_weights))
+    logits = cache.load()
+    if logits is None:
+        raise FileNotFoundError(
+            'No cached validation logits of this checkpoint. Run hf_trainer.py or inference.py --split validation with --cache_logits first.')
+    start_logits, end_logits = logits
+
+    # everything but the span selection is shared by all settings
+    offsets = offsets_to_array(valid['offset_mapping'], start_logits.shape[1])
+    feature_example_ids = list(valid['example_id'])
+    question_ids = validation['question_id'].tolist()
+    contexts = validation['context'].tolist()
+    scorer = SquadV2Scorer.from_examples(validation)
+
+    # skipping a window is the same as decoding it with -inf logits, since logits do not depend on the batch
+    window_settings = [(None, np.ones(len(valid), dtype=bool))]
+    if config.top_k_windows is not None:
+        if not WindowIndex.exists(valid):
+            raise FileNotFoundError('No window index of the current features in {}, run preprocess.py with --window_index.'.format(valid.path))
+        window_scores = WindowIndex(valid.path).scores()
+        window_settings += [(top_k, select_windows(window_scores, valid['example_index'], top_k)) for top_k in config.top_k_windows]
+
+    print('{:>8}{:>10}{:>8}{:>20}{:>10}{:>10}{:>10}'.format('windows', 'top_k', 'n_best', 'max_answer_length', 'exact', 'f1', 'seconds'))
+    results = []
+    full = {}
+    for top_k, keep in window_settings:
+        window_start_logits = np.where(keep[:, None], start_logits, -np.inf)
+        window_end_logits = np.where(keep[:, None], end_logits, -np.inf)
+        for n_best, max_answer_length in itertools.product(config.n_best, config.max_answer_length):
+            started = time.perf_counter()
+            predictions = postprocess_predictions(
+                window_start_logits,
+                window_end_logits,
+                offsets,
+                feature_example_ids,
+                question_ids,
+                contexts,
+                n_best=n_best,
+                max_answer_length=max_answer_length)
+            result = {
+                'top_k_windows': top_k,
+                'n_windows': int(keep.sum()),
+                'n_best': n_best,
+                'max_answer_length': max_answer_length,
+                **scorer.score(predictions)}
+            result['seconds'] = time.perf_counter() - started
+            if top_k is None:
+                full[n_best, max_answer_length] = result
+            else:
+                # forward passes saved by the filter against the exact/F1 it costs
+                result['forward_saved'] = 1 - result['n_windows'] / len(valid)
+                result['exact_change'] = result['exact'] - full[n_best, max_answer_length]['exact']
+                result['f1_change'] = result['f1'] - full[n_best, max_answer_length]['f1']
+            results.append(result)
+            print('{:>8}{:>10}{:>8}{:>20}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                result['n_windows'], top_k or 'all', n_best, max_answer_length, result['exact'], result['f1'], result['seconds']))
+
+    best = max(results, key=lambda result: (result['f1'], result['exact']))
+    print('best: top_k_windows {} n_best {} max_answer_length {} (exact {:.2f}, f1 {:.2f})'.format(
+        best['top_k_windows'] or 'all', best['n_best'], best['max_answer_length'], best['exact'], best['f1']))
+
+    if config.report_fn is not None:
+        with open(config.report_fn, 'w') as fw:
+            json.dump({'logits_fn': cache.logits_fn, 'results': results, 'best': best}, fw, indent=2)
+
+
+if __name__ == '__main__':
+    config = define_argparser()
+    main(config)